@@ -1,11 +1,34 @@
+import hmac
 import os
+from time import sleep
 
-from flask import Flask, render_template, request, flash, redirect, session, g, abort 
+import click
+
+from flask import Flask, render_template, request, flash, redirect, session, g, abort, jsonify
+from flask.ctx import _AppCtxGlobals
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 
 from forms import UserAddForm, LoginForm, MessageForm,UserEditForm
-from models import db, connect_db, User, Message, Likes
+from models import db, connect_db, User, Message, Likes, Follows
+from assets import configure_assets, build_assets, prune_assets, serve_asset
+from caching import configure_caching, conditional, user_stamp, viewer_stamp
+from counters import (message_added, message_removed, follow_added,
+                      follow_removed, like_added, like_removed,
+                      reconcile_counters)
+from loading import with_authors, liked_ids, message_versions, follows_author
+from metrics import configure_metrics, scrape
+from migrations import migrate, check_indexes, build_index_pack, LATEST_VERSION
+from pagination import paginate, get_before, page_of, per_page, seek
+from purge import mark_deleted, purge_deleted_users
+from profiler import configure_profiler, profiler, ProfilerBusy
+from passwords import configure_passwords, calibrate_log_rounds, PasswordPoolFull
+from snowflakes import configure_snowflakes
+from sqlstats import configure_sql_stats
+from search import search_users, search_messages, index_message, unindex_message, reindex_messages
+from usercache import user_cache, load_user
+from timelines import (get_timeline_store, fan_out_message, backfill_follow,
+                       followers_lost, read_timeline)
 
 CURR_USER_KEY = "curr_user"
 
@@ -20,24 +43,95 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+app.config['PAGE_SIZE'] = int(os.environ.get('PAGE_SIZE', 100))
+# "sql" (Postgres indexes) or "memory" (in-process index). See search.py.
+app.config['SEARCH_BACKEND'] = os.environ.get('SEARCH_BACKEND', 'sql')
 # toolbar = DebugToolbarExtension(app)
 
+# Materialized home timelines: None (build the feed on every view),
+# "sql" or "memory". See timelines.py.
+app.config['TIMELINE_BACKEND'] = os.environ.get('TIMELINE_BACKEND')
+app.config['TIMELINE_MAX_LENGTH'] = int(os.environ.get('TIMELINE_MAX_LENGTH', 800))
+# Authors with more followers than this are merged in at read time
+# instead of being fanned out on write (see benchmarks/timeline_fanout.py).
+app.config['TIMELINE_FANOUT_THRESHOLD'] = int(
+    os.environ.get('TIMELINE_FANOUT_THRESHOLD', 1000))
+
+# Seconds to keep the logged-in user's row in this process (0 = don't).
+# See usercache.py.
+app.config['CURRENT_USER_CACHE_TTL'] = float(
+    os.environ.get('CURRENT_USER_CACHE_TTL', 0))
+
+# bcrypt runs in a pool of this many processes (0 = inline on the request
+# worker), with at most this many more jobs waiting before we answer 503.
+app.config['BCRYPT_POOL_SIZE'] = int(os.environ.get('BCRYPT_POOL_SIZE', 0))
+app.config['BCRYPT_QUEUE_LIMIT'] = int(os.environ.get('BCRYPT_QUEUE_LIMIT', 0))
+# bcrypt cost; pick it per machine with `flask calibrate-bcrypt`.
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+# Unique per process minting message ids (0-1023); if unset, each process
+# leases a free one from Postgres. See snowflakes.py.
+app.config['SNOWFLAKE_WORKER_ID'] = os.environ.get('SNOWFLAKE_WORKER_ID')
+# Requests slower than this are logged with their SQL; see sqlstats.py.
+app.config['SLOW_REQUEST_MS'] = float(os.environ.get('SLOW_REQUEST_MS', 500))
+# Send each request's query count and database time in a Server-Timing
+# header (always on in debug mode).
+app.config['SERVER_TIMING'] = os.environ.get('SERVER_TIMING') == '1'
+# Sampling profiler at /_profile, off unless this is set; see profiler.py.
+app.config['PROFILER_TOKEN'] = os.environ.get('PROFILER_TOKEN')
+app.config['PROFILER_MAX_SECONDS'] = float(os.environ.get('PROFILER_MAX_SECONDS', 60))
+# With several worker processes, each writes its metrics here every
+# METRICS_FLUSH_SECONDS for /metrics to add up; see metrics.py.
+app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR')
+app.config['METRICS_FLUSH_SECONDS'] = float(os.environ.get('METRICS_FLUSH_SECONDS', 5))
+# Where `flask build-assets` writes hashed, precompressed copies of
+# static/ for /assets/ to serve; see assets.py.
+app.config['ASSETS_DIR'] = os.environ.get(
+    'ASSETS_DIR', os.path.join(app.static_folder, 'dist'))
+
 connect_db(app)
+configure_metrics(app)
+configure_passwords(app)
+configure_snowflakes(app)
+configure_sql_stats(app)
+configure_profiler(app)
+configure_caching(app)
+configure_assets(app)
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+class WarblerGlobals(_AppCtxGlobals):
+    """Flask's `g`, except that g.user is only looked up when first used.
+
+    Requests that never touch g.user (static files, anonymous pages) skip
+    the lookup entirely, and the rest do it once.
+    """
+
+    @property
+    def user(self):
+        if '_user' not in self.__dict__:
+            self._user = add_user_to_g()
+        return self._user
+
+    @user.setter
+    def user(self, user):
+        self._user = user
+
+
+app.app_ctx_globals_class = WarblerGlobals
+
+
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, get curr user for the Flask global."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        return load_user(session[CURR_USER_KEY],
+                         app.config['CURRENT_USER_CACHE_TTL'])
 
     else:
-        g.user = None
+        return None
 
 
 def do_login(user):
@@ -100,6 +194,10 @@ def login():
                                  form.password.data)
 
         if user:
+            # Saves the password if authenticate() rehashed it, and drops
+            # any cached copy of the old hash.
+            db.session.commit()
+            user_cache.forget(user.id)
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -123,36 +221,57 @@ def logout():
 
 @app.route('/users')
 def list_users():
-    """Page with listing of users.
+    """Page with listing of users, a page at a time.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username;
+    exact and prefix matches come first.
     """
 
     search = request.args.get('q')
 
     if not search:
-        users = User.query.all()
+        users, next_cursor = paginate(User.visible(), [User.id], key=lambda u: (u.id,))
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users, next_cursor = search_users(search)
+
+    # One query for every listed user's follow state; the template's
+    # is_following() calls then answer from the cache.
+    if g.user:
+        g.user.following_among(users)
 
-    return render_template('users/index.html', users=users)
+    return render_template('users/index.html', users=users,
+                           next_cursor=next_cursor)
 
 
 @app.route('/users/<int:user_id>')
 def users_show(user_id):
-    """Show user profile."""
+    """Show user profile, with their messages a page at a time."""
 
-    user = User.query.get_or_404(user_id)
+    user = User.visible().filter(User.id == user_id).first_or_404()
+
+    # Version the page from the user's row and the ids and like counts of
+    # the messages on it, before loading anything else.
+    columns = [Message.id]
+    page = seek(Message.query.filter(Message.user_id == user_id), columns, get_before(columns))
+    versions = message_versions(page.limit(per_page() + 1), g.user)
+
+    not_modified = conditional(
+        viewer_stamp(g.user), user_stamp(user), versions,
+        g.user is not None and g.user.id != user.id and g.user.is_following(user),
+        private=g.user is not None)
+    if not_modified:
+        return not_modified
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    messages, next_cursor = paginate(
+        Message.query.filter(Message.user_id == user_id),
+        [Message.id],
+        key=lambda msg: (msg.id,))
+    likes = {message_id for message_id, _, liked in versions if liked}
+
+    return render_template('users/show.html', user=user, messages=messages,
+                           next_cursor=next_cursor, likes=likes)
 
 
 @app.route('/users/<int:user_id>/following')
@@ -163,8 +282,18 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = User.visible().filter(User.id == user_id).first_or_404()
+    following, next_cursor = paginate(
+        (User
+         .visible()
+         .join(Follows, Follows.user_being_followed_id == User.id)
+         .filter(Follows.user_following_id == user_id)),
+        [User.id],
+        key=lambda u: (u.id,))
+    g.user.following_among(following)
+
+    return render_template('users/following.html', user=user,
+                           following=following, next_cursor=next_cursor)
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -175,8 +304,18 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = User.visible().filter(User.id == user_id).first_or_404()
+    followers, next_cursor = paginate(
+        (User
+         .visible()
+         .join(Follows, Follows.user_following_id == User.id)
+         .filter(Follows.user_being_followed_id == user_id)),
+        [User.id],
+        key=lambda u: (u.id,))
+    g.user.following_among(followers)
+
+    return render_template('users/followers.html', user=user,
+                           followers=followers, next_cursor=next_cursor)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -187,8 +326,15 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
+    followed_user = User.visible().filter(User.id == follow_id).first_or_404()
     g.user.following.append(followed_user)
+    follow_added(g.user.id, followed_user.id)
+
+    store = get_timeline_store()
+    if store:
+        db.session.flush()
+        backfill_follow(store, g.user.id, followed_user.id)
+
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -204,6 +350,14 @@ def stop_following(follow_id):
 
     followed_user = User.query.get(follow_id)
     g.user.following.remove(followed_user)
+    follow_removed(g.user.id, followed_user.id)
+
+    store = get_timeline_store()
+    if store:
+        store.prune_author(g.user.id, followed_user.id)
+        db.session.flush()
+        followers_lost(store, [followed_user.id])
+
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -233,6 +387,7 @@ def profile():
             user.bio = form.bio.data
 
             db.session.commit()
+            user_cache.forget(user.id)
             return redirect(f"/users/{user.id}")
 
         flash("Wrong password, try again!", 'danger')
@@ -250,7 +405,8 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    # The account disappears now; its rows are purged in the background.
+    mark_deleted(g.user)
     db.session.commit()
 
     return redirect("/signup")
@@ -275,6 +431,14 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        message_added(g.user.id)
+        db.session.flush()
+        index_message(msg)
+
+        store = get_timeline_store()
+        if store:
+            fan_out_message(store, msg)
+
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -282,12 +446,41 @@ def messages_add():
     return render_template('messages/new.html', form=form)
 
 
+@app.route('/messages/search')
+def messages_search():
+    """Full-text search over message text, most relevant first.
+
+    Takes the search words in a 'q' param in the querystring.
+    """
+
+    search = request.args.get('q', '').strip()
+
+    messages, next_cursor = search_messages(search) if search else ([], None)
+
+    return render_template('messages/search.html', messages=messages,
+                           next_cursor=next_cursor, likes=liked_ids(g.user, messages))
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get_or_404(message_id)
-    return render_template('messages/show.html', message=msg)
+    query = Message.visible().filter(Message.id == message_id)
+
+    # Version the page from one narrow row, before loading anything else.
+    versions = message_versions(query, g.user, User.id, User.username, User.image_url,
+                                follows_author(g.user))
+    if not versions:
+        abort(404)
+
+    not_modified = conditional(viewer_stamp(g.user), versions, private=g.user is not None)
+    if not_modified:
+        return not_modified
+
+    msg = query.first_or_404()
+    likes = {message_id for message_id, _, liked, *_ in versions if liked}
+
+    return render_template('messages/show.html', message=msg, likes=likes)
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -303,6 +496,12 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    store = get_timeline_store()
+    if store:
+        store.remove_message(msg.id)
+
+    message_removed(msg)
+    unindex_message(msg)
     db.session.delete(msg)
     db.session.commit()
 
@@ -319,8 +518,17 @@ def show_likes(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/likes.html', user=user)
+    user = User.visible().filter(User.id == user_id).first_or_404()
+    liked_messages, next_cursor = paginate(
+        with_authors(Message
+                     .visible()
+                     .join(Likes, Likes.message_id == Message.id)
+                     .filter(Likes.user_id == user_id)),
+        [Message.id],
+        key=lambda msg: (msg.id,))
+
+    return render_template('users/likes.html', user=user,
+                           liked_messages=liked_messages, next_cursor=next_cursor)
 
 @app.route('/messages/<int:message_id>/like', methods=["POST"])
 def like_message(message_id):
@@ -330,18 +538,23 @@ def like_message(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    liked_msg = Message.query.get(message_id)
+    liked_msg = Message.visible().filter(Message.id == message_id).first_or_404()
     if liked_msg.user_id == g.user.id:
         return abort(403)
-    user_likes = g.user.likes
-    if liked_msg in user_likes:
-        g.user.likes = [like for like in user_likes if like != liked_msg]
-    else:
-        g.user.likes.append(liked_msg)
-    
+
+    liked = Likes.toggle(g.user.id, message_id)
+    if liked:
+        like_added(g.user.id, message_id)
+    elif liked is False:
+        like_removed(g.user.id, message_id)
+
     db.session.commit()
 
-    return redirect("/")
+    # Scripts can ask for JSON and update the button in place.
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(liked=liked is not False, likes=liked_msg.like_count)
+
+    return redirect(request.referrer or "/")
 
 
 
@@ -354,21 +567,34 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, a page at a time
+      (read from the materialized timeline when TIMELINE_BACKEND is set)
     """
 
     if g.user:
-        following_ids = [f.id for f in g.user.following] + [g.user.id]
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-
-        return render_template('home.html', messages=messages)
+        store = get_timeline_store()
+        if store:
+            before = get_before([Message.id])
+            messages, next_cursor = page_of(
+                read_timeline(store, g.user, per_page() + 1, before),
+                per_page(),
+                key=lambda msg: (msg.id,))
+        else:
+            following_ids = [f.id for f in g.user.following] + [g.user.id]
+            messages, next_cursor = paginate(
+                with_authors(Message.visible().filter(Message.user_id.in_(following_ids))),
+                [Message.id],
+                key=lambda msg: (msg.id,))
+
+        return render_template('home.html', messages=messages,
+                               next_cursor=next_cursor,
+                               likes=liked_ids(g.user, messages))
 
     else:
+        not_modified = conditional('home-anon', private=False)
+        if not_modified:
+            return not_modified
+
         return render_template('home-anon.html')
 
 @app.errorhandler(404)
@@ -378,19 +604,159 @@ def page_not_found(e):
     return render_template("404.html"), 404
 
 
+@app.errorhandler(PasswordPoolFull)
+def password_pool_full(e):
+    """Too many logins at once: fail fast rather than queue forever."""
+
+    return render_template("503.html"), 503, {"Retry-After": "1"}
+
+
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+# Profiling and metrics (see profiler.py and metrics.py)
+
+
+@app.route('/_profile')
+def profile_worker():
+    """Sample this worker's request threads; answer with collapsed stacks."""
+
+    token = app.config['PROFILER_TOKEN']
+    if not token:
+        abort(404)
+
+    given = request.headers.get('Authorization', '').encode('UTF-8')
+    if not hmac.compare_digest(given, f"Bearer {token}".encode('UTF-8')):
+        abort(403)
+
+    seconds = min(request.args.get('seconds', 10, type=float),
+                  app.config['PROFILER_MAX_SECONDS'])
+    rate = min(max(request.args.get('rate', 100, type=float), 1), 1000)
+    route = request.args.get('route')
+    requests = request.args.get('requests', type=int)
+
+    try:
+        result = profiler.run(seconds, rate, route, requests if route else None)
+    except ProfilerBusy:
+        abort(409)
+
+    return result.collapsed(), 200, {"Content-Type": "text/plain; charset=utf-8",
+                                     "X-Profile-Samples": str(result.samples)}
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Request, database and pool metrics, in Prometheus text format."""
+
+    return scrape(app), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+##############################################################################
+# Built static assets (see assets.py)
+
+
+@app.route('/assets/<path:filename>')
+def assets(filename):
+    """A hashed asset from `flask build-assets`, precompressed if possible."""
+
+    return serve_asset(filename)
+
+
+##############################################################################
+# Maintenance commands (run like `FLASK_APP=app.py flask reconcile-counters`)
+
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Bring the database schema up to date."""
+
+    for migration in migrate():
+        print(f"Applied {migration.version}: {migration.description}")
+    print(f"Schema is at version {LATEST_VERSION}.")
+
+
+@app.cli.command('check-indexes')
+@click.option('--build', is_flag=True, help="Build missing and invalid indexes.")
+def check_indexes_command(build):
+    """Report missing, invalid and unused indexes in the live database."""
+
+    if build:
+        build_index_pack()
+
+    report = check_indexes()
+
+    for name in report.missing:
+        print(f"missing: {name}")
+    for name in report.invalid:
+        print(f"invalid: {name}")
+    for table, name, size in report.unused:
+        print(f"unused since stats reset: {name} on {table} ({size})")
+
+    if report.missing or report.invalid:
+        raise SystemExit(1)
+    print("All indexes present.")
+
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Write hashed, precompressed copies of static/ and their manifest."""
+
+    manifest = build_assets(app.static_folder, app.config['ASSETS_DIR'])
+    print(f"Built {len(manifest)} assets into {app.config['ASSETS_DIR']}.")
+
+
+@app.cli.command('prune-assets')
+@click.option('--days', default=7.0, help="Keep unused built files written this recently.")
+def prune_assets_command(days):
+    """Delete built assets that no recent build has used."""
+
+    deleted = prune_assets(app.config['ASSETS_DIR'], days * 24 * 60 * 60)
+    print(f"Deleted {deleted} old asset files.")
+
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters_command():
+    """Rebuild every user's denormalized counters from the base tables."""
+
+    reconcile_counters()
+    db.session.commit()
+    print("Counters reconciled.")
+
+
+@app.cli.command('reindex-messages')
+def reindex_messages_command():
+    """Build the search index for messages added in bulk (e.g. by seed.py)."""
+
+    reindex_messages()
+    db.session.commit()
+    print("Messages reindexed.")
+
+
+@app.cli.command('purge-deleted-users')
+@click.option('--batch-size', default=1000, help="Rows to delete per transaction.")
+@click.option('--watch', type=float, help="Keep running, checking every this many seconds.")
+def purge_deleted_users_command(batch_size, watch):
+    """Delete the rows of deleted accounts, a batch at a time."""
+
+    def progress(user_id, step, total):
+        print(f"user {user_id}: {total} {step} deleted")
+
+    while True:
+        for user_id in purge_deleted_users(batch_size, progress):
+            print(f"user {user_id}: purged")
+
+        if not watch:
+            break
+        sleep(watch)
+
+
+@app.cli.command('calibrate-bcrypt')
+@click.option('--target-ms', default=250, help="Latency budget for one hash.")
+@click.option('--min-rounds', default=10, help="Never pick a cost below this.")
+def calibrate_bcrypt_command(target_ms, min_rounds):
+    """Pick the bcrypt cost that fits a hashing latency budget on this machine."""
+
+    log_rounds, timings = calibrate_log_rounds(target_ms, min_rounds)
+
+    for rounds, ms in timings.items():
+        print(f"cost {rounds}: {ms:.0f}ms")
+    print(f"BCRYPT_LOG_ROUNDS={log_rounds}")
+
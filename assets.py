@@ -0,0 +1,245 @@
+"""Fingerprinted, precompressed static assets.
+
+``flask build-assets`` copies every file under ``static/`` into
+``ASSETS_DIR`` (``static/dist`` by default) under a name that includes a
+hash of its contents (``stylesheets/style.css`` becomes
+``stylesheets/style.1a2b3c4d5e6f.css``).  References to other static files
+inside stylesheets are rewritten to their hashed names first.  Next to
+each file it writes gzip and (when the ``brotli`` package is installed)
+brotli variants, when those come out at least 10% smaller.  A manifest maps
+each original name to its hashed name and the variants written.
+
+Templates link to assets with ``asset_url('stylesheets/style.css')``,
+which resolves through the manifest to ``/assets/<hashed name>``.  Those
+URLs change whenever the contents do, so they are cached for a year (see
+caching.py).  The `assets` view answers each with the smallest variant
+the browser's ``Accept-Encoding`` allows, read straight from disk, so no
+request spends CPU compressing.
+
+Builds are additive: files from earlier builds are left in place and the
+manifest is replaced atomically, so workers still running with the old
+manifest (and pages cached before a deploy) keep getting the files they
+link to.  ``flask prune-assets`` deletes built files that the current
+manifest doesn't use and no build has written for a while.
+
+Without a manifest (assets not built, e.g. in development) `asset_url`
+falls back to the plain static file, fingerprinted with a query string.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import time
+from os import path
+
+from flask import abort, current_app, request, safe_join, send_file, url_for
+
+from caching import static_url
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST = 'manifest.json'
+
+# Variants by preference, with their file suffixes.
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+# Already compressed; another pass only wastes build time.
+INCOMPRESSIBLE = {'.png', '.jpg', '.jpeg', '.gif', '.webp', '.woff', '.woff2', '.gz', '.br'}
+
+CSS_URL = re.compile(r"""url\((["']?)/static/([^"')]+)\1\)""")
+
+
+def hashed_name(name, contents):
+    """`name` with a hash of `contents` before its extension."""
+
+    root, ext = path.splitext(name)
+    return f"{root}.{hashlib.md5(contents).hexdigest()[:12]}{ext}"
+
+
+def compress(encoding, contents):
+    if encoding == 'gzip':
+        return gzip.compress(contents, 9, mtime=0)
+    return brotli.compress(contents)
+
+
+def source_files(static_dir, out_dir):
+    """Names (relative to `static_dir`) of every file to build, stylesheets last."""
+
+    names = []
+    for root, dirs, files in os.walk(static_dir):
+        if path.abspath(root) == path.abspath(out_dir):
+            dirs[:] = []
+            continue
+        dirs[:] = [name for name in dirs
+                   if path.abspath(path.join(root, name)) != path.abspath(out_dir)]
+        names += [path.relpath(path.join(root, name), static_dir) for name in files]
+
+    return sorted(names, key=lambda name: (name.endswith('.css'), name))
+
+
+def build_assets(static_dir, out_dir, out=print):
+    """Build every static file into `out_dir`, and its manifest.
+
+    Returns the manifest: {name: {'path': hashed name, 'encodings': [...]}}.
+    """
+
+    encodings = [(encoding, suffix) for encoding, suffix in ENCODINGS
+                 if encoding != 'br' or brotli]
+    if not brotli:
+        out("brotli isn't installed; writing gzip variants only")
+
+    manifest = {}
+    for name in source_files(static_dir, out_dir):
+        with open(path.join(static_dir, name), 'rb') as source:
+            contents = source.read()
+
+        if name.endswith('.css'):
+            contents = CSS_URL.sub(
+                lambda match: (f"url({match.group(1)}/assets/"
+                               f"{manifest[match.group(2)]['path']}{match.group(1)})"
+                               if match.group(2) in manifest else match.group(0)),
+                contents.decode('UTF-8')).encode('UTF-8')
+
+        built = hashed_name(name, contents).replace(os.sep, '/')
+        built_path = path.join(out_dir, built)
+        os.makedirs(path.dirname(built_path), exist_ok=True)
+        save_built(built_path, contents)
+
+        written = []
+        if path.splitext(name)[1].lower() not in INCOMPRESSIBLE:
+            for encoding, suffix in encodings:
+                variant = compress(encoding, contents)
+                if len(variant) < len(contents) * 0.9:
+                    save_built(built_path + suffix, variant)
+                    written.append(encoding)
+
+        manifest[name.replace(os.sep, '/')] = {'path': built, 'encodings': written}
+        out(f"{name} -> {built} {' '.join(written)}".rstrip())
+
+    write_file(path.join(out_dir, MANIFEST),
+               json.dumps(manifest, indent=2, sort_keys=True).encode('UTF-8'))
+
+    return manifest
+
+
+def save_built(file_path, contents):
+    """Write built file `file_path`, unless an earlier build already has.
+
+    Built files are named by their contents, so one that is already there
+    is only touched, to mark it as used by this build (see `prune_assets`).
+    """
+
+    if path.exists(file_path):
+        os.utime(file_path)
+    else:
+        write_file(file_path, contents)
+
+
+def write_file(file_path, contents):
+    """Write `contents` to `file_path` atomically."""
+
+    partial = f"{file_path}.{os.getpid()}.tmp"
+    with open(partial, 'wb') as target:
+        target.write(contents)
+    os.replace(partial, file_path)
+
+
+def prune_assets(out_dir, max_age, out=print):
+    """Delete built files the current manifest doesn't use and no build has
+    written or touched in the last `max_age` seconds.
+
+    Returns how many files were deleted.
+    """
+
+    try:
+        with open(path.join(out_dir, MANIFEST)) as manifest_file:
+            manifest = json.load(manifest_file)
+    except FileNotFoundError:
+        return 0
+
+    in_use = {MANIFEST}
+    for entry in manifest.values():
+        in_use.add(entry['path'])
+        in_use.update(entry['path'] + suffix for encoding, suffix in ENCODINGS)
+
+    cutoff = time.time() - max_age
+    deleted = 0
+    for root, dirs, files in os.walk(out_dir):
+        for name in files:
+            file_path = path.join(root, name)
+            built = path.relpath(file_path, out_dir).replace(os.sep, '/')
+            if built not in in_use and path.getmtime(file_path) < cutoff:
+                os.remove(file_path)
+                out(f"deleted {built}")
+                deleted += 1
+
+    return deleted
+
+
+class Assets:
+    """The built assets' manifest, loaded once per process."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        try:
+            with open(path.join(directory, MANIFEST)) as manifest_file:
+                self.manifest = json.load(manifest_file)
+        except FileNotFoundError:
+            self.manifest = {}
+
+        self.encodings = {entry['path']: entry['encodings']
+                          for entry in self.manifest.values()}
+
+
+def get_assets():
+    app = current_app._get_current_object()
+    if 'assets' not in app.extensions:
+        app.extensions['assets'] = Assets(app.config['ASSETS_DIR'])
+    return app.extensions['assets']
+
+
+def asset_url(filename):
+    """URL for static file `filename`: its built, hashed copy if there is one."""
+
+    entry = get_assets().manifest.get(filename)
+    if entry is None:
+        return static_url(filename)
+
+    return url_for('assets', filename=entry['path'])
+
+
+def serve_asset(filename):
+    """Response for built asset `filename`, precompressed if the browser allows."""
+
+    assets = get_assets()
+    encodings = assets.encodings.get(filename)
+    if encodings is None:
+        abort(404)
+
+    file_path = safe_join(assets.directory, filename)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    try:
+        for encoding, suffix in ENCODINGS:
+            if encoding in encodings and request.accept_encodings[encoding]:
+                response = send_file(file_path + suffix, mimetype=mimetype)
+                response.headers['Content-Encoding'] = encoding
+                break
+        else:
+            response = send_file(file_path, mimetype=mimetype)
+    except FileNotFoundError:
+        # Pruned (or never built) since this process loaded its manifest.
+        abort(404)
+
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def configure_assets(app):
+    app.jinja_env.globals['asset_url'] = asset_url
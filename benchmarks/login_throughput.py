@@ -0,0 +1,72 @@
+"""Measure password-check throughput against bcrypt pool size.
+
+Simulates a login spike: `--workers` request threads each check passwords
+as fast as they can for `--seconds`, through a PasswordPool of each size
+given.  Reports successful checks per second and how many were turned
+away with PasswordPoolFull (what the app answers with a 503).
+
+Run it from the project root like:
+
+    python -m benchmarks.login_throughput --sizes 0 1 2 4 --workers 16
+"""
+
+import argparse
+import os
+from threading import Thread
+from time import perf_counter, sleep
+
+from passwords import PasswordPool, PasswordPoolFull
+
+
+def run(size, queue_limit, log_rounds, workers, seconds, pw_hash):
+    pool = PasswordPool(size, queue_limit, log_rounds)
+    pool.check(pw_hash, 'password')  # start the worker processes up front
+
+    checked = [0] * workers
+    rejected = [0] * workers
+    deadline = perf_counter() + seconds
+
+    def worker(i):
+        while perf_counter() < deadline:
+            try:
+                pool.check(pw_hash, 'password')
+                checked[i] += 1
+            except PasswordPoolFull:
+                rejected[i] += 1
+                sleep(0.01)  # a turned-away client retrying
+
+    threads = [Thread(target=worker, args=(i,)) for i in range(workers)]
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - start
+
+    pool.shutdown()
+    return sum(checked) / elapsed, sum(rejected)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[0, 1, 2, os.cpu_count() or 4])
+    parser.add_argument('--queue-limit', type=int, default=4)
+    parser.add_argument('--log-rounds', type=int, default=12)
+    parser.add_argument('--workers', type=int, default=16,
+                        help="concurrent request threads")
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    pw_hash = PasswordPool(log_rounds=args.log_rounds).hash('password')
+
+    print(f"{'pool size':>10} {'logins/s':>10} {'rejected (503)':>15}")
+    for size in args.sizes:
+        per_second, rejected = run(size, args.queue_limit, args.log_rounds,
+                                   args.workers, args.seconds, pw_hash)
+        label = 'inline' if size == 0 else str(size)
+        print(f"{label:>10} {per_second:>10.1f} {rejected:>15}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+"""Measure route latency, SQL queries and rows fetched as the data grows.
+
+For each dataset size, generates CSVs with generator/create_csvs.py, bulk
+loads them (plus some random likes) into a scratch database, then drives
+the app through Flask's test client from `--workers` threads, logged in as
+random users.  Reports p50/p95/p99 latency and the mean number of SQL
+queries and rows fetched per request for each route.
+
+The database given is wiped for every size, so don't point this at one
+you care about.  Create it first (``createdb warbler-bench``) and run it
+from the project root like:
+
+    python -m benchmarks.routes --sizes 1000 10000 --output before.json
+
+Results saved with --output can be compared with a later run:
+
+    python -m benchmarks.routes --sizes 1000 10000 --compare before.json
+"""
+
+import argparse
+import csv
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from os import path
+from statistics import mean
+from time import perf_counter
+
+from benchmarks.timeline_fanout import percentile
+from sqlstats import count_queries
+
+GENERATOR = path.join(path.dirname(path.dirname(path.abspath(__file__))),
+                      'generator', 'create_csvs.py')
+
+# App settings recorded alongside the results, since they change them.
+CONFIG_KEYS = ['PAGE_SIZE', 'SEARCH_BACKEND', 'TIMELINE_BACKEND',
+               'CURRENT_USER_CACHE_TTL']
+
+
+def seed(size, args, out):
+    """Fill the database with `size` users' worth of generated data."""
+
+    from app import app
+    from bulkload import load_csvs
+    from counters import reconcile_counters
+    from models import db, Message
+    from search import reindex_messages
+
+    with tempfile.TemporaryDirectory() as directory:
+        subprocess.run([sys.executable, GENERATOR,
+                        '--users', str(size),
+                        '--messages', str(size * args.messages_per_user),
+                        '--follows', str(size * args.follows_per_user),
+                        '--seed', str(args.seed),
+                        '--out', directory],
+                       check=True, stdout=subprocess.DEVNULL)
+
+        db.drop_all()
+        db.create_all()
+        load_csvs(directory, out=out)
+
+        messages = db.session.query(Message.id, Message.user_id).all()
+        db.session.commit()
+
+        rng = random.Random(args.seed)
+        with open(path.join(directory, 'likes.csv'), 'w', newline='') as likes_csv:
+            writer = csv.writer(likes_csv)
+            writer.writerow(['user_id', 'message_id'])
+            for user_id in range(1, size + 1):
+                liked = {message_id for message_id, author_id
+                         in rng.sample(messages, min(args.likes_per_user, len(messages)))
+                         if author_id != user_id}
+                writer.writerows((user_id, message_id) for message_id in sorted(liked))
+
+        for name in ['users.csv', 'messages.csv', 'follows.csv']:
+            os.remove(path.join(directory, name))
+        load_csvs(directory, out=out)
+
+    reconcile_counters()
+
+    # The search backend comes from the app's config.
+    with app.app_context():
+        reindex_messages()
+        db.session.commit()
+
+    return messages
+
+
+def plan_requests(route, num_requests, size, messages, rng):
+    """(viewer id, method, url) for each request to `route`."""
+
+    requests = []
+    for _ in range(num_requests):
+        viewer = rng.randint(1, size)
+        target = rng.randint(1, size)
+
+        if route == 'homepage':
+            requests.append((viewer, 'GET', "/"))
+        elif route == 'users_show':
+            requests.append((viewer, 'GET', f"/users/{target}"))
+        elif route == 'list_users':
+            requests.append((viewer, 'GET', "/users"))
+        elif route == 'show_likes':
+            requests.append((viewer, 'GET', f"/users/{target}/likes"))
+        elif route == 'like_message':
+            message_id, author_id = rng.choice(messages)
+            while author_id == viewer:
+                message_id, author_id = rng.choice(messages)
+            requests.append((viewer, 'POST', f"/messages/{message_id}/like"))
+
+    return requests
+
+
+def run_route(app, requests, workers):
+    """Send `requests` from `workers` threads; returns per-request samples."""
+
+    from app import CURR_USER_KEY
+
+    local = threading.local()
+
+    def send(request):
+        viewer, method, url = request
+
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+        with local.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = viewer
+
+        with count_queries() as log:
+            start = perf_counter()
+            resp = local.client.open(url, method=method,
+                                     headers={'Accept': 'application/json'}
+                                     if method == 'POST' else {})
+            elapsed = (perf_counter() - start) * 1000
+
+        return elapsed, log.queries, log.rows, resp.status_code >= 400
+
+    with ThreadPoolExecutor(workers) as pool:
+        return list(pool.map(send, requests))
+
+
+def summarize(size, route, samples):
+    latencies = [elapsed for elapsed, _, _, _ in samples]
+    return dict(
+        size=size,
+        route=route,
+        requests=len(samples),
+        errors=sum(error for _, _, _, error in samples),
+        p50_ms=percentile(latencies, 50),
+        p95_ms=percentile(latencies, 95),
+        p99_ms=percentile(latencies, 99),
+        queries=mean(queries for _, queries, _, _ in samples),
+        rows=mean(rows for _, _, rows, _ in samples),
+    )
+
+
+def print_results(results, baseline=None):
+    """Print a table of results, with the change from `baseline` if given."""
+
+    before = {(r['size'], r['route']): r for r in (baseline or {}).get('results', [])}
+
+    print(f"{'size':>8} {'route':<14} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'queries':>8} {'rows':>9} {'errors':>7}")
+
+    for result in results:
+        print(f"{result['size']:>8} {result['route']:<14} {result['p50_ms']:>8.1f} "
+              f"{result['p95_ms']:>8.1f} {result['p99_ms']:>8.1f} "
+              f"{result['queries']:>8.1f} {result['rows']:>9.1f} {result['errors']:>7}")
+
+        old = before.get((result['size'], result['route']))
+        if old:
+            print(f"{'':>8} {'  vs baseline':<14} "
+                  f"{change(old['p50_ms'], result['p50_ms']):>8} "
+                  f"{change(old['p95_ms'], result['p95_ms']):>8} "
+                  f"{change(old['p99_ms'], result['p99_ms']):>8} "
+                  f"{change(old['queries'], result['queries']):>8} "
+                  f"{change(old['rows'], result['rows']):>9}")
+
+
+def change(old, new):
+    if not old:
+        return "-" if not new else "new"
+    return f"{(new - old) / old:+.0%}"
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--database', default='postgresql:///warbler-bench',
+                        help="scratch database; wiped for every size")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000],
+                        help="number of users in each dataset")
+    parser.add_argument('--messages-per-user', type=int, default=10)
+    parser.add_argument('--follows-per-user', type=int, default=20)
+    parser.add_argument('--likes-per-user', type=int, default=5)
+    parser.add_argument('--routes', nargs='+',
+                        default=['homepage', 'users_show', 'list_users',
+                                 'show_likes', 'like_message'])
+    parser.add_argument('--requests', type=int, default=200,
+                        help="requests per route per size")
+    parser.add_argument('--warmup', type=int, default=10,
+                        help="requests per route sent before measuring")
+    parser.add_argument('--workers', type=int, default=4,
+                        help="concurrent request threads")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="save the results to this JSON file")
+    parser.add_argument('--compare', help="JSON results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    # The app picks its database when it's imported.
+    os.environ['DATABASE_URL'] = args.database
+    from app import app
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_json:
+            baseline = json.load(baseline_json)
+        print(f"comparing with {baseline['commit']} ({baseline['started']})\n")
+
+    started = datetime.utcnow().isoformat(timespec='seconds')
+    results = []
+
+    for size in args.sizes:
+        print(f"seeding {size} users...", file=sys.stderr)
+        messages = seed(size, args, out=lambda line: None)
+
+        for route in args.routes:
+            rng = random.Random(f"{args.seed}-{size}-{route}")
+            run_route(app, plan_requests(route, args.warmup, size, messages, rng),
+                      args.workers)
+            samples = run_route(app,
+                                plan_requests(route, args.requests, size, messages, rng),
+                                args.workers)
+            results.append(summarize(size, route, samples))
+
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(dict(commit=git_commit(),
+                           started=started,
+                           options=vars(args),
+                           config={key: app.config[key] for key in CONFIG_KEYS},
+                           results=results),
+                      output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""Compare pure fan-out timelines with hybrid push/pull timelines.
+
+Loads a skewed (power-law) follow graph into a scratch database, posts
+messages through `fan_out_message` and reads homepages through
+`read_timeline` (the code the views run) for each fan-out threshold.
+Reports write amplification (timeline entries written per message),
+total and slowest write time, and homepage read latency and queries.
+
+The database given is wiped, so don't point this at one you care about.
+Create it first (``createdb warbler-bench``) and run it from the project
+root like:
+
+    python -m benchmarks.timeline_fanout --users 5000 --thresholds none 1000 100
+"""
+
+import argparse
+import os
+import random
+from collections import defaultdict
+from datetime import datetime, timedelta
+from statistics import mean, median
+from time import perf_counter
+
+from sqlstats import count_queries
+
+
+def build_follow_graph(num_users, follows_per_user, skew, rng):
+    """Return {user_id: {followed ids}} with popularity following a power law."""
+
+    weights = [1 / (rank ** skew) for rank in range(1, num_users + 1)]
+    following = defaultdict(set)
+
+    for user_id in range(1, num_users + 1):
+        for followed_id in rng.choices(range(1, num_users + 1), weights, k=follows_per_user):
+            if followed_id != user_id:
+                following[user_id].add(followed_id)
+
+    return following
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+def seed(args, rng):
+    """Load the users, follow graph and messages; returns the most followers anyone has."""
+
+    from counters import reconcile_counters
+    from models import db, User, Message, Follows
+
+    db.drop_all()
+    db.create_all()
+
+    db.session.execute(User.__table__.insert(),
+                       [dict(id=id, username=f"user{id}", email=f"user{id}@test.com",
+                             password="HASHED_PASSWORD")
+                        for id in range(1, args.users + 1)])
+
+    following = build_follow_graph(args.users, args.follows_per_user, args.skew, rng)
+    db.session.execute(Follows.__table__.insert(),
+                       [dict(user_following_id=user_id, user_being_followed_id=followed_id)
+                        for user_id, followed_ids in following.items()
+                        for followed_id in followed_ids])
+
+    start = datetime.utcnow() - timedelta(days=1)
+    db.session.execute(Message.__table__.insert(),
+                       [dict(id=id, text=f"warble {id}", user_id=rng.randint(1, args.users),
+                             timestamp=start + timedelta(seconds=id))
+                        for id in range(1, args.messages + 1)])
+
+    reconcile_counters()
+    db.session.commit()
+
+    return db.session.query(db.func.max(User.follower_count)).scalar()
+
+
+def run(threshold, args, rng):
+    """Post every message and read some homepages with one fan-out threshold."""
+
+    from models import db, User, Message, TimelineBuild, TimelineEntry
+    from timelines import BACKENDS, fan_out_message, read_timeline
+
+    follower_counts = dict(db.session.query(User.id, User.follower_count))
+
+    class CountingStore(BACKENDS[args.backend]):
+        written = 0
+
+        def push(self, item, user_ids):
+            self.written += len(user_ids)
+            super().push(item, user_ids)
+
+        def fan_out(self, item):
+            self.written += 1 + follower_counts[item.author_id]
+            super().fan_out(item)
+
+    TimelineEntry.query.delete()
+    TimelineBuild.query.delete()
+    db.session.commit()
+    store = CountingStore(args.max_length, threshold)
+
+    # Built from the start, so reads don't rebuild them.
+    for user_id in range(1, args.users + 1):
+        store.mark_built(user_id)
+    db.session.commit()
+
+    posts = Message.query.order_by(Message.id).all()
+    writes = []
+    for msg in posts:
+        start = perf_counter()
+        fan_out_message(store, msg)
+        db.session.commit()
+        writes.append((perf_counter() - start) * 1000)
+
+    readers = [User.query.get(user_id)
+               for user_id in rng.sample(range(1, args.users + 1), min(args.readers, args.users))]
+    latencies = []
+    queries = []
+    for reader in readers:
+        start = perf_counter()
+        with count_queries() as log:
+            read_timeline(store, reader, 100)
+        latencies.append((perf_counter() - start) * 1000)
+        queries.append(log.queries)
+        db.session.commit()
+
+    return dict(
+        threshold=threshold,
+        entries_per_message=store.written / len(posts),
+        write_seconds=sum(writes) / 1000,
+        write_max_ms=max(writes),
+        read_p50_ms=median(latencies),
+        read_p95_ms=percentile(latencies, 95),
+        read_p99_ms=percentile(latencies, 99),
+        read_queries=mean(queries),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--database', default='postgresql:///warbler-bench',
+                        help="scratch database; wiped first")
+    parser.add_argument('--backend', choices=['sql', 'memory'], default='sql')
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--follows-per-user', type=int, default=50)
+    parser.add_argument('--skew', type=float, default=1.1,
+                        help="power-law exponent for picking who gets followed")
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--readers', type=int, default=200)
+    parser.add_argument('--max-length', type=int, default=800)
+    parser.add_argument('--thresholds', nargs='+', default=['none', '1000', '100'])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # The app picks its database when it's imported.
+    os.environ['DATABASE_URL'] = args.database
+    from app import app
+
+    with app.app_context():
+        most_followed = seed(args, random.Random(args.seed))
+
+        print(f"{args.users} users, {args.messages} messages, "
+              f"most-followed author has {most_followed} followers\n")
+        print(f"{'threshold':>10} {'entries/msg':>12} {'write s':>8} {'max ms':>8} "
+              f"{'read p50 ms':>12} {'p95 ms':>8} {'p99 ms':>8} {'queries':>8}")
+
+        for threshold in args.thresholds:
+            threshold = None if threshold == 'none' else int(threshold)
+            result = run(threshold, args, random.Random(args.seed))
+            print(f"{str(result['threshold']):>10} {result['entries_per_message']:>12.1f} "
+                  f"{result['write_seconds']:>8.2f} {result['write_max_ms']:>8.2f} "
+                  f"{result['read_p50_ms']:>12.2f} "
+                  f"{result['read_p95_ms']:>8.2f} {result['read_p99_ms']:>8.2f} "
+                  f"{result['read_queries']:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
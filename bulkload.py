@@ -0,0 +1,166 @@
+"""Streaming bulk loader for Warbler's CSV datasets (see seed.py).
+
+On Postgres each CSV is streamed into its table with ``COPY ... FROM
+STDIN``, `chunk_rows` rows at a time, so memory use stays flat however big
+the files are.  Around the load:
+
+- the tables' secondary indexes are dropped, then rebuilt in one pass
+  each once the rows are in, which is far cheaper than maintaining them
+  row by row
+- serial sequences are moved past the highest loaded id, so rows added
+  later don't collide with loaded ones
+- the tables are analyzed, so the planner knows how big they now are
+
+Everything happens in one transaction: a failed load leaves the database
+as it was.  Other databases (i.e. SQLite) get chunked ``executemany``
+INSERTs instead.
+
+Message ids aren't in the CSVs; each message gets a snowflake id minted
+from its timestamp, as the app would have given it.
+"""
+
+import csv
+import io
+from datetime import datetime
+from os import path
+from time import perf_counter
+
+from sqlalchemy import text
+
+from models import db
+from snowflakes import message_ids
+
+# Loaded in this order, so foreign keys always point at loaded rows.
+TABLE_FILES = [
+    ('users', 'users.csv'),
+    ('messages', 'messages.csv'),
+    ('follows', 'follows.csv'),
+    ('likes', 'likes.csv'),
+]
+
+
+def prepare_message(row):
+    """Give a message row its snowflake id."""
+
+    row['timestamp'] = datetime.fromisoformat(row['timestamp'])
+    row['id'] = message_ids.id_at(row['timestamp'])
+    return row
+
+
+ROW_PREPARERS = {
+    'messages': prepare_message,
+}
+
+
+def read_chunks(csv_path, chunk_rows, prepare=None):
+    """Yield the rows of `csv_path` as lists of up to `chunk_rows` dicts."""
+
+    with open(csv_path, newline='') as csv_file:
+        chunk = []
+        for row in csv.DictReader(csv_file):
+            chunk.append(prepare(row) if prepare else row)
+            if len(chunk) == chunk_rows:
+                yield chunk
+                chunk = []
+
+        if chunk:
+            yield chunk
+
+
+def copy_chunk(conn, table, rows):
+    """Stream `rows` into `table` with COPY."""
+
+    columns = list(rows[0])
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([row[column] for column in columns])
+    buffer.seek(0)
+
+    cursor = conn.connection.cursor()
+    cursor.copy_expert(f"COPY {table.name} ({', '.join(columns)}) "
+                       "FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def insert_chunk(conn, table, rows):
+    """Insert `rows` into `table` with one executemany."""
+
+    conn.execute(table.insert(), rows)
+
+
+def drop_indexes(conn, tables):
+    """Drop the secondary indexes on `tables`; returns how to rebuild them."""
+
+    rows = conn.execute(text(
+        """SELECT indexname, indexdef FROM pg_indexes
+           WHERE schemaname = current_schema()
+             AND tablename = ANY(:tables)
+             AND indexname NOT IN (SELECT conname FROM pg_constraint)"""),
+        tables=[table.name for table in tables]).fetchall()
+
+    for name, _ in rows:
+        conn.execute(f"DROP INDEX {name}")
+
+    return rows
+
+
+def fix_sequences(conn, tables):
+    """Move each table's id sequence (if any) past the highest id in it."""
+
+    for table in tables:
+        if 'id' not in table.c:
+            continue
+
+        sequence = conn.execute(text("SELECT pg_get_serial_sequence(:table, 'id')"),
+                                table=table.name).scalar()
+        if sequence:
+            conn.execute(text(f"SELECT setval(:sequence, coalesce(max(id), 1), "
+                              f"max(id) IS NOT NULL) FROM {table.name}"),
+                         sequence=sequence)
+
+
+def load_csvs(directory, chunk_rows=50000, engine=None, out=print):
+    """Load every CSV in `directory` into its (empty) table.
+
+    Reports progress and rows/sec through `out`.  Returns the number of
+    rows loaded into each table.
+    """
+
+    engine = engine or db.engine
+    postgres = engine.dialect.name == 'postgresql'
+    load_chunk = copy_chunk if postgres else insert_chunk
+
+    tables = [db.metadata.tables[name] for name, filename in TABLE_FILES
+              if path.exists(path.join(directory, filename))]
+    loaded = {}
+
+    with engine.begin() as conn:
+        if postgres:
+            indexes = drop_indexes(conn, tables)
+
+        for table in tables:
+            filename = dict(TABLE_FILES)[table.name]
+            start = perf_counter()
+            loaded[table.name] = 0
+
+            for chunk in read_chunks(path.join(directory, filename), chunk_rows,
+                                     ROW_PREPARERS.get(table.name)):
+                load_chunk(conn, table, chunk)
+                loaded[table.name] += len(chunk)
+
+                elapsed = perf_counter() - start
+                out(f"{table.name}: {loaded[table.name]:,} rows "
+                    f"({loaded[table.name] / elapsed:,.0f} rows/s)")
+
+        if postgres:
+            for name, definition in indexes:
+                start = perf_counter()
+                conn.execute(definition)
+                out(f"rebuilt {name} in {perf_counter() - start:.1f}s")
+
+            fix_sequences(conn, tables)
+            for table in tables:
+                conn.execute(f"ANALYZE {table.name}")
+
+    return loaded
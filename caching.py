@@ -0,0 +1,161 @@
+"""HTTP caching: Cache-Control per route, and conditional GETs.
+
+Pages that opt in (profile pages, message pages, the anonymous home page)
+call `conditional` with a version stamp before rendering: a tuple of the
+values the page is made from, e.g. the user's counters and the ids and
+like counts of the messages on the page, plus who is looking.  The stamp
+is hashed into a weak ETag.  If the browser already has that version (its
+``If-None-Match`` matches), the view answers 304 without rendering the
+template; otherwise the page goes out with the ETag and
+``Cache-Control: no-cache``, so the browser keeps it but checks back
+every time.  Pages shown to a logged-in user are also ``private`` and
+vary by cookie, so shared caches never hand them to anyone else.
+
+Every ETag also covers what pages are built from besides the data (see
+`page_version`): the templates, the static files whose fingerprinted URLs
+pages link to, and the built assets' manifest.  So a deploy that changes
+a page's markup, or only a stylesheet, changes its ETags, and browsers
+never keep a page that links to an old, cached-forever stylesheet.
+
+Static files with a ``v`` query parameter (see `static_url`) are
+fingerprinted by their content, so they are cached for a year and marked
+immutable, as are built assets (see assets.py), whose names carry their
+hash.  Other static files are revalidated.  Any other response is
+``no-store``.
+"""
+
+import hashlib
+import os
+from os import path
+
+from flask import g, request, session, current_app, url_for
+
+ONE_YEAR = 365 * 24 * 60 * 60
+
+TEMPLATES = path.join(path.dirname(path.abspath(__file__)), 'templates')
+
+
+def file_versions(directory):
+    """A hash of every file under `directory`, names and contents."""
+
+    digest = hashlib.sha1()
+    for root, dirs, files in sorted(os.walk(directory)):
+        for name in sorted(files):
+            file_path = path.join(root, name)
+            digest.update(path.relpath(file_path, directory).encode())
+            with open(file_path, 'rb') as contents:
+                digest.update(contents.read())
+    return digest.hexdigest()
+
+
+TEMPLATE_VERSION = file_versions(TEMPLATES)
+
+
+def page_version(app):
+    """A hash of the templates, the static files and the built assets' manifest."""
+
+    digest = hashlib.sha1(TEMPLATE_VERSION.encode())
+    digest.update(file_versions(app.static_folder).encode())
+
+    manifest = path.join(app.config['ASSETS_DIR'], 'manifest.json')
+    if path.exists(manifest):
+        with open(manifest, 'rb') as contents:
+            digest.update(contents.read())
+
+    return digest.hexdigest()
+
+
+def etag_for(stamp):
+    version = current_app.extensions['page_version']
+    return hashlib.sha1(repr((version, stamp)).encode()).hexdigest()[:24]
+
+
+def viewer_stamp(user):
+    """What a page shows of the logged-in `user` (the nav bar)."""
+
+    return user and (user.id, user.username, user.image_url)
+
+
+def user_stamp(user):
+    """What a page shows of `user`'s profile."""
+
+    return (user.id, user.username, user.image_url, user.header_image_url,
+            user.bio, user.location, user.message_count, user.following_count,
+            user.follower_count, user.like_count)
+
+
+def conditional(*stamp, private=True):
+    """Version this page by `stamp`.
+
+    Returns a 304 response if the browser already has this version,
+    otherwise None (and the page gets the ETag when it goes out).
+    """
+
+    # Flashed messages show on (and are used up by) the next page rendered.
+    if session.get('_flashes'):
+        return None
+
+    g.etag = etag_for(stamp)
+    g.cache_control = 'private, no-cache' if private else 'public, no-cache'
+
+    if request.if_none_match.contains_weak(g.etag):
+        return current_app.response_class(status=304)
+
+    return None
+
+
+def static_url(filename):
+    """URL for static file `filename`, fingerprinted so it can be cached forever."""
+
+    return url_for('static', filename=filename, v=static_version(filename))
+
+
+_static_versions = {}
+
+
+def static_version(filename):
+    """A short hash of static file `filename`'s contents."""
+
+    file_path = path.join(current_app.static_folder, filename)
+    mtime = os.stat(file_path).st_mtime_ns
+
+    cached = _static_versions.get(filename)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with open(file_path, 'rb') as static_file:
+        version = hashlib.md5(static_file.read()).hexdigest()[:12]
+    _static_versions[filename] = (mtime, version)
+    return version
+
+
+def configure_caching(app):
+    """Give every response its Cache-Control (and ETag, if it has one)."""
+
+    app.extensions['page_version'] = page_version(app)
+    app.jinja_env.globals['static_url'] = static_url
+
+    @app.after_request
+    def add_cache_headers(response):
+        # Only a file that was found can be cached for good; a 404 for a
+        # fingerprinted URL may be a deploy that hasn't finished yet.
+        versioned = (request.endpoint == 'assets'
+                     or (request.endpoint == 'static' and request.args.get('v')))
+        if versioned and response.status_code == 200:
+            response.headers['Cache-Control'] = f'public, max-age={ONE_YEAR}, immutable'
+            return response
+
+        if request.endpoint == 'static' and response.status_code in (200, 304):
+            response.headers['Cache-Control'] = 'public, no-cache'
+            return response
+
+        etag = g.get('etag')
+        if etag and response.status_code in (200, 304):
+            response.set_etag(etag, weak=True)
+            response.headers['Cache-Control'] = g.cache_control
+            if g.cache_control.startswith('private'):
+                response.vary.add('Cookie')
+        else:
+            response.headers['Cache-Control'] = 'no-store'
+
+        return response
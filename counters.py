@@ -0,0 +1,92 @@
+"""Denormalized per-user counters.
+
+``User.message_count``, ``follower_count``, ``following_count`` and
+``like_count``, and ``Message.like_count``, are adjusted in the same
+transaction as the change they count, with ``UPDATE ... SET n = n + 1``
+so concurrent requests can't lose an update.  ``reconcile_counters``
+rebuilds all of them from the base tables; run it after bulk loads with
+``flask reconcile-counters``.
+"""
+
+from sqlalchemy import func, select
+
+from models import db, Follows, Likes, Message, User
+
+
+def adjust(ids, column, delta):
+    """Add `delta` to `column` (e.g. ``User.message_count``) for `ids`.
+
+    `ids` may be a list or a subquery of ids of the column's table.
+    """
+
+    model = Message if column.class_ is Message else User
+    (model
+     .query
+     .filter(model.id.in_(ids))
+     .update({column: column + delta}, synchronize_session=False))
+
+
+def message_added(author_id):
+    """`author_id` has just written a message."""
+
+    adjust([author_id], User.message_count, 1)
+
+
+def message_removed(msg):
+    """`msg` is about to be deleted, taking its likes with it."""
+
+    adjust([msg.user_id], User.message_count, -1)
+    adjust(db.session.query(Likes.user_id).filter(Likes.message_id == msg.id),
+           User.like_count, -1)
+
+
+def follow_added(follower_id, followed_id):
+    """`follower_id` has just followed `followed_id`."""
+
+    adjust([follower_id], User.following_count, 1)
+    adjust([followed_id], User.follower_count, 1)
+
+
+def follow_removed(follower_id, followed_id):
+    """`follower_id` has just stopped following `followed_id`."""
+
+    adjust([follower_id], User.following_count, -1)
+    adjust([followed_id], User.follower_count, -1)
+
+
+def like_added(user_id, message_id):
+    """`user_id` has just liked `message_id`."""
+
+    adjust([user_id], User.like_count, 1)
+    adjust([message_id], Message.like_count, 1)
+
+
+def like_removed(user_id, message_id):
+    """`user_id` has just stopped liking `message_id`."""
+
+    adjust([user_id], User.like_count, -1)
+    adjust([message_id], Message.like_count, -1)
+
+
+def reconcile_counters():
+    """Recompute every counter from the base tables, one UPDATE per table."""
+
+    def count(key, model=User):
+        return (select([func.count()])
+                .where(key == model.id)
+                .correlate(model.__table__)
+                .as_scalar())
+
+    (User
+     .query
+     .update({
+         User.message_count: count(Message.user_id),
+         User.follower_count: count(Follows.user_being_followed_id),
+         User.following_count: count(Follows.user_following_id),
+         User.like_count: count(Likes.user_id),
+     }, synchronize_session=False))
+
+    (Message
+     .query
+     .update({Message.like_count: count(Likes.message_id, Message)},
+             synchronize_session=False))
@@ -3,14 +3,37 @@
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
 tweak the CSV formats or generate fewer/more rows.
+
+Run it like:
+
+    python generator/create_csvs.py [--users 300] [--messages 1000]
+        [--follows 5000] [--skew 1.0] [--seed 0] [--workers N] [--out generator]
+
+Nothing is fetched over the network, and the same options always produce
+the same files, however many workers there are.
+
+Rows are generated in fixed-size shards, each with its own random generator
+seeded from --seed, the table and the shard's number.  A pool of worker
+processes writes each shard to its own part file, and the parts are then
+joined in order, so memory use stays flat however many rows are asked for.
+
+Every user follows about the same number of other users, but who they
+follow is skewed by a power law over user ids (see --skew): a handful of
+early users end up with most of the followers, as celebrities do.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+import shutil
+from datetime import datetime
+from multiprocessing import Pool
+from os import path
+from random import Random
+from time import perf_counter
+
 from faker import Faker
-from helpers import get_random_datetime
+from helpers import get_random_datetime, power_law_user, HEADER_IMAGE_URLS
 
 MAX_WARBLER_LENGTH = 140
 
@@ -20,11 +43,14 @@ FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+NUM_FOLLOWS = 5000
 
-fake = Faker()
+# Messages are dated in the two years up to here.
+UNTIL = datetime(2019, 1, 1)
 
-# Generate random profile image URLs to use for users
+SHARD_ROWS = 50000
+
+# Random profile image URLs to use for users
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
@@ -32,46 +58,155 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
+def user_rows(rng, fake, first, last, options):
+    """Users `first` to `last`.
+
+    Usernames (and so emails) end in the user's id, zero-padded to the same
+    width, which keeps them unique.
+    """
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
+    width = len(str(options.users))
 
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
+    for user_id in range(first, last + 1):
+        username = f"{fake.user_name()}{user_id:0{width}}"
+        yield dict(
+            email=f"{username}@{fake.free_email_domain()}",
+            username=username,
+            image_url=rng.choice(image_urls),
             password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
             bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
+            header_image_url=rng.choice(HEADER_IMAGE_URLS),
             location=fake.city()
-        ))
+        )
 
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
 
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
+def message_rows(rng, fake, first, last, options):
+    """Messages `first` to `last`, each by a random user."""
+
+    for _ in range(first, last + 1):
+        yield dict(
             text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
+            timestamp=get_random_datetime(rng, UNTIL),
+            user_id=rng.randint(1, options.users)
+        )
+
+
+def following_count(user_id, options):
+    """How many users `user_id` follows: the follows, shared out evenly."""
+
+    per_user, extra = divmod(options.follows, options.users)
+    return per_user + (user_id <= extra)
+
+
+def follow_rows(rng, fake, first, last, options):
+    """The follows by users `first` to `last`."""
+
+    for follower in range(first, last + 1):
+        count = following_count(follower, options)
+        followed = set()
+        draws = 0
+
+        while len(followed) < count:
+            # Once the power law has run out of fresh users to offer (only
+            # likely when a user follows most of the site), draw uniformly.
+            draws += 1
+            skew = options.skew if draws <= 10 * count else 0
+            user_id = power_law_user(rng, options.users, skew)
+
+            if user_id != follower and user_id not in followed:
+                followed.add(user_id)
+                yield dict(user_being_followed_id=user_id, user_following_id=follower)
+
+
+# table: (headers, row generator, number of items sharded)
+TABLES = {
+    'users': (USERS_CSV_HEADERS, user_rows, lambda options: options.users),
+    'messages': (MESSAGES_CSV_HEADERS, message_rows, lambda options: options.messages),
+    'follows': (FOLLOWS_CSV_HEADERS, follow_rows, lambda options: options.users),
+}
+
+
+def shards(table, options):
+    """Split `table`'s items into (first, last) ranges of about SHARD_ROWS rows."""
+
+    count = TABLES[table][2](options)
+    size = SHARD_ROWS
+
+    # Follows are sharded by follower; keep each shard about SHARD_ROWS rows.
+    if table == 'follows':
+        size = max(1, SHARD_ROWS // max(1, following_count(1, options)))
+
+    return [(first, min(first + size - 1, count))
+            for first in range(1, count + 1, size)]
+
+
+def write_shard(task):
+    """Write one shard of a table to its own part file; returns its path."""
+
+    table, number, first, last, options = task
+    headers, rows, count = TABLES[table]
+
+    seed = f"{options.seed}-{table}-{number}"
+    rng = Random(seed)
+    fake = Faker()
+    fake.seed_instance(seed)
+
+    part_path = path.join(options.out, f"{table}.csv.{number:05}")
+    with open(part_path, 'w', newline='') as part:
+        writer = csv.DictWriter(part, fieldnames=headers)
+        writer.writerows(rows(rng, fake, first, last, options))
+
+    return part_path
+
+
+def join_parts(table, part_paths, options):
+    """Join `table`'s part files, in order, into its CSV."""
+
+    headers = TABLES[table][0]
+
+    with open(path.join(options.out, f"{table}.csv"), 'w', newline='') as table_csv:
+        csv.DictWriter(table_csv, fieldnames=headers).writeheader()
+
+        for part_path in part_paths:
+            with open(part_path, newline='') as part:
+                shutil.copyfileobj(part, table_csv)
+            os.remove(part_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLOWS)
+    parser.add_argument('--skew', type=float, default=1.0,
+                        help="power law exponent for who gets followed; 0 is uniform")
+    parser.add_argument('--seed', default='0')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--out', default=path.dirname(path.abspath(__file__)),
+                        help="directory to write the CSVs to")
+    options = parser.parse_args()
+
+    if options.follows > options.users * (options.users - 1):
+        parser.error(f"{options.users} users can only make "
+                     f"{options.users * (options.users - 1)} follows")
+
+    tasks = [(table, number, first, last, options)
+             for table in TABLES
+             for number, (first, last) in enumerate(shards(table, options))]
+
+    start = perf_counter()
+    with Pool(options.workers) as pool:
+        part_paths = pool.map(write_shard, tasks, chunksize=1)
 
-# Generate follows.csv from random pairings of users
+    for table in TABLES:
+        join_parts(table, [part_path for (name, *_), part_path in zip(tasks, part_paths)
+                           if name == table], options)
 
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
+    print(f"wrote {options.users:,} users, {options.messages:,} messages and "
+          f"{options.follows:,} follows to {options.out} "
+          f"in {perf_counter() - start:.1f}s")
 
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
 
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+if __name__ == '__main__':
+    main()
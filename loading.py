@@ -0,0 +1,65 @@
+"""Read-path loading helpers for Warbler views.
+
+Templates that render a list of messages touch ``msg.user`` for every row.
+``Message.user`` is a lazy relationship, so without help each of those is
+its own SELECT.  These helpers make listing queries load everything the
+templates need up front, in a fixed number of batched queries.
+"""
+
+from sqlalchemy import and_, exists, literal
+from sqlalchemy.orm import selectinload
+
+from models import db, Follows, Likes, Message
+
+
+def with_authors(query):
+    """Have a Message query load every message's author in one extra SELECT."""
+
+    return query.options(selectinload(Message.user))
+
+
+def liked_ids(user, messages):
+    """Ids of the `messages` that `user` has liked, as a set.
+
+    Only the messages on the page are checked, so this costs the same
+    however many likes `user` has in total.
+    """
+
+    if not user or not messages:
+        return set()
+
+    rows = (db.session
+            .query(Likes.message_id)
+            .filter(Likes.user_id == user.id,
+                    Likes.message_id.in_([msg.id for msg in messages]))
+            .all())
+    return {message_id for (message_id,) in rows}
+
+
+def message_versions(query, user, *columns):
+    """(id, like count, liked by `user`, *`columns`) for each message `query`
+    finds, reading only those columns.
+
+    Enough to version a page of messages (see caching.py) without loading
+    the messages themselves.
+    """
+
+    if user:
+        liked = exists().where(and_(Likes.user_id == user.id, Likes.message_id == Message.id))
+    else:
+        liked = literal(False)
+
+    rows = query.with_entities(Message.id, Message.like_count, liked.label('liked'),
+                               *columns).all()
+    return [tuple(row) for row in rows]
+
+
+def follows_author(user):
+    """Column for a Message query: does `user` follow the message's author?"""
+
+    if not user:
+        return literal(False).label('following')
+
+    return exists().where(and_(Follows.user_following_id == user.id,
+                               Follows.user_being_followed_id == Message.user_id)
+                          ).label('following')
@@ -0,0 +1,323 @@
+"""Prometheus metrics, served at ``/metrics``.
+
+Recorded for every request, by route (endpoint):
+
+- request latency, response size, template render time and database time
+  (from sqlstats.py), as histograms
+- requests, by route and status code
+
+and for the database connection pool: how long checkouts wait for a
+connection, and how many connections are checked out versus the pool's
+capacity (per process, labelled by pid).
+
+Recording is a few dict updates under a lock.  With ``METRICS_DIR`` set
+(the multiprocess mode, for running several worker processes), each
+process also writes a snapshot of its metrics to its own file there every
+``METRICS_FLUSH_SECONDS``, from a background thread, and ``/metrics``
+sums every process's file.  Either way user requests never wait on file
+I/O or on a scrape.  Counts from processes that have exited are kept;
+their pool gauges are dropped.
+"""
+
+import json
+import os
+from bisect import bisect_left
+from glob import glob
+from os import path
+from threading import Lock, Thread
+from time import perf_counter, sleep
+
+from flask import g, request, before_render_template, template_rendered
+from sqlalchemy.pool import QueuePool
+
+from models import db
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+SIZE_BUCKETS = [100, 1000, 10000, 100000, 1000000]
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'warbler_requests_total':
+        ('counter', "Requests answered.", None),
+    'warbler_request_duration_seconds':
+        ('histogram', "Time to build each response.", LATENCY_BUCKETS),
+    'warbler_response_size_bytes':
+        ('histogram', "Size of each response body.", SIZE_BUCKETS),
+    'warbler_template_render_seconds':
+        ('histogram', "Time spent rendering templates, per request.", LATENCY_BUCKETS),
+    'warbler_db_seconds':
+        ('histogram', "Time spent in the database, per request.", LATENCY_BUCKETS),
+    'warbler_db_pool_checkout_seconds':
+        ('histogram', "Time waited for a database connection.", LATENCY_BUCKETS),
+    'warbler_db_pool_checked_out':
+        ('gauge', "Database connections checked out of the pool.", None),
+    'warbler_db_pool_capacity':
+        ('gauge', "Database connections the pool can hand out at once.", None),
+}
+
+
+class Metrics:
+    """Map of (metric name, label pairs) -> value.
+
+    A counter's or gauge's value is a number; a histogram's is
+    [count per bucket (not cumulative), +Inf count, sum].
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.lock = Lock()
+        self.pid = os.getpid()
+
+    def inc(self, name, labels, amount=1):
+        key = (name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, name, labels, value):
+        with self.lock:
+            self.values[(name, labels)] = value
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][2]
+        key = (name, labels)
+
+        with self.lock:
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = [0] * (len(buckets) + 1) + [0.0]
+            histogram[bisect_left(buckets, value)] += 1
+            histogram[-1] += value
+
+    def snapshot(self):
+        with self.lock:
+            return [[name, labels, value if isinstance(value, (int, float)) else list(value)]
+                    for (name, labels), value in self.values.items()]
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+
+metrics = Metrics()
+
+
+class TimedQueuePool(QueuePool):
+    """A QueuePool that records how long each checkout takes."""
+
+    def connect(self):
+        start = perf_counter()
+        try:
+            return super().connect()
+        finally:
+            metrics.observe('warbler_db_pool_checkout_seconds', (),
+                            perf_counter() - start)
+
+
+def record_pool(pool):
+    """Set the pool gauges for this process."""
+
+    if not isinstance(pool, QueuePool):
+        return
+
+    labels = (('pid', str(os.getpid())),)
+    metrics.set('warbler_db_pool_checked_out', labels, pool.checkedout())
+    metrics.set('warbler_db_pool_capacity', labels, pool.size() + max(pool._max_overflow, 0))
+
+
+##############################################################################
+# Multiprocess mode
+
+
+def snapshot_path(directory, pid):
+    return path.join(directory, f"metrics-{pid}.json")
+
+
+def write_snapshot(directory):
+    """Write this process's metrics to its file (atomically)."""
+
+    final = snapshot_path(directory, os.getpid())
+    partial = final + ".tmp"
+    with open(partial, 'w') as snapshot:
+        json.dump(metrics.snapshot(), snapshot)
+    os.replace(partial, final)
+
+
+def start_flusher(directory, interval, before_flush):
+    def flush_forever():
+        while True:
+            sleep(interval)
+            before_flush()
+            write_snapshot(directory)
+
+    Thread(target=flush_forever, name='metrics-flusher', daemon=True).start()
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collect(directory=None):
+    """Every process's metrics, summed: {(name, labels): value}."""
+
+    snapshots = {os.getpid(): metrics.snapshot()}
+
+    for snapshot_file in glob(snapshot_path(directory, '*')) if directory else []:
+        pid = int(path.basename(snapshot_file)[len('metrics-'):-len('.json')])
+        if pid not in snapshots:
+            try:
+                with open(snapshot_file) as snapshot:
+                    snapshots[pid] = json.load(snapshot)
+            except (OSError, ValueError):
+                continue
+
+    totals = {}
+    for pid, snapshot in snapshots.items():
+        alive = pid == os.getpid() or process_alive(pid)
+
+        for name, labels, value in snapshot:
+            if METRICS[name][0] == 'gauge' and not alive:
+                continue
+
+            key = (name, tuple(tuple(pair) for pair in labels))
+            if isinstance(value, list):
+                total = totals.setdefault(key, [0] * len(value))
+                totals[key] = [a + b for a, b in zip(total, value)]
+            else:
+                totals[key] = totals.get(key, 0) + value
+
+    return totals
+
+
+##############################################################################
+# Prometheus text format
+
+
+def format_labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ""
+
+    def escape(value):
+        return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(totals):
+    lines = []
+
+    for name, (kind, help_text, buckets) in METRICS.items():
+        series = sorted((labels, value) for (metric, labels), value in totals.items()
+                        if metric == name)
+        if not series:
+            continue
+
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+        for labels, value in series:
+            if kind != 'histogram':
+                lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+                continue
+
+            cumulative = 0
+            for bound, count in zip(buckets + ['+Inf'], value[:-1]):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels(labels, le=bound)} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {format_value(value[-1])}")
+            lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+
+    return "\n".join(lines) + "\n"
+
+
+##############################################################################
+# Flask hooks
+
+
+def configure_metrics(app):
+    """Record every request's metrics, and time pool checkouts.
+
+    Call before the app first uses the database, so the engine is created
+    with the timed pool (``SQLALCHEMY_ENGINE_OPTIONS`` needs Flask-SQLAlchemy
+    2.4 or later).
+    """
+
+    def record_app_pool():
+        record_pool(db.get_engine(app).pool)
+
+    app.extensions['metrics'] = record_app_pool
+
+    if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+        app.config['SQLALCHEMY_ENGINE_OPTIONS']['poolclass'] = TimedQueuePool
+
+    @app.before_request
+    def start_request_metrics():
+        # In a freshly forked worker, start over (the counts so far are the
+        # parent's) with a flusher of its own.
+        if metrics.pid != os.getpid():
+            metrics.clear()
+            metrics.pid = os.getpid()
+            if app.config['METRICS_DIR']:
+                start_flusher(app.config['METRICS_DIR'], app.config['METRICS_FLUSH_SECONDS'],
+                              record_app_pool)
+
+        g.metrics_start = perf_counter()
+        g.template_seconds = 0.0
+
+    @app.after_request
+    def record_request_metrics(response):
+        if 'metrics_start' not in g:
+            return response
+
+        route = (('route', request.endpoint or 'unmatched'),)
+        metrics.inc('warbler_requests_total', route + (('status', str(response.status_code)),))
+        metrics.observe('warbler_request_duration_seconds', route,
+                        perf_counter() - g.metrics_start)
+
+        size = response.content_length
+        if size is None and not response.is_streamed:
+            size = response.calculate_content_length()
+        if size is not None:
+            metrics.observe('warbler_response_size_bytes', route, size)
+
+        if g.template_seconds:
+            metrics.observe('warbler_template_render_seconds', route, g.template_seconds)
+
+        log = g.get('query_log')
+        if log:
+            metrics.observe('warbler_db_seconds', route, log.seconds)
+
+        return response
+
+    def template_started(sender, template, context, **extra):
+        g.template_start = perf_counter()
+
+    def template_finished(sender, template, context, **extra):
+        if 'template_start' in g and 'template_seconds' in g:
+            g.template_seconds += perf_counter() - g.pop('template_start')
+
+    before_render_template.connect(template_started, app, weak=False)
+    template_rendered.connect(template_finished, app, weak=False)
+
+    if app.config['METRICS_DIR']:
+        os.makedirs(app.config['METRICS_DIR'], exist_ok=True)
+        start_flusher(app.config['METRICS_DIR'], app.config['METRICS_FLUSH_SECONDS'],
+                      record_app_pool)
+
+
+def scrape(app):
+    """Every process's metrics, in Prometheus text format."""
+
+    app.extensions['metrics']()
+    return render(collect(app.config['METRICS_DIR']))
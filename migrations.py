@@ -0,0 +1,307 @@
+"""Versioned schema migrations for Warbler.
+
+Each migration has a version number; the versions applied to a database are
+recorded in ``schema_migrations``.  ``flask migrate`` applies any that are
+pending, in order:
+
+- an empty database gets the current schema straight from the models and
+  is stamped with the latest version
+- a database created before migrations existed (it has a ``users`` table
+  but no ``schema_migrations``) is taken to be at version 1, the original
+  schema, and brought forward from there
+
+Migrations are written as SQL against the schema as it was at the time,
+not against the models, so they keep working as the models change.
+
+Index builds use ``CREATE INDEX CONCURRENTLY`` so they don't block writes
+to a live table.  That can't run inside a transaction, so migrations marked
+`concurrent` run each step on its own.  A failed concurrent build leaves an
+invalid index behind; it is dropped and rebuilt on the next run.
+
+``flask check-indexes`` compares the live database against the index pack
+below, reporting indexes that are missing or invalid, and indexes that have
+never been used since Postgres' statistics were last reset.  With
+``--build`` it (re)builds the missing and invalid ones, concurrently.
+"""
+
+from collections import namedtuple
+from contextlib import contextmanager
+
+from sqlalchemy import func, inspect
+
+from models import db, has_pg_trgm, SchemaMigration
+
+Migration = namedtuple('Migration', 'version description steps concurrent')
+
+# Secondary indexes the app's hot queries rely on: (name, definition, only
+# if this returns true for the connection).
+INDEX_PACK = [
+    ('ix_users_username_prefix',
+     "users (lower(username) text_pattern_ops)", None),
+    ('ix_users_username_trgm',
+     "users USING gin (lower(username) gin_trgm_ops)",
+     lambda conn: has_pg_trgm(None, None, conn)),
+    ('ix_users_deleted_at',
+     "users (deleted_at) WHERE deleted_at IS NOT NULL", None),
+    ('ix_follows_user_following_id',
+     "follows (user_following_id, user_being_followed_id)", None),
+    ('ix_likes_message_id_user_id',
+     "likes (message_id, user_id)", None),
+    ('ix_messages_user_id_id',
+     "messages (user_id, id)", None),
+    ('ix_messages_search_vector',
+     "messages USING gin (search_vector)", None),
+    ('ix_timeline_entries_message_id',
+     "timeline_entries (message_id)", None),
+]
+
+
+def index_is_valid(conn, name):
+    """True if index `name` exists and is usable, False if a failed build
+    left it invalid, None if it doesn't exist.
+    """
+
+    return conn.execute(
+        "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)",
+        (name,)).scalar()
+
+
+def create_index(name, definition, condition=None):
+    """A migration step building index `name` without locking out writes."""
+
+    def step(conn):
+        if condition and not condition(conn):
+            return
+
+        if index_is_valid(conn, name) is False:
+            conn.execute(f"DROP INDEX CONCURRENTLY {name}")
+        conn.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}")
+
+    return step
+
+
+def create_pg_trgm(conn):
+    if has_pg_trgm(None, None, conn):
+        conn.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+
+
+MIGRATIONS = [
+    Migration(1, "original schema", [], False),
+
+    Migration(2, "denormalized counters on users", [
+        """ALTER TABLE users
+           ADD COLUMN IF NOT EXISTS message_count INTEGER NOT NULL DEFAULT 0,
+           ADD COLUMN IF NOT EXISTS follower_count INTEGER NOT NULL DEFAULT 0,
+           ADD COLUMN IF NOT EXISTS following_count INTEGER NOT NULL DEFAULT 0,
+           ADD COLUMN IF NOT EXISTS like_count INTEGER NOT NULL DEFAULT 0""",
+        """UPDATE users SET
+           message_count = (SELECT count(*) FROM messages
+                            WHERE messages.user_id = users.id),
+           follower_count = (SELECT count(*) FROM follows
+                             WHERE follows.user_being_followed_id = users.id),
+           following_count = (SELECT count(*) FROM follows
+                              WHERE follows.user_following_id = users.id),
+           like_count = (SELECT count(*) FROM likes
+                         WHERE likes.user_id = users.id)""",
+    ], False),
+
+    Migration(3, "materialized home timelines", [
+        """CREATE TABLE IF NOT EXISTS timeline_entries (
+           user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+           message_id INTEGER NOT NULL REFERENCES messages (id) ON DELETE CASCADE,
+           author_id INTEGER NOT NULL,
+           timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+           PRIMARY KEY (user_id, message_id))""",
+    ], False),
+
+    Migration(4, "message search vectors and like counts", [
+        """ALTER TABLE messages
+           ADD COLUMN IF NOT EXISTS search_vector TSVECTOR,
+           ADD COLUMN IF NOT EXISTS like_count INTEGER NOT NULL DEFAULT 0""",
+        """UPDATE messages SET search_vector = to_tsvector('english', text)
+           WHERE search_vector IS NULL""",
+        """UPDATE messages SET
+           like_count = (SELECT count(*) FROM likes
+                         WHERE likes.message_id = messages.id)""",
+    ], False),
+
+    Migration(5, "likes keyed on (user_id, message_id)", [
+        "DELETE FROM likes WHERE user_id IS NULL OR message_id IS NULL",
+        "ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_key",
+        "ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_pkey",
+        "ALTER TABLE likes DROP COLUMN IF EXISTS id",
+        "ALTER TABLE likes ADD PRIMARY KEY (user_id, message_id)",
+    ], False),
+
+    Migration(6, "index pack", [
+        create_pg_trgm,
+        create_index('ix_users_username_prefix',
+                     "users (lower(username) text_pattern_ops)"),
+        create_index('ix_users_username_trgm',
+                     "users USING gin (lower(username) gin_trgm_ops)",
+                     lambda conn: has_pg_trgm(None, None, conn)),
+        create_index('ix_follows_user_following_id',
+                     "follows (user_following_id, user_being_followed_id)"),
+        create_index('ix_likes_message_id_user_id', "likes (message_id, user_id)"),
+        create_index('ix_messages_user_id_timestamp', "messages (user_id, timestamp, id)"),
+        create_index('ix_messages_search_vector', "messages USING gin (search_vector)"),
+        create_index('ix_timeline_entries_user_id_timestamp',
+                     "timeline_entries (user_id, timestamp, message_id)"),
+        create_index('ix_timeline_entries_message_id', "timeline_entries (message_id)"),
+    ], True),
+
+    # Existing messages keep their serial ids, which are all smaller than
+    # (and so sort before) any snowflake id.  Changing the column types
+    # rewrites these tables, so run this one in a quiet period.
+    Migration(7, "snowflake message ids and insert-time timestamps", [
+        """ALTER TABLE messages
+           ALTER COLUMN id DROP DEFAULT,
+           ALTER COLUMN id TYPE BIGINT,
+           ALTER COLUMN timestamp SET DEFAULT timezone('utc', now())""",
+        "DROP SEQUENCE IF EXISTS messages_id_seq",
+        "ALTER TABLE likes ALTER COLUMN message_id TYPE BIGINT",
+        """ALTER TABLE timeline_entries
+           ALTER COLUMN message_id TYPE BIGINT,
+           DROP COLUMN IF EXISTS timestamp""",
+    ], False),
+
+    Migration(8, "page messages by id alone", [
+        create_index('ix_messages_user_id_id', "messages (user_id, id)"),
+        "DROP INDEX CONCURRENTLY IF EXISTS ix_messages_user_id_timestamp",
+    ], True),
+
+    # Adding a nullable column without a default doesn't rewrite the table.
+    Migration(9, "soft-deleted accounts", [
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP WITHOUT TIME ZONE",
+        create_index('ix_users_deleted_at',
+                     "users (deleted_at) WHERE deleted_at IS NOT NULL"),
+    ], True),
+
+    # Timelines that already have entries were built; the rest are rebuilt
+    # (and marked) on first read.
+    Migration(10, "timeline build markers", [
+        """CREATE TABLE IF NOT EXISTS timeline_builds (
+           user_id INTEGER PRIMARY KEY REFERENCES users (id) ON DELETE CASCADE,
+           built_at TIMESTAMP WITHOUT TIME ZONE NOT NULL)""",
+        """INSERT INTO timeline_builds (user_id, built_at)
+           SELECT DISTINCT user_id, timezone('utc', now()) FROM timeline_entries
+           ON CONFLICT DO NOTHING""",
+    ], False),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def current_version(bind):
+    """The schema version of the database at `bind`; 0 if it is empty."""
+
+    tables = inspect(bind).get_table_names()
+
+    if SchemaMigration.__tablename__ not in tables:
+        return 1 if 'users' in tables else 0
+
+    return bind.execute(func.max(SchemaMigration.version).select()).scalar() or 0
+
+
+def stamp(bind, version):
+    """Record `version` as applied."""
+
+    bind.execute(SchemaMigration.__table__.insert(), version=version)
+
+
+def run_step(conn, step):
+    if callable(step):
+        step(conn)
+    else:
+        conn.execute(step)
+
+
+@contextmanager
+def autocommit(engine):
+    """A connection running each statement in its own transaction."""
+
+    with engine.connect() as conn:
+        yield conn.execution_options(isolation_level='AUTOCOMMIT')
+
+
+def migrate(engine=None):
+    """Apply every pending migration. Returns the migrations applied."""
+
+    engine = engine or db.engine
+    version = current_version(engine)
+
+    if version == 0:
+        db.metadata.create_all(engine)
+        stamp(engine, LATEST_VERSION)
+        return []
+
+    SchemaMigration.__table__.create(engine, checkfirst=True)
+    if version == 1:
+        stamp(engine, 1)
+
+    applied = []
+    for migration in MIGRATIONS:
+        if migration.version <= version:
+            continue
+
+        if migration.concurrent:
+            with autocommit(engine) as conn:
+                for step in migration.steps:
+                    run_step(conn, step)
+                stamp(conn, migration.version)
+        else:
+            with engine.begin() as conn:
+                for step in migration.steps:
+                    run_step(conn, step)
+                stamp(conn, migration.version)
+
+        applied.append(migration)
+
+    return applied
+
+
+IndexReport = namedtuple('IndexReport', 'missing invalid unused')
+
+
+def check_indexes(engine=None):
+    """Compare the live database's indexes with the index pack.
+
+    Returns the names of pack indexes that are missing or invalid, and
+    (table, index, size) for indexes that have never been scanned.
+    """
+
+    engine = engine or db.engine
+
+    with engine.connect() as conn:
+        missing, invalid = [], []
+        for name, definition, condition in INDEX_PACK:
+            if condition and not condition(conn):
+                continue
+
+            valid = index_is_valid(conn, name)
+            if valid is None:
+                missing.append(name)
+            elif not valid:
+                invalid.append(name)
+
+        unused = conn.execute(
+            """SELECT s.relname, s.indexrelname,
+                      pg_size_pretty(pg_relation_size(s.indexrelid))
+               FROM pg_stat_user_indexes s
+               JOIN pg_index i ON i.indexrelid = s.indexrelid
+               WHERE s.idx_scan = 0
+                 AND NOT i.indisunique
+                 AND NOT i.indisprimary
+               ORDER BY pg_relation_size(s.indexrelid) DESC""").fetchall()
+
+    return IndexReport(missing, invalid, [tuple(row) for row in unused])
+
+
+def build_index_pack(engine=None):
+    """Build any index in the pack that is missing or invalid."""
+
+    engine = engine or db.engine
+
+    with autocommit(engine) as conn:
+        for name, definition, condition in INDEX_PACK:
+            create_index(name, definition, condition)(conn)
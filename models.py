@@ -2,10 +2,13 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event, func
+from sqlalchemy.dialects.postgresql import TSVECTOR, insert
+
+from passwords import password_pool
+from snowflakes import message_ids, timestamp_of
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 
 
@@ -25,6 +28,13 @@ class Follows(db.Model):
         db.ForeignKey('users.id', ondelete="cascade"),
         primary_key=True,
     )
+
+    # The primary key serves "who follows this user"; this index serves
+    # "who does this user follow".
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
 # Note that the follows table has two foreign keys to the same table user, 
 # This is because each of these foreigns keys track data in two scenarios
 # While user_being_followed holds data of the other users a current user is following,
@@ -36,22 +46,44 @@ class Likes(db.Model):
 
     __tablename__ = 'likes' 
 
-    id = db.Column(
-        db.Integer,
-        primary_key=True
-    )
-
+    # The primary key serves "what did this user like"; the index below
+    # serves "who liked this message".
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
     message_id = db.Column(
-        db.Integer,
+        db.BigInteger,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        primary_key=True,
+    )
+
+    __table_args__ = (
+        db.Index('ix_likes_message_id_user_id', 'message_id', 'user_id'),
     )
 
+    @classmethod
+    def toggle(cls, user_id, message_id):
+        """Like `message_id` for `user_id`, or unlike it if already liked.
+
+        One DELETE, plus one INSERT if nothing was deleted, however many
+        likes the user has.  Returns True if a like was added, False if one
+        was removed, or None if a concurrent request added it first.
+        """
+
+        unliked = (cls.query
+                   .filter_by(user_id=user_id, message_id=message_id)
+                   .delete(synchronize_session=False))
+        if unliked:
+            return False
+
+        liked = db.session.execute(insert(cls.__table__)
+                                   .values(user_id=user_id, message_id=message_id)
+                                   .on_conflict_do_nothing())
+        return True if liked.rowcount else None
+
 
 class User(db.Model):
     """User in the system."""
@@ -98,6 +130,43 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized counts, kept up to date by the views that change them
+    # (see counters.py) so pages don't load whole collections to count them.
+
+    message_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    follower_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Set when the account is deleted.  The user is hidden from then on
+    # and their rows are purged later, in the background (see purge.py).
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -119,20 +188,53 @@ class User(db.Model):
         secondary="likes"
     )
 
+    __table_args__ = (
+        # Finds accounts waiting to be purged.
+        db.Index('ix_users_deleted_at', 'deleted_at',
+                 postgresql_where=deleted_at.isnot(None)),
+    )
+
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    @classmethod
+    def visible(cls):
+        """Query for users who haven't deleted their accounts."""
+
+        return cls.query.filter(cls.deleted_at.is_(None))
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return self.id in other_user.following_among([self])
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.id in self.following_among([other_user])
+
+    def following_among(self, users):
+        """Which of `users` is this user following? Returns a set of their ids.
+
+        Answered with one lookup on the follows primary key for all of
+        `users`.  Answers are remembered on this instance (i.e. for the rest
+        of the request), so views can check a whole page of users up front
+        and templates can then call `is_following` for free.
+        """
+
+        cache = self.__dict__.setdefault('_following_cache', {})
+        missing = {user.id for user in users} - cache.keys()
+
+        if missing:
+            rows = (db.session
+                    .query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == self.id,
+                            Follows.user_being_followed_id.in_(missing))
+                    .all())
+            found = {user_id for (user_id,) in rows}
+            cache.update({user_id: user_id in found for user_id in missing})
+
+        return {user.id for user in users if cache[user.id]}
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -141,7 +243,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = password_pool.hash(password)
 
         user = User(
             username=username,
@@ -162,26 +264,86 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        A password stored at a different bcrypt cost than the current one is
+        rehashed at the current cost (the caller commits).
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.visible().filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = password_pool.check(user.password, password)
             if is_auth:
+                if password_pool.needs_rehash(user.password):
+                    user.password = password_pool.hash(password)
                 return user
 
         return False
 
 
+def has_pg_trgm(ddl, target, bind, **kw):
+    """Can this Postgres server create the pg_trgm extension?"""
+
+    return bind.execute(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'").scalar()
+
+
+# Username search (search.py) filters on lower(username): a text_pattern_ops
+# index serves prefix matches and, where pg_trgm is available, a trigram
+# index serves substring matches too.
+event.listen(User.__table__, 'after_create', DDL(
+    "CREATE INDEX ix_users_username_prefix "
+    "ON users (lower(username) text_pattern_ops)"
+).execute_if(dialect='postgresql'))
+event.listen(User.__table__, 'after_create', DDL(
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm"
+).execute_if(dialect='postgresql', callable_=has_pg_trgm))
+event.listen(User.__table__, 'after_create', DDL(
+    "CREATE INDEX ix_users_username_trgm "
+    "ON users USING gin (lower(username) gin_trgm_ops)"
+).execute_if(dialect='postgresql', callable_=has_pg_trgm))
+
+
+@event.listens_for(User.following, 'append')
+@event.listens_for(User.following, 'remove')
+def forget_following_cache(user, followed_user, initiator):
+    """Following someone new invalidates `following_among`'s answers."""
+
+    user.__dict__.pop('_following_cache', None)
+
+
+def new_message_id(context):
+    """Snowflake id for a message being inserted; see snowflakes.py.
+
+    Messages loaded with a timestamp (e.g. by seed.py) get an id from that
+    time, so ids still sort in timestamp order.
+    """
+
+    timestamp = context.get_current_parameters().get('timestamp')
+    if timestamp is None:
+        return message_ids.next_id()
+    return message_ids.id_at(timestamp)
+
+
+def message_timestamp(context):
+    """A new message's timestamp: the time its id was minted."""
+
+    return timestamp_of(context.get_current_parameters()['id'])
+
+
 class Message(db.Model):
-    """An individual message ("warble")."""
+    """An individual message ("warble").
+
+    Ids are time-ordered, so listings order and page by id alone.
+    """
 
     __tablename__ = 'messages'
 
     id = db.Column(
-        db.Integer,
+        db.BigInteger,
         primary_key=True,
+        autoincrement=False,
+        default=new_message_id,
     )
 
     text = db.Column(
@@ -189,10 +351,12 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Rows inserted with raw SQL get the database's clock instead.
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=message_timestamp,
+        server_default=func.timezone('utc', func.now()),
     )
 
     user_id = db.Column(
@@ -201,8 +365,105 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Full-text search vector for `text`, filled in by search.py. Deferred
+    # so that ordinary message queries don't load it.
+    search_vector = db.deferred(db.Column(
+        db.Text().with_variant(TSVECTOR(), 'postgresql'),
+    ))
+
+    # Maintained by counters.py, like the counters on User.
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     user = db.relationship('User')
 
+    @classmethod
+    def visible(cls):
+        """Query for messages whose authors haven't deleted their accounts."""
+
+        return cls.query.join(cls.user).filter(User.deleted_at.is_(None))
+
+    __table_args__ = (
+        db.Index('ix_messages_search_vector', 'search_vector',
+                 postgresql_using='gin'),
+        # A user's messages, newest first (profile pages, pulled timelines).
+        db.Index('ix_messages_user_id_id', 'user_id', 'id'),
+    )
+
+
+class TimelineEntry(db.Model):
+    """One message id in a user's materialized home timeline."""
+
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # Message ids are time-ordered, so the primary key also serves
+    # reading a timeline newest first.
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        # Deleting a message removes it from every timeline.
+        db.Index('ix_timeline_entries_message_id', 'message_id'),
+    )
+
+
+class TimelineBuild(db.Model):
+    """Marks a user's materialized timeline as built from the messages table.
+
+    A timeline without one is rebuilt on first read; one that is built but
+    empty (the user follows nobody who has posted) is left alone.
+    """
+
+    __tablename__ = 'timeline_builds'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    built_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+
+class SchemaMigration(db.Model):
+    """A schema version that has been applied (see migrations.py)."""
+
+    __tablename__ = 'schema_migrations'
+
+    version = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    applied_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -0,0 +1,92 @@
+"""Keyset (cursor) pagination for Warbler listings.
+
+Every listing is ordered newest-first on a small set of columns (e.g.
+``Message.id``, or a search rank then an id).  Instead of an OFFSET, the next page
+is fetched with a seek predicate on those columns, starting just after
+the last row of the previous page, so each page costs the same no matter
+how deep it is.
+
+Cursors are handed to templates as opaque url-safe strings and come back
+in the ``before`` query string argument.
+"""
+
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+
+from flask import abort, current_app, request
+from sqlalchemy import tuple_
+
+
+def encode_cursor(values):
+    """Turn the sort-key `values` of a row into an opaque cursor string."""
+
+    raw = json.dumps([value.isoformat() if isinstance(value, datetime) else value
+                      for value in values])
+    return urlsafe_b64encode(raw.encode('UTF-8')).decode('ascii')
+
+
+def decode_cursor(cursor, columns):
+    """Turn a cursor string back into sort-key values for `columns`.
+
+    Aborts with a 400 if the cursor is not one we handed out.
+    """
+
+    try:
+        values = json.loads(urlsafe_b64decode(cursor.encode('ascii')))
+        if len(values) != len(columns):
+            raise ValueError(cursor)
+
+        return tuple(datetime.fromisoformat(value)
+                     if column.type.python_type is datetime else int(value)
+                     for column, value in zip(columns, values))
+
+    except (ValueError, TypeError, UnicodeError):
+        abort(400)
+
+
+def get_before(columns):
+    """Decoded ``before`` cursor from the query string, or None for page 1."""
+
+    cursor = request.args.get('before')
+    return decode_cursor(cursor, columns) if cursor else None
+
+
+def per_page():
+    """Number of rows on one page of any listing."""
+
+    return current_app.config['PAGE_SIZE']
+
+
+def seek(query, columns, before):
+    """Order `query` newest-first on `columns`, starting after `before`."""
+
+    if before is not None:
+        query = query.filter(tuple_(*columns) < tuple_(*before))
+
+    return query.order_by(*[column.desc() for column in columns])
+
+
+def page_of(rows, size, key):
+    """Split `size + 1` fetched rows into a page and the next page's cursor.
+
+    The extra row is only there to tell whether there is another page.
+    """
+
+    if len(rows) <= size:
+        return rows, None
+
+    rows = rows[:size]
+    return rows, encode_cursor(key(rows[-1]))
+
+
+def paginate(query, columns, key):
+    """Fetch the page of `query` named by the request's ``before`` cursor.
+
+    `key` maps a row to its values for `columns`.  Returns the rows on the
+    page and the cursor for the next (older) page, or None if this is the last.
+    """
+
+    size = per_page()
+    rows = seek(query, columns, get_before(columns)).limit(size + 1).all()
+    return page_of(rows, size, key)
@@ -0,0 +1,162 @@
+"""Password hashing and checking, off the request worker.
+
+bcrypt is deliberately slow (~250ms of CPU per hash at cost 12), so doing it
+inline on the request worker means a burst of logins ties up every worker.
+With ``BCRYPT_POOL_SIZE`` set, hashing and checking run in a dedicated pool
+of that many processes instead.  At most ``BCRYPT_POOL_SIZE +
+BCRYPT_QUEUE_LIMIT`` jobs are in flight at once; past that, `PasswordPoolFull`
+is raised straight away so the app can answer 503 instead of piling up.
+
+With a pool size of 0 (the default) everything runs inline, as before.
+
+The bcrypt cost (``BCRYPT_LOG_ROUNDS``) should be picked per machine with
+``flask calibrate-bcrypt``, which times hashes and reports the highest cost
+that fits a latency budget.  Stored hashes made at any other cost are
+rehashed at the current one the next time their owner logs in.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from threading import BoundedSemaphore, Lock
+from time import perf_counter
+
+import bcrypt
+
+DEFAULT_LOG_ROUNDS = 12
+
+
+class PasswordPoolFull(Exception):
+    """Too many password jobs are already running or queued."""
+
+
+def _hash(password, log_rounds):
+    return bcrypt.hashpw(password.encode('UTF-8'),
+                         bcrypt.gensalt(log_rounds)).decode('UTF-8')
+
+
+def _check(pw_hash, password):
+    return bcrypt.checkpw(password.encode('UTF-8'), pw_hash.encode('UTF-8'))
+
+
+class PasswordPool:
+    """Runs bcrypt jobs inline or in a bounded process pool."""
+
+    def __init__(self, size=0, queue_limit=0, log_rounds=DEFAULT_LOG_ROUNDS):
+        self.executor = None
+        self.lock = Lock()
+        self.configure(size, queue_limit, log_rounds)
+
+    def configure(self, size, queue_limit, log_rounds):
+        """(Re)size the pool; any existing worker processes are shut down."""
+
+        self.shutdown()
+        self.size = size
+        self.queue_limit = queue_limit
+        self.log_rounds = log_rounds
+        self.slots = BoundedSemaphore(size + queue_limit) if size else None
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor:
+                self.executor.shutdown()
+                self.executor = None
+
+    def run(self, fn, *args):
+        """Run `fn(*args)` in the pool and wait for its result."""
+
+        if not self.size:
+            return fn(*args)
+
+        if not self.slots.acquire(blocking=False):
+            raise PasswordPoolFull()
+
+        try:
+            executor = self._executor()
+            try:
+                return executor.submit(fn, *args).result()
+            except BrokenProcessPool:
+                # A worker died (e.g. killed for memory), which leaves the
+                # executor refusing every job from then on.  Start a fresh
+                # one and try once more.
+                self._discard(executor)
+                return self._executor().submit(fn, *args).result()
+        finally:
+            self.slots.release()
+
+    def _executor(self):
+        with self.lock:
+            if self.executor is None:
+                # Spawn rather than fork, so workers don't inherit the
+                # app's database connections and threads.
+                self.executor = ProcessPoolExecutor(self.size,
+                                                    mp_context=get_context('spawn'))
+            return self.executor
+
+    def _discard(self, executor):
+        """Stop using broken `executor`, unless another job already has."""
+
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+        executor.shutdown(wait=False)
+
+    def hash(self, password):
+        """Hash `password` with bcrypt at this pool's cost."""
+
+        if not password:
+            raise ValueError('Password must be non-empty.')
+
+        return self.run(_hash, password, self.log_rounds)
+
+    def check(self, pw_hash, password):
+        """Does `password` match the bcrypt hash `pw_hash`?"""
+
+        return self.run(_check, pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        """Was `pw_hash` made at a different cost than this pool uses?"""
+
+        return log_rounds_of(pw_hash) != self.log_rounds
+
+
+def log_rounds_of(pw_hash):
+    """The cost a bcrypt hash was made at, e.g. 12 for ``$2b$12$...``."""
+
+    try:
+        return int(pw_hash.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+def calibrate_log_rounds(target_ms, min_rounds=10, max_rounds=16):
+    """Highest bcrypt cost whose hash takes no more than `target_ms` here.
+
+    Never goes below `min_rounds`, even on hardware too slow to meet the
+    target.  Returns the chosen cost and {cost: measured ms}.
+    """
+
+    timings = {}
+    chosen = min_rounds
+
+    for log_rounds in range(min_rounds, max_rounds + 1):
+        start = perf_counter()
+        _hash('calibration password', log_rounds)
+        timings[log_rounds] = (perf_counter() - start) * 1000
+
+        if timings[log_rounds] > target_ms:
+            break
+        chosen = log_rounds
+
+    return chosen, timings
+
+
+password_pool = PasswordPool()
+
+
+def configure_passwords(app):
+    """Set up the shared password pool from the app's config."""
+
+    password_pool.configure(app.config.get('BCRYPT_POOL_SIZE', 0),
+                            app.config.get('BCRYPT_QUEUE_LIMIT', 0),
+                            app.config.get('BCRYPT_LOG_ROUNDS', DEFAULT_LOG_ROUNDS))
@@ -0,0 +1,142 @@
+"""Sampling profiler for live workers.
+
+``GET /_profile`` samples the stacks of this worker's other request
+threads for a while and answers with them in collapsed ("folded") form,
+one ``view;frame;frame;... count`` line per distinct stack, ready for
+flamegraph.pl, speedscope or similar.  Each stack starts with the view
+(endpoint) the thread was serving, e.g. ``homepage`` or ``list_users``.
+
+Query parameters:
+
+- ``seconds``: how long to sample for (default 10)
+- ``rate``: samples per second (default 100)
+- ``route`` and ``requests``: only sample threads serving that view, and
+  stop once that many of its requests have finished (or ``seconds``
+  have passed, whichever is first)
+
+It is off unless ``PROFILER_TOKEN`` is set, and then needs that token as
+``Authorization: Bearer <token>``.  Sampling only walks the stacks of
+threads that are serving a request, from the profiling request's own
+thread, so the cost to other requests is a few dict operations each;
+nothing is traced.  The profiling request ties up its thread while it
+samples, so this is for threaded workers (e.g. gunicorn ``--threads``),
+and only sees the worker process that answered it.
+"""
+
+import sys
+from collections import Counter
+from os import path
+from threading import Event, Lock, get_ident
+from time import monotonic
+
+from flask import request
+
+
+class ProfilerBusy(Exception):
+    """Another profile is already running in this process."""
+
+
+class Profile:
+    """One profiling run: which threads to sample, and what it has seen."""
+
+    def __init__(self, rate, route=None, requests=None):
+        self.interval = 1 / rate
+        self.route = route
+        self.requests_left = requests
+        self.done = Event()
+        self.stacks = Counter()
+        self.samples = 0
+
+    def request_finished(self, view):
+        if self.requests_left is not None and view == self.route:
+            self.requests_left -= 1
+            if self.requests_left <= 0:
+                self.done.set()
+
+    def sample(self, views, skip):
+        """Count the current stack of every thread serving a request."""
+
+        for ident, frame in sys._current_frames().items():
+            view = views.get(ident)
+            if ident == skip or view is None or self.route not in (None, view):
+                continue
+
+            self.stacks[collapse(view, frame)] += 1
+
+        self.samples += 1
+
+    def collapsed(self):
+        return "".join(f"{stack} {count}\n"
+                       for stack, count in sorted(self.stacks.items()))
+
+
+def collapse(view, frame):
+    """`frame`'s stack as ``view;outermost;...;innermost``."""
+
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+
+    return ";".join([view] + names[::-1])
+
+
+class Profiler:
+    """Map of thread -> the view it is serving, and the running profile."""
+
+    def __init__(self):
+        self.views = {}
+        self.profile = None
+        self.lock = Lock()
+
+    def request_started(self, view):
+        self.views[get_ident()] = view
+
+    def request_finished(self):
+        view = self.views.pop(get_ident(), None)
+
+        with self.lock:
+            if self.profile:
+                self.profile.request_finished(view)
+
+    def run(self, seconds, rate, route=None, requests=None):
+        """Sample for `seconds` (or `requests` requests to `route`).
+
+        Returns the finished Profile.
+        """
+
+        profile = Profile(rate, route, requests)
+
+        with self.lock:
+            if self.profile:
+                raise ProfilerBusy()
+            self.profile = profile
+
+        try:
+            deadline = monotonic() + seconds
+            me = get_ident()
+            while monotonic() < deadline:
+                profile.sample(self.views, skip=me)
+                if profile.done.wait(profile.interval):
+                    break
+        finally:
+            with self.lock:
+                self.profile = None
+
+        return profile
+
+
+profiler = Profiler()
+
+
+def configure_profiler(app):
+    """Keep track of which view each request thread is serving."""
+
+    @app.before_request
+    def profiler_request_started():
+        profiler.request_started(request.endpoint or 'unmatched')
+
+    @app.teardown_request
+    def profiler_request_finished(exc):
+        profiler.request_finished()
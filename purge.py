@@ -0,0 +1,235 @@
+"""Deleting accounts, and purging their rows in the background.
+
+Deleting an account (`mark_deleted`) only stamps ``users.deleted_at``.
+From then on the user and their messages are left out of every page (see
+``User.visible`` and ``Message.visible``), but their rows stay put, so the
+request never has to cascade through a heavy account's messages, likes and
+follows while holding locks on those tables.
+
+``flask purge-deleted-users`` (run it from cron, or leave it running with
+``--watch``) removes those rows later, a bounded batch at a time.  Each
+batch is deleted in its own short transaction together with the counter
+updates it implies (see counters.py), so a purge that dies part way through
+leaves everything consistent and simply carries on from where it got to
+the next time it runs.
+"""
+
+from collections import defaultdict
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+from counters import adjust
+from models import db, Follows, Likes, Message, TimelineEntry, User
+from timelines import followers_lost, get_timeline_store
+from usercache import user_cache
+
+
+def mark_deleted(user):
+    """Delete `user`'s account, as far as every page is concerned.
+
+    The caller commits.
+    """
+
+    user.deleted_at = datetime.utcnow()
+
+    store = get_timeline_store()
+    if store:
+        store.drop(user.id)
+
+    user_cache.forget(user.id)
+
+
+##############################################################################
+# Purge steps: each deletes up to `limit` of a deleted user's rows and
+# returns how many it deleted.
+
+
+def purge_following(user_id, limit):
+    """Follows of other users: they each lose a follower."""
+
+    ids = [followed_id for (followed_id,) in (db.session
+           .query(Follows.user_being_followed_id)
+           .filter(Follows.user_following_id == user_id)
+           .limit(limit))]
+
+    if ids:
+        adjust(ids, User.follower_count, -1)
+        (Follows
+         .query
+         .filter(Follows.user_following_id == user_id,
+                 Follows.user_being_followed_id.in_(ids))
+         .delete(synchronize_session=False))
+
+        store = get_timeline_store()
+        if store:
+            followers_lost(store, ids)
+
+    return len(ids)
+
+
+def purge_followers(user_id, limit):
+    """Follows by other users: they each follow one fewer user."""
+
+    ids = [follower_id for (follower_id,) in (db.session
+           .query(Follows.user_following_id)
+           .filter(Follows.user_being_followed_id == user_id)
+           .limit(limit))]
+
+    if ids:
+        adjust(ids, User.following_count, -1)
+        (Follows
+         .query
+         .filter(Follows.user_being_followed_id == user_id,
+                 Follows.user_following_id.in_(ids))
+         .delete(synchronize_session=False))
+
+    return len(ids)
+
+
+def purge_likes_given(user_id, limit):
+    """Their likes: each liked message loses a like."""
+
+    ids = [message_id for (message_id,) in (db.session
+           .query(Likes.message_id)
+           .filter(Likes.user_id == user_id)
+           .limit(limit))]
+
+    if ids:
+        adjust(ids, Message.like_count, -1)
+        (Likes
+         .query
+         .filter(Likes.user_id == user_id, Likes.message_id.in_(ids))
+         .delete(synchronize_session=False))
+
+    return len(ids)
+
+
+def purge_likes_received(user_id, limit):
+    """Likes of their messages: each liker loses one like per message."""
+
+    rows = (db.session
+            .query(Likes.user_id, Likes.message_id)
+            .join(Message, Message.id == Likes.message_id)
+            .filter(Message.user_id == user_id)
+            .limit(limit)
+            .all())
+
+    per_liker = defaultdict(int)
+    for liker_id, _ in rows:
+        per_liker[liker_id] += 1
+
+    by_count = defaultdict(list)
+    for liker_id, num_likes in per_liker.items():
+        by_count[num_likes].append(liker_id)
+
+    for num_likes, liker_ids in by_count.items():
+        adjust(liker_ids, User.like_count, -num_likes)
+
+    if rows:
+        (Likes
+         .query
+         .filter(tuple_(Likes.user_id, Likes.message_id).in_(rows))
+         .delete(synchronize_session=False))
+
+    return len(rows)
+
+
+def purge_timeline_entries(user_id, limit):
+    """Their messages in other users' timelines, then their own timeline."""
+
+    their_messages = db.session.query(Message.id).filter(Message.user_id == user_id)
+    rows = (db.session
+            .query(TimelineEntry.user_id, TimelineEntry.message_id)
+            .filter(TimelineEntry.message_id.in_(their_messages))
+            .limit(limit)
+            .all())
+
+    if len(rows) < limit:
+        rows += (db.session
+                 .query(TimelineEntry.user_id, TimelineEntry.message_id)
+                 .filter(TimelineEntry.user_id == user_id)
+                 .limit(limit - len(rows))
+                 .all())
+
+    if rows:
+        (TimelineEntry
+         .query
+         .filter(tuple_(TimelineEntry.user_id, TimelineEntry.message_id).in_(rows))
+         .delete(synchronize_session=False))
+
+    return len(rows)
+
+
+def purge_messages(user_id, limit):
+    ids = [message_id for (message_id,) in (db.session
+           .query(Message.id)
+           .filter(Message.user_id == user_id)
+           .limit(limit))]
+
+    if ids:
+        (Message
+         .query
+         .filter(Message.id.in_(ids))
+         .delete(synchronize_session=False))
+
+    return len(ids)
+
+
+def purge_account(user_id, limit):
+    return (User
+            .query
+            .filter(User.id == user_id, User.deleted_at.isnot(None))
+            .delete(synchronize_session=False))
+
+
+# In order: by the time messages are deleted, nothing refers to them.
+PURGE_STEPS = [
+    ('following', purge_following),
+    ('followers', purge_followers),
+    ('likes given', purge_likes_given),
+    ('likes received', purge_likes_received),
+    ('timeline entries', purge_timeline_entries),
+    ('messages', purge_messages),
+    ('account', purge_account),
+]
+
+
+def purge_user(user_id, batch_size=1000, progress=None):
+    """Delete every row belonging to deleted user `user_id`, in batches.
+
+    Commits after every batch.  `progress`, if given, is called after each
+    batch with the user id, the step name and the rows deleted so far in
+    that step.
+    """
+
+    for name, step in PURGE_STEPS:
+        total = 0
+
+        while True:
+            deleted = step(user_id, batch_size)
+            db.session.commit()
+
+            total += deleted
+            if deleted and progress:
+                progress(user_id, name, total)
+
+            if deleted < batch_size:
+                break
+
+
+def purge_deleted_users(batch_size=1000, progress=None):
+    """Purge every account marked deleted, oldest first.
+
+    Returns the ids of the users purged.
+    """
+
+    user_ids = [user_id for (user_id,) in (db.session
+                .query(User.id)
+                .filter(User.deleted_at.isnot(None))
+                .order_by(User.deleted_at))]
+
+    for user_id in user_ids:
+        purge_user(user_id, batch_size, progress)
+
+    return user_ids
@@ -0,0 +1,389 @@
+"""Search for Warbler.
+
+Username search ranks exact matches first, then prefix matches, then
+anything containing the search term.  Message search is full-text and
+ranks messages by relevance.  Both are cursor-paginated like every other
+listing (see pagination.py).
+
+Two backends are available (``SEARCH_BACKEND`` in the app config):
+
+- ``"sql"``: usernames are matched on ``lower(username)``, which Postgres
+  serves from the trigram / prefix indexes created alongside the users
+  table; messages are matched on ``messages.search_vector``, a tsvector
+  with a GIN index.  Without the pg_trgm extension no index can serve a
+  substring match, so username search falls back to prefix matches only
+  rather than scanning every user.
+- ``"memory"``: trigram and inverted word indexes kept in this process,
+  for SQLite and tests
+
+Either way, views call `index_message` / `unindex_message` as messages are
+written and deleted.  Messages loaded in bulk (e.g. by seed.py) are
+indexed with ``flask reindex-messages``.
+"""
+
+import re
+from bisect import bisect_left
+from collections import Counter, defaultdict
+
+from flask import current_app
+from sqlalchemy import Integer, case, cast, event, func
+
+from loading import with_authors
+from models import db, Message, User
+from pagination import get_before, page_of, per_page, seek
+
+EXACT, PREFIX, CONTAINS = 2, 1, 0
+
+
+def rank(username, term):
+    """How well `username` matches the (lowercase) search `term`."""
+
+    username = username.lower()
+
+    if username == term:
+        return EXACT
+    if username.startswith(term):
+        return PREFIX
+    return CONTAINS
+
+
+def like_escape(term):
+    """Escape LIKE wildcards in a user-supplied search term."""
+
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def trigrams(text):
+    """Set of three-character substrings of `text`."""
+
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+##############################################################################
+# Username search
+
+
+def ranking_columns(term):
+    """Sort columns for username search: the match rank, then the user id."""
+
+    lowered = func.lower(User.username)
+    ranking = case([(lowered == term, EXACT),
+                    (lowered.like(f"{like_escape(term)}%", escape='\\'), PREFIX)],
+                   else_=CONTAINS)
+    return [ranking, User.id]
+
+
+class SQLUserSearch:
+    """Username search against the users table."""
+
+    def __init__(self):
+        self.substrings = None
+
+    def matches_substrings(self):
+        """Is pg_trgm installed, so the trigram index can serve substring matches?"""
+
+        if self.substrings is None:
+            self.substrings = bool(db.session.execute(
+                "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'").scalar())
+        return self.substrings
+
+    def query(self, term):
+        """Users whose username matches `term`, by index."""
+
+        pattern = f"{like_escape(term)}%"
+        if self.matches_substrings():
+            pattern = f"%{pattern}"
+
+        return User.visible().filter(func.lower(User.username).like(pattern, escape='\\'))
+
+    def search(self, term):
+        query = self.query(term)
+        columns = ranking_columns(term)
+
+        size = per_page()
+        users = seek(query, columns, get_before(columns)).limit(size + 1).all()
+        return page_of(users, size, key=lambda user: (rank(user.username, term), user.id))
+
+
+class MemoryUserSearch:
+    """Username search against a trigram index kept in this process.
+
+    The index is built from the users table on first use and then kept up
+    to date by mapper events as users are added, renamed and deleted.
+    """
+
+    def __init__(self):
+        self.usernames = None
+        self.by_trigram = defaultdict(set)
+
+    def clear(self):
+        """Forget the index; it is rebuilt on the next search."""
+
+        self.usernames = None
+        self.by_trigram.clear()
+
+    def add(self, user_id, username):
+        if self.usernames is None:
+            return
+
+        self.remove(user_id)
+        self.usernames[user_id] = username.lower()
+        for trigram in trigrams(username.lower()):
+            self.by_trigram[trigram].add(user_id)
+
+    def remove(self, user_id):
+        if self.usernames is None:
+            return
+
+        username = self.usernames.pop(user_id, None)
+        if username is not None:
+            for trigram in trigrams(username):
+                self.by_trigram[trigram].discard(user_id)
+
+    def load(self):
+        self.usernames = {}
+        for user_id, username in (db.session
+                                  .query(User.id, User.username)
+                                  .filter(User.deleted_at.is_(None))):
+            self.add(user_id, username)
+
+    def candidates(self, term):
+        """Ids that could contain `term`: every user sharing all its trigrams."""
+
+        grams = trigrams(term)
+        if not grams:
+            return self.usernames.keys()
+
+        return set.intersection(*[self.by_trigram.get(gram, set()) for gram in grams])
+
+    def search(self, term):
+        if self.usernames is None:
+            self.load()
+
+        ranked = sorted(((-rank(self.usernames[user_id], term), -user_id)
+                         for user_id in self.candidates(term)
+                         if term in self.usernames[user_id]))
+
+        cursor = get_before(ranking_columns(term))
+        start = 0
+        if cursor is not None:
+            # Keys are negated, so "older than the cursor" means greater.
+            start = bisect_left(ranked, (-cursor[0], -cursor[1] + 1))
+
+        size = per_page()
+        ids = [-user_id for _, user_id in ranked[start:start + size + 1]]
+        if not ids:
+            return [], None
+
+        by_id = {user.id: user for user in User.visible().filter(User.id.in_(ids))}
+        users = [by_id[user_id] for user_id in ids if user_id in by_id]
+
+        return page_of(users, size, key=lambda user: (rank(user.username, term), user.id))
+
+
+memory_user_search = MemoryUserSearch()
+
+USER_SEARCH_BACKENDS = {
+    'sql': SQLUserSearch(),
+    'memory': memory_user_search,
+}
+
+
+def search_users(term):
+    """One page of users whose username contains `term`, best matches first.
+
+    Returns the users and the cursor for the next page (or None).
+    """
+
+    backend = USER_SEARCH_BACKENDS[current_app.config['SEARCH_BACKEND']]
+    return backend.search(term.lower())
+
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_update')
+def index_user(mapper, connection, user):
+    if user.deleted_at:
+        memory_user_search.remove(user.id)
+    else:
+        memory_user_search.add(user.id, user.username)
+
+
+@event.listens_for(User, 'after_delete')
+def unindex_user(mapper, connection, user):
+    memory_user_search.remove(user.id)
+
+
+##############################################################################
+# Message full-text search
+
+TEXT_SEARCH_CONFIG = 'english'
+
+# ts_rank is a float; it is scaled to an int so it can go in a cursor.
+RANK_SCALE = 1000000
+
+
+def words(text):
+    """Lowercase words in `text`, for the in-process index."""
+
+    return re.findall(r"\w+", text.lower())
+
+
+def message_columns(term):
+    """Sort columns for message search: relevance, then the message id."""
+
+    query = func.plainto_tsquery(TEXT_SEARCH_CONFIG, term)
+    relevance = cast(func.ts_rank(Message.search_vector, query) * RANK_SCALE, Integer)
+    return [relevance, Message.id]
+
+
+class SQLMessageSearch:
+    """Message search against the tsvector column on messages."""
+
+    def index(self, msg):
+        (Message
+         .query
+         .filter(Message.id == msg.id)
+         .update({Message.search_vector: func.to_tsvector(TEXT_SEARCH_CONFIG, Message.text)},
+                 synchronize_session=False))
+
+    def unindex(self, msg):
+        """The row (and its vector) goes away with the message."""
+
+    def reindex(self):
+        (Message
+         .query
+         .filter(Message.search_vector.is_(None))
+         .update({Message.search_vector: func.to_tsvector(TEXT_SEARCH_CONFIG, Message.text)},
+                 synchronize_session=False))
+
+    def search(self, term):
+        query = with_authors(Message.visible()).filter(
+            Message.search_vector.op('@@')(func.plainto_tsquery(TEXT_SEARCH_CONFIG, term)))
+        columns = message_columns(term)
+        relevance = columns[0].label('relevance')
+
+        size = per_page()
+        rows = (seek(query.add_columns(relevance), columns, get_before(columns))
+                .limit(size + 1)
+                .all())
+        rows, cursor = page_of(rows, size, key=lambda row: (row.relevance, row.Message.id))
+        return [row.Message for row in rows], cursor
+
+
+class MemoryMessageSearch:
+    """Message search against an inverted word index kept in this process.
+
+    Relevance is how many times the search words appear in the message.
+    """
+
+    def __init__(self):
+        self.counts = None
+        self.by_word = defaultdict(set)
+
+    def clear(self):
+        """Forget the index; it is rebuilt on the next search."""
+
+        self.counts = None
+        self.by_word.clear()
+
+    def index(self, msg):
+        if self.counts is None:
+            return
+
+        self.add(msg.id, msg.text)
+
+    def unindex(self, msg):
+        if self.counts is None:
+            return
+
+        for word in self.counts.pop(msg.id, {}):
+            self.by_word[word].discard(msg.id)
+
+    def reindex(self):
+        self.clear()
+
+    def add(self, message_id, text):
+        self.counts[message_id] = Counter(words(text))
+        for word in self.counts[message_id]:
+            self.by_word[word].add(message_id)
+
+    def load(self):
+        self.counts = {}
+        for message_id, text in db.session.query(Message.id, Message.text):
+            self.add(message_id, text)
+
+    def search(self, term):
+        if self.counts is None:
+            self.load()
+
+        terms = set(words(term))
+        if not terms:
+            return [], None
+
+        matches = set.intersection(*[self.by_word.get(word, set()) for word in terms])
+        ranked = sorted((-sum(self.counts[message_id][word] for word in terms), -message_id)
+                        for message_id in matches)
+
+        cursor = get_before(message_columns(term))
+        start = 0
+        if cursor is not None:
+            # Keys are negated, so "older than the cursor" means greater.
+            start = bisect_left(ranked, (-cursor[0], -cursor[1] + 1))
+
+        # Messages by deleted accounts stay in the index until they are
+        # purged, so keep reading ranked matches until a full page is
+        # visible or they run out.
+        size = per_page()
+        relevance = {}
+        messages = []
+        while len(messages) < size + 1 and start < len(ranked):
+            chunk = ranked[start:start + size + 1]
+            start += len(chunk)
+
+            ids = [-message_id for _, message_id in chunk]
+            relevance.update({-message_id: -score for score, message_id in chunk})
+            by_id = {msg.id: msg
+                     for msg in with_authors(Message.visible()).filter(Message.id.in_(ids))}
+            messages += [by_id[message_id] for message_id in ids if message_id in by_id]
+
+        return page_of(messages[:size + 1], size,
+                       key=lambda msg: (relevance[msg.id], msg.id))
+
+
+memory_message_search = MemoryMessageSearch()
+
+MESSAGE_SEARCH_BACKENDS = {
+    'sql': SQLMessageSearch(),
+    'memory': memory_message_search,
+}
+
+
+def message_search():
+    return MESSAGE_SEARCH_BACKENDS[current_app.config['SEARCH_BACKEND']]
+
+
+def search_messages(term):
+    """One page of messages matching every word in `term`, most relevant first.
+
+    Returns the messages and the cursor for the next page (or None).
+    """
+
+    return message_search().search(term)
+
+
+def index_message(msg):
+    """Add a just-written (and flushed) message to the search index."""
+
+    message_search().index(msg)
+
+
+def unindex_message(msg):
+    """Take a message that is about to be deleted out of the search index."""
+
+    message_search().unindex(msg)
+
+
+def reindex_messages():
+    """Index every message not indexed yet, e.g. after a bulk load."""
+
+    message_search().reindex()
@@ -1,20 +1,32 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
+Run it like:
 
+    python seed.py [--dir generator] [--chunk-rows 50000]
+"""
 
-db.drop_all()
-db.create_all()
+import argparse
+
+from app import app, db
+from bulkload import load_csvs
+from counters import reconcile_counters
+from migrations import migrate
+from search import reindex_messages
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--dir', default='generator', help="directory holding the CSVs")
+parser.add_argument('--chunk-rows', type=int, default=50000,
+                    help="rows sent to the database at a time")
+args = parser.parse_args()
+
+db.drop_all()
+migrate()
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+load_csvs(args.dir, args.chunk_rows)
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+reconcile_counters()
 
-db.session.commit()
+# The search backend comes from the app's config.
+with app.app_context():
+    reindex_messages()
+    db.session.commit()
@@ -0,0 +1,170 @@
+"""Time-ordered 64-bit message ids ("snowflakes").
+
+Each id packs, from the high bits down:
+
+- 41 bits: milliseconds since `EPOCH` (good for ~69 years)
+- 10 bits: worker id, so processes can mint ids without coordinating
+- 12 bits: a sequence number, for up to 4096 ids per millisecond per worker
+
+So ids are generated in process, without a round trip to the database, and
+sorting by id sorts by creation time; the time can be read back out with
+`timestamp_of`.
+
+Every process minting ids needs its own worker id.  Set it with
+``SNOWFLAKE_WORKER_ID`` in the app config, or leave that unset and each
+process leases the lowest free id from Postgres the first time it mints
+one: it holds a session-level advisory lock on the id (see
+`lease_worker_id`) on a connection of its own, until the process exits.
+On other databases (a single SQLite dev process) the id is 0.
+"""
+
+import os
+from datetime import datetime, timedelta
+from threading import Lock
+
+EPOCH = datetime(2015, 1, 1)
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+# First key of the advisory locks leasing worker ids; the second is the id.
+WORKER_LOCK_CLASS = 0x736e6f77
+
+
+def millis(when):
+    """Whole milliseconds from `EPOCH` to the (naive, UTC) datetime `when`."""
+
+    if when < EPOCH:
+        raise ValueError(f"Can't make a snowflake id for {when}, before {EPOCH}.")
+
+    return (when - EPOCH) // timedelta(milliseconds=1)
+
+
+def timestamp_of(snowflake_id):
+    """The (naive, UTC) time at which `snowflake_id` was minted."""
+
+    return EPOCH + timedelta(milliseconds=snowflake_id >> (WORKER_BITS + SEQUENCE_BITS))
+
+
+class SnowflakeGenerator:
+    """Mints unique, increasing ids for one worker."""
+
+    def __init__(self, worker_id=0):
+        self.lock = Lock()
+        self.configure(worker_id)
+
+        # If set, called for a worker id (and whatever holds it) the first
+        # time each process mints an id; see `configure_snowflakes`.
+        self.allocate = None
+        self.pid = None
+        # pid -> what holds that process's lease.  A forked child keeps its
+        # parent's entry referenced, so it never closes the parent's
+        # connection (and releases its lease) by garbage collecting it.
+        self.leases = {}
+
+    def configure(self, worker_id):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"Worker id must be between 0 and {MAX_WORKER_ID}.")
+
+        self.worker_id = worker_id
+        self.last_millis = -1
+        self.sequence = 0
+        # millisecond -> last sequence number `id_at` used in it
+        self.backfill_sequences = {}
+
+    def check_worker(self):
+        """Lease a worker id, if this process hasn't got one yet (call with the lock held)."""
+
+        if self.allocate and self.pid != os.getpid():
+            worker_id, self.leases[os.getpid()] = self.allocate()
+            self.configure(worker_id)
+            self.pid = os.getpid()
+
+    def pack(self, ms, sequence):
+        return (ms << (WORKER_BITS + SEQUENCE_BITS)) | (self.worker_id << SEQUENCE_BITS) | sequence
+
+    def next_id(self):
+        """A new id for right now."""
+
+        with self.lock:
+            self.check_worker()
+
+            # If the clock steps backwards, keep counting from the last
+            # millisecond used rather than risk reusing an id.
+            ms = max(millis(datetime.utcnow()), self.last_millis)
+
+            if ms == self.last_millis:
+                self.sequence = (self.sequence + 1) & MAX_SEQUENCE
+                if self.sequence == 0:
+                    # This millisecond is used up; borrow the next one.
+                    ms += 1
+            else:
+                self.sequence = 0
+
+            self.last_millis = ms
+            return self.pack(ms, self.sequence)
+
+    def id_at(self, when):
+        """An id for a message written at `when`, e.g. when loading old data.
+
+        Each millisecond counts through its own sequence numbers,
+        independently of `next_id`.  Raises ValueError rather than reuse
+        one once 4096 ids have been made for the same millisecond.
+        """
+
+        with self.lock:
+            self.check_worker()
+            ms = millis(when)
+
+            sequence = self.backfill_sequences.get(ms, -1) + 1
+            if sequence > MAX_SEQUENCE:
+                raise ValueError(f"Can't make more than {MAX_SEQUENCE + 1} snowflake ids "
+                                 f"for {when} on worker {self.worker_id}.")
+
+            self.backfill_sequences[ms] = sequence
+            return self.pack(ms, sequence)
+
+
+message_ids = SnowflakeGenerator()
+
+
+def lease_worker_id(engine):
+    """Lease the lowest worker id no other process holds.
+
+    Returns the id and the connection holding it.  The lease lasts until
+    that connection closes, e.g. when the process exits.
+    """
+
+    conn = engine.raw_connection()
+    conn.detach()  # never handed back to (or closed by) the pool
+
+    cursor = conn.cursor()
+    for worker_id in range(MAX_WORKER_ID + 1):
+        cursor.execute("SELECT pg_try_advisory_lock(%s, %s)", (WORKER_LOCK_CLASS, worker_id))
+        if cursor.fetchone()[0]:
+            conn.commit()
+            return worker_id, conn
+
+    conn.close()
+    raise RuntimeError(f"All {MAX_WORKER_ID + 1} snowflake worker ids are leased.")
+
+
+def configure_snowflakes(app):
+    """Set this process's worker id from the app's config, or lease one."""
+
+    worker_id = app.config.get('SNOWFLAKE_WORKER_ID')
+    if worker_id is not None:
+        message_ids.allocate = None
+        message_ids.configure(int(worker_id))
+        return
+
+    def allocate():
+        engine = app.extensions['sqlalchemy'].db.get_engine(app)
+        if engine.dialect.name != 'postgresql':
+            return 0, None
+        return lease_worker_id(engine)
+
+    message_ids.allocate = allocate
+    message_ids.pid = None
@@ -0,0 +1,212 @@
+"""Always-on SQL instrumentation: queries, database time and rows.
+
+Every statement the app sends through SQLAlchemy is timed (by engine
+events, so it costs a couple of clock reads per statement) and counted
+against the request that ran it:
+
+- with ``SERVER_TIMING`` set (or in debug mode), each response gets a
+  ``Server-Timing`` header with that request's query count, rows fetched
+  and time spent in the database; it is off by default since it tells
+  every client about the database
+- totals are kept per route (`sql_stats.routes()`) for the life of the
+  process
+- requests slower than ``SLOW_REQUEST_MS`` are logged as a warning along
+  with their statements, fingerprinted (literals and parameters replaced
+  by ``?``) and grouped, so an N+1 query shows up as one line run N times
+
+Tests can hold a view to a query budget with `assert_max_queries`.
+"""
+
+import re
+from collections import namedtuple, defaultdict
+from contextlib import contextmanager
+from threading import Lock, local
+from time import perf_counter
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# The query logs collecting this thread's statements right now.
+_active = local()
+
+
+class QueryLog:
+    """The statements run while it is active."""
+
+    def __init__(self):
+        self.queries = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self.statements = []
+
+    def add(self, statement, seconds, rows):
+        self.queries += 1
+        self.rows += rows
+        self.seconds += seconds
+        self.statements.append((statement, seconds))
+
+    def fingerprints(self):
+        """[(fingerprint, times run, total seconds)], slowest first."""
+
+        grouped = defaultdict(lambda: [0, 0.0])
+        for statement, seconds in self.statements:
+            totals = grouped[fingerprint(statement)]
+            totals[0] += 1
+            totals[1] += seconds
+
+        return sorted(((statement, count, seconds)
+                       for statement, (count, seconds) in grouped.items()),
+                      key=lambda row: row[2], reverse=True)
+
+
+def start_log():
+    """A new QueryLog, collecting this thread's statements until `stop_log`."""
+
+    log = QueryLog()
+    _active.__dict__.setdefault('logs', []).append(log)
+    return log
+
+
+def stop_log(log):
+    _active.logs.remove(log)
+
+
+@contextmanager
+def count_queries():
+    """Collect the statements this thread runs inside the block."""
+
+    log = start_log()
+    try:
+        yield log
+    finally:
+        stop_log(log)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if getattr(_active, 'logs', None):
+        conn.info.setdefault('query_start', []).append(perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    logs = getattr(_active, 'logs', None)
+    if not logs or not conn.info.get('query_start'):
+        return
+
+    seconds = perf_counter() - conn.info['query_start'].pop()
+    rows = max(cursor.rowcount, 0) if cursor.description else 0
+
+    for log in logs:
+        log.add(statement, seconds, rows)
+
+
+@event.listens_for(Engine, 'handle_error')
+def handle_error(context):
+    # after_cursor_execute won't run for a statement that failed.
+    if context.connection is not None and context.connection.info.get('query_start'):
+        context.connection.info['query_start'].pop()
+
+
+def fingerprint(statement):
+    """`statement` with literals and parameters replaced by ?, so runs of
+    the same query look the same whatever values they were given.
+    """
+
+    statement = re.sub(r"'(?:[^']|'')*'", "?", statement)
+    statement = re.sub(r"%\(\w+\)s|%s|\?|\b\d+\b", "?", statement)
+    statement = re.sub(r"\bIN \(\?(?:, \?)*\)", "IN (?, ...)", statement)
+    return " ".join(statement.split())
+
+
+##############################################################################
+# Per-route totals
+
+
+RouteStats = namedtuple('RouteStats', 'requests seconds queries rows db_seconds')
+
+
+class SQLStats:
+    """Map of route (endpoint) -> RouteStats, for every request so far."""
+
+    def __init__(self):
+        self.totals = {}
+        self.lock = Lock()
+
+    def record(self, route, seconds, log):
+        with self.lock:
+            totals = self.totals.get(route, RouteStats(0, 0.0, 0, 0, 0.0))
+            self.totals[route] = RouteStats(totals.requests + 1,
+                                            totals.seconds + seconds,
+                                            totals.queries + log.queries,
+                                            totals.rows + log.rows,
+                                            totals.db_seconds + log.seconds)
+
+    def routes(self):
+        with self.lock:
+            return dict(self.totals)
+
+    def clear(self):
+        with self.lock:
+            self.totals.clear()
+
+
+sql_stats = SQLStats()
+
+
+def configure_sql_stats(app):
+    """Count every request's statements, and log slow requests."""
+
+    @app.before_request
+    def start_query_log():
+        g.query_log = start_log()
+        g.request_start = perf_counter()
+
+    @app.after_request
+    def add_server_timing(response):
+        log = g.get('query_log')
+        if log and (app.debug or app.config['SERVER_TIMING']):
+            response.headers.add(
+                'Server-Timing',
+                f'db;dur={log.seconds * 1000:.1f};desc="{log.queries} queries, {log.rows} rows"')
+        return response
+
+    @app.teardown_request
+    def finish_query_log(exc):
+        log = g.pop('query_log', None)
+        if not log:
+            return
+
+        stop_log(log)
+        seconds = perf_counter() - g.pop('request_start')
+
+        sql_stats.record(request.endpoint or 'unmatched', seconds, log)
+
+        if seconds * 1000 >= app.config['SLOW_REQUEST_MS']:
+            app.logger.warning(slow_request_report(seconds, log))
+
+
+def slow_request_report(seconds, log, limit=10):
+    lines = [f"slow request: {request.method} {request.full_path.rstrip('?')} "
+             f"({request.endpoint}) took {seconds * 1000:.0f}ms; {log.queries} queries, "
+             f"{log.rows} rows, {log.seconds * 1000:.0f}ms in the database"]
+
+    for statement, count, total in log.fingerprints()[:limit]:
+        lines.append(f"  {count:>4} x {total * 1000:>8.1f}ms  {statement}")
+
+    return "\n".join(lines)
+
+
+@contextmanager
+def assert_max_queries(budget):
+    """Fail (AssertionError) if the block runs more than `budget` statements."""
+
+    with count_queries() as log:
+        yield log
+
+    if log.queries > budget:
+        raise AssertionError(
+            f"{log.queries} queries run, over the budget of {budget}:\n" +
+            "\n".join(f"  {count:>4} x  {statement}"
+                      for statement, count, _ in log.fingerprints()))
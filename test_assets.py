@@ -0,0 +1,176 @@
+"""Built static asset tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_assets.py
+
+
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import time
+from os import path
+from unittest import TestCase
+
+from models import db
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+from assets import build_assets, hashed_name, prune_assets
+
+db.create_all()
+
+
+class AssetsTestCase(TestCase):
+    """Test building assets and serving their precompressed variants."""
+
+    def setUp(self):
+        self.static = tempfile.mkdtemp()
+        os.makedirs(path.join(self.static, 'images'))
+        with open(path.join(self.static, 'images', 'logo.png'), 'wb') as image:
+            image.write(b'\x89PNG not really' * 20)
+        with open(path.join(self.static, 'style.css'), 'w') as css:
+            css.write('body { background: url("/static/images/logo.png"); }\n' * 50)
+
+        self.out = path.join(self.static, 'dist')
+        self.manifest = build_assets(self.static, self.out, out=lambda line: None)
+
+        self.old_dir = app.config['ASSETS_DIR']
+        app.config['ASSETS_DIR'] = self.out
+        app.extensions.pop('assets', None)
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['ASSETS_DIR'] = self.old_dir
+        app.extensions.pop('assets', None)
+        shutil.rmtree(self.static)
+
+    def test_manifest(self):
+        """Each file gets a hashed copy; stylesheets point at hashed images."""
+
+        with open(path.join(self.out, 'manifest.json')) as manifest:
+            self.assertEqual(json.load(manifest), self.manifest)
+
+        logo = self.manifest['images/logo.png']
+        self.assertRegex(logo['path'], r'^images/logo\.[0-9a-f]{12}\.png$')
+        self.assertEqual(logo['encodings'], [])
+
+        style = self.manifest['style.css']
+        self.assertIn('gzip', style['encodings'])
+        with open(path.join(self.out, style['path']), 'rb') as css:
+            contents = css.read()
+        self.assertEqual(style['path'], hashed_name('style.css', contents))
+        self.assertIn(f'url("/assets/{logo["path"]}")'.encode(), contents)
+        self.assertNotIn(b'/static/', contents)
+
+        self.assertFalse(any(name.startswith('dist') for name in self.manifest))
+
+    def test_serves_gzip(self):
+        """A browser that takes gzip gets the gzip file, cached for good."""
+
+        style = self.manifest['style.css']
+        resp = self.client.get(f"/assets/{style['path']}",
+                               headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.mimetype, 'text/css')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+
+        with open(path.join(self.out, style['path']), 'rb') as css:
+            self.assertEqual(gzip.decompress(resp.data), css.read())
+
+    def test_serves_identity(self):
+        """Without Accept-Encoding the file goes out as is."""
+
+        style = self.manifest['style.css']
+        resp = self.client.get(f"/assets/{style['path']}")
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertIn(b'background', resp.data)
+
+    def test_unknown_asset(self):
+        """Only files in the manifest are served."""
+
+        resp = self.client.get("/assets/manifest.json")
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(resp.headers['Cache-Control'], 'no-store')
+
+        resp = self.client.get("/assets/style.css")
+        self.assertEqual(resp.status_code, 404)
+
+    def test_pages_link_built_assets(self):
+        """Pages link to assets through the manifest, or to static/ without one."""
+
+        app.config['ASSETS_DIR'] = self.out
+        with open(path.join(self.out, 'manifest.json'), 'w') as manifest:
+            json.dump({'stylesheets/style.css': {'path': 'stylesheets/style.abc.css',
+                                                 'encodings': ['gzip']}}, manifest)
+        app.extensions.pop('assets', None)
+
+        resp = self.client.get("/signup")
+        self.assertIn(b'href="/assets/stylesheets/style.abc.css"', resp.data)
+        self.assertIn(b'/static/favicon.ico?v=', resp.data)
+
+    def test_rebuild_keeps_old_files(self):
+        """Workers and pages still on the old manifest can fetch its files."""
+
+        # This process loads the manifest before the rebuild.
+        old = self.manifest['style.css']['path']
+        self.assertEqual(self.client.get(f"/assets/{old}").status_code, 200)
+
+        with open(path.join(self.static, 'style.css'), 'a') as css:
+            css.write('p { color: blue; }\n')
+        manifest = build_assets(self.static, self.out, out=lambda line: None)
+
+        self.assertNotEqual(manifest['style.css']['path'], old)
+        with open(path.join(self.out, 'manifest.json')) as manifest_file:
+            self.assertEqual(json.load(manifest_file), manifest)
+
+        resp = self.client.get(f"/assets/{old}")
+        self.assertEqual(resp.status_code, 200)
+
+    def test_prune(self):
+        """Pruning deletes only files the manifest doesn't use, once they're old."""
+
+        old = self.manifest['style.css']['path']
+        with open(path.join(self.static, 'style.css'), 'a') as css:
+            css.write('p { color: blue; }\n')
+        manifest = build_assets(self.static, self.out, out=lambda line: None)
+
+        quiet = lambda line: None
+        self.assertEqual(prune_assets(self.out, 60, out=quiet), 0)
+
+        # Pretend both builds ran a day ago.
+        day_ago = time.time() - 24 * 60 * 60
+        for root, dirs, files in os.walk(self.out):
+            for name in files:
+                os.utime(path.join(root, name), (day_ago, day_ago))
+
+        self.assertEqual(prune_assets(self.out, 60, out=quiet), 2)
+        self.assertFalse(path.exists(path.join(self.out, old)))
+        self.assertFalse(path.exists(path.join(self.out, old + '.gz')))
+        for entry in manifest.values():
+            self.assertTrue(path.exists(path.join(self.out, entry['path'])))
+        self.assertTrue(path.exists(path.join(self.out, 'manifest.json')))
+
+    def test_missing_file(self):
+        """A manifest entry whose file has gone answers 404, not 500."""
+
+        logo = self.manifest['images/logo.png']['path']
+        os.remove(path.join(self.out, logo))
+
+        resp = self.client.get(f"/assets/{logo}")
+        self.assertEqual(resp.status_code, 404)
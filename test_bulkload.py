@@ -0,0 +1,113 @@
+"""CSV bulk loader tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_bulkload.py
+
+
+import csv
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+from bulkload import load_csvs
+from snowflakes import timestamp_of
+
+db.create_all()
+
+USERS = [
+    ['email', 'username', 'image_url', 'header_image_url', 'bio', 'location', 'password'],
+] + [[f"user{i}@test.com", f"user{i}", "/static/images/default-pic.png",
+      "/static/images/warbler-hero.jpg", "A bio, with \"quotes\"", "Nowhere",
+      "HASHED_PASSWORD"] for i in range(1, 6)]
+
+MESSAGES = [
+    ['text', 'timestamp', 'user_id'],
+] + [[f"message {i}", f"2017-01-0{i} 12:00:00.000000", i] for i in range(1, 6)]
+
+FOLLOWS = [
+    ['user_being_followed_id', 'user_following_id'],
+] + [[i, j] for i in range(1, 6) for j in range(1, 6) if i != j]
+
+
+class BulkLoadTestCase(TestCase):
+    """Test loading the generator's CSVs."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.dir = tempfile.TemporaryDirectory()
+        for filename, rows in [('users.csv', USERS), ('messages.csv', MESSAGES),
+                               ('follows.csv', FOLLOWS)]:
+            with open(os.path.join(self.dir.name, filename), 'w', newline='') as f:
+                csv.writer(f).writerows(rows)
+
+    def tearDown(self):
+        res = super().tearDown()
+        self.dir.cleanup()
+        db.session.rollback()
+        return res
+
+    def load(self, chunk_rows=2):
+        self.output = []
+        return load_csvs(self.dir.name, chunk_rows, out=self.output.append)
+
+    def test_load_csvs(self):
+        loaded = self.load()
+
+        self.assertEqual(loaded, {'users': 5, 'messages': 5, 'follows': 20})
+        self.assertIn("users: 4 rows", " ".join(self.output))
+
+        self.assertEqual(User.query.count(), 5)
+        self.assertEqual(User.query.get(3).bio, 'A bio, with "quotes"')
+        self.assertEqual(Follows.query.count(), 20)
+
+        messages = Message.query.order_by(Message.id).all()
+        self.assertEqual([m.text for m in messages],
+                         [f"message {i}" for i in range(1, 6)])
+        for message in messages:
+            self.assertEqual(timestamp_of(message.id), message.timestamp)
+
+    def test_indexes_rebuilt(self):
+        before = db.session.execute("SELECT indexdef FROM pg_indexes "
+                                    "ORDER BY indexname").fetchall()
+        db.session.commit()
+
+        self.load()
+
+        after = db.session.execute("SELECT indexdef FROM pg_indexes "
+                                   "ORDER BY indexname").fetchall()
+        self.assertEqual(before, after)
+        self.assertTrue(any(line.startswith("rebuilt ix_messages_user_id_id")
+                            for line in self.output))
+
+    def test_sequences_moved_past_loaded_rows(self):
+        self.load()
+
+        user = User.signup("newcomer", "newcomer@test.com", "password", None)
+        db.session.commit()
+        self.assertEqual(user.id, 6)
+
+    def test_failed_load_changes_nothing(self):
+        with open(os.path.join(self.dir.name, 'follows.csv'), 'a', newline='') as f:
+            csv.writer(f).writerow([1, 99])
+
+        with self.assertRaises(Exception):
+            self.load()
+
+        self.assertEqual(User.query.count(), 0)
+        self.assertEqual(Message.query.count(), 0)
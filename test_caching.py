@@ -0,0 +1,212 @@
+"""HTTP caching tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_caching.py
+
+
+import os
+import re
+import tempfile
+from os import path
+from unittest import TestCase
+
+from flask import Flask
+
+from models import db, User, Message
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from caching import page_version
+from sqlstats import count_queries
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class CachingTestCase(TestCase):
+    """Test ETags, 304s and Cache-Control per route."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        db.session.add_all([User(id=id, username=f"user{id}", email=f"user{id}@test.com",
+                                 password="HASHED_PASSWORD")
+                            for id in (1, 2, 3)])
+        db.session.commit()
+
+        db.session.add_all([Message(id=10, text="hello", user_id=2),
+                            Message(id=11, text="again", user_id=2)])
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        res = super().tearDown()
+        db.session.rollback()
+        return res
+
+    def get(self, url, user_id=1, etag=None):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                if user_id:
+                    sess[CURR_USER_KEY] = user_id
+                else:
+                    sess.pop(CURR_USER_KEY, None)
+
+            headers = {"If-None-Match": etag} if etag else {}
+            return c.get(url, headers=headers)
+
+    def post(self, url, user_id=1):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            c.post(url, headers={"Accept": "application/json"})
+
+    def assert_revalidates(self, url, user_id=1):
+        """`url` has an ETag and answers 304 to it; returns the ETag."""
+
+        resp = self.get(url, user_id)
+        self.assertEqual(resp.status_code, 200)
+        etag = resp.headers['ETag']
+        self.assertTrue(etag.startswith('W/"'))
+
+        resp = self.get(url, user_id, etag)
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b"")
+        self.assertEqual(resp.headers['ETag'], etag)
+
+        return etag
+
+    def test_profile_page(self):
+        etag = self.assert_revalidates("/users/2")
+
+        resp = self.get("/users/2", etag=etag)
+        self.assertEqual(resp.headers['Cache-Control'], "private, no-cache")
+        self.assertIn("Cookie", resp.headers['Vary'])
+
+        # Someone else likes a message on the page.
+        self.post("/messages/11/like", user_id=3)
+        self.assertEqual(self.get("/users/2", etag=etag).status_code, 200)
+        etag = self.assert_revalidates("/users/2")
+
+        # The viewer follows the user.
+        self.post("/users/follow/2")
+        self.assertEqual(self.get("/users/2", etag=etag).status_code, 200)
+        etag = self.assert_revalidates("/users/2")
+
+        # A new message.
+        db.session.add(Message(id=12, text="news", user_id=2))
+        db.session.commit()
+        self.assertEqual(self.get("/users/2", etag=etag).status_code, 200)
+
+    def test_not_modified_skips_page_queries(self):
+        """A 304 is answered before the page's messages are loaded."""
+
+        etag = self.assert_revalidates("/users/2")
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            with count_queries() as not_modified:
+                self.assertEqual(c.get("/users/2", headers={"If-None-Match": etag})
+                                 .status_code, 304)
+            with count_queries() as modified:
+                self.assertEqual(c.get("/users/2").status_code, 200)
+
+        self.assertLess(not_modified.queries, modified.queries)
+        self.assertFalse(any("messages.text" in statement
+                             for statement, _ in not_modified.statements))
+
+    def test_static_changes_change_etags(self):
+        """A deploy that only changes static files still changes every ETag."""
+
+        etag = self.assert_revalidates("/users/2")
+
+        old_version = app.extensions['page_version']
+        try:
+            app.extensions['page_version'] = "a new stylesheet"
+            self.assertEqual(self.get("/users/2", etag=etag).status_code, 200)
+        finally:
+            app.extensions['page_version'] = old_version
+
+    def test_page_version(self):
+        """The page version covers static files and the assets manifest."""
+
+        with tempfile.TemporaryDirectory() as static:
+            site = Flask(__name__, static_folder=static)
+            site.config['ASSETS_DIR'] = path.join(static, 'dist')
+            stylesheet = path.join(static, 'style.css')
+
+            with open(stylesheet, 'w') as css:
+                css.write("body { color: black; }")
+            first = page_version(site)
+
+            with open(stylesheet, 'w') as css:
+                css.write("body { color: blue; }")
+            second = page_version(site)
+
+            os.makedirs(site.config['ASSETS_DIR'])
+            with open(path.join(site.config['ASSETS_DIR'], 'manifest.json'), 'w') as manifest:
+                manifest.write("{}")
+            third = page_version(site)
+
+        self.assertEqual(len({first, second, third}), 3)
+
+    def test_pages_differ_by_viewer(self):
+        etag = self.assert_revalidates("/users/2", user_id=1)
+        self.assertEqual(self.get("/users/2", user_id=3, etag=etag).status_code, 200)
+
+    def test_message_page(self):
+        etag = self.assert_revalidates("/messages/10")
+
+        self.post("/messages/10/like")
+        resp = self.get("/messages/10", etag=etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("btn-primary", str(resp.data))
+
+    def test_anonymous_home_page(self):
+        self.assert_revalidates("/", user_id=None)
+        resp = self.get("/", user_id=None)
+        self.assertEqual(resp.headers['Cache-Control'], "public, no-cache")
+
+    def test_other_pages_not_stored(self):
+        resp = self.get("/users")
+        self.assertEqual(resp.headers['Cache-Control'], "no-store")
+        self.assertNotIn('ETag', resp.headers)
+
+    def test_no_etag_with_flashes_pending(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['_flashes'] = [('success', "Welcome back!")]
+
+            resp = c.get("/")
+            self.assertIn("Welcome back!", str(resp.data))
+            self.assertNotIn('ETag', resp.headers)
+
+    def test_static_files(self):
+        page = str(self.get("/users/2").data)
+        url = re.search(r'href="(/static/stylesheets/style.css\?v=\w+)"', page).group(1)
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Cache-Control'], "public, max-age=31536000, immutable")
+
+        resp = self.client.get("/static/stylesheets/style.css")
+        self.assertEqual(resp.headers['Cache-Control'], "public, no-cache")
+
+        resp = self.client.get("/static/stylesheets/missing.css?v=abc123")
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(resp.headers['Cache-Control'], "no-store")
@@ -6,6 +6,7 @@
 
 
 import os
+from datetime import datetime
 from unittest import TestCase
 from sqlalchemy import exc
 
@@ -108,4 +109,48 @@ class   MessageModelTestCase(TestCase):
         self.assertEqual(len(l), 1)
         self.assertEqual(l[0].message_id, m1.id)
 
-    
\ No newline at end of file
+    
+    def test_message_liked_by_many(self):
+        """This test method confirms that more than one user can like
+           the same message, and that each user can like it only once.
+        """
+
+        m = Message(text="popular warble", user_id=self.uid)
+        u1 = User.signup("fan1", "fan1@test.com", "passWord4fan1", None)
+        u2 = User.signup("fan2", "fan2@test.com", "passWord4fan2", None)
+
+        db.session.add(m)
+        db.session.commit()
+
+        db.session.add_all([Likes(user_id=u1.id, message_id=m.id),
+                            Likes(user_id=u2.id, message_id=m.id)])
+        db.session.commit()
+
+        self.assertEqual(Likes.query.filter(Likes.message_id == m.id).count(), 2)
+
+        db.session.add(Likes(user_id=u1.id, message_id=m.id))
+        with self.assertRaises(exc.IntegrityError):
+            db.session.commit()
+
+    def test_message_ids_and_timestamps(self):
+        """This test method confirms that each message gets its own
+           time-ordered id and the timestamp it was inserted at.
+        """
+
+        m1 = Message(text="first warble", user_id=self.uid)
+        db.session.add(m1)
+        db.session.commit()
+
+        m2 = Message(text="second warble", user_id=self.uid)
+        db.session.add(m2)
+        db.session.commit()
+
+        old = Message(text="old warble", user_id=self.uid,
+                      timestamp=datetime(2017, 1, 21, 11, 4, 53))
+        db.session.add(old)
+        db.session.commit()
+
+        self.assertLess(m1.id, m2.id)
+        self.assertLess(m1.timestamp, m2.timestamp)
+        self.assertLess(old.id, m1.id)
+        self.assertEqual(old.timestamp, datetime(2017, 1, 21, 11, 4, 53))
@@ -0,0 +1,140 @@
+"""Prometheus metrics tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_metrics.py
+
+
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from metrics import (metrics, collect, render, write_snapshot, snapshot_path,
+                     TimedQueuePool)
+
+db.create_all()
+
+# A pid no process will have.
+GONE_PID = 4194305
+
+
+class MetricsTestCase(TestCase):
+    """Test recording requests and serving /metrics."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        db.session.add(User(id=1, username="user1", email="user1@test.com",
+                            password="HASHED_PASSWORD"))
+        db.session.commit()
+
+        self.client = app.test_client()
+        metrics.clear()
+
+    def tearDown(self):
+        res = super().tearDown()
+        db.session.rollback()
+        return res
+
+    def scrape(self):
+        resp = self.client.get("/metrics")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("text/plain; version=0.0.4", resp.content_type)
+        return resp.get_data(as_text=True).splitlines()
+
+    def test_request_metrics(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            c.get("/users/1")
+            c.get("/users/1")
+            c.get("/users/999")
+
+        lines = self.scrape()
+
+        self.assertIn('warbler_requests_total{route="users_show",status="200"} 2', lines)
+        self.assertIn('warbler_requests_total{route="users_show",status="404"} 1', lines)
+        self.assertIn('warbler_request_duration_seconds_count{route="users_show"} 3', lines)
+        self.assertIn('warbler_request_duration_seconds_bucket{route="users_show",le="+Inf"} 3',
+                      lines)
+        self.assertIn('warbler_template_render_seconds_count{route="users_show"} 3', lines)
+        self.assertIn('warbler_db_seconds_count{route="users_show"} 3', lines)
+        self.assertIn('warbler_response_size_bytes_count{route="users_show"} 3', lines)
+        self.assertIn("# TYPE warbler_db_pool_checked_out gauge", lines)
+
+        # Buckets are cumulative.
+        buckets = [int(line.rsplit(" ", 1)[1]) for line in lines
+                   if line.startswith('warbler_request_duration_seconds_bucket{route="users_show"')]
+        self.assertEqual(buckets, sorted(buckets))
+
+    def test_pool_checkouts_timed(self):
+        """The app's engine uses the timed pool, so checkouts are observed."""
+
+        self.assertIsInstance(db.get_engine(app).pool, TimedQueuePool)
+
+        self.client.get("/users/1")
+        lines = self.scrape()
+
+        counts = [int(line.rsplit(" ", 1)[1]) for line in lines
+                  if line.startswith("warbler_db_pool_checkout_seconds_count ")]
+        self.assertEqual(len(counts), 1)
+        self.assertGreater(counts[0], 0)
+
+    def test_label_escaping(self):
+        metrics.inc('warbler_requests_total', (('route', 'say "hi"\\'),))
+
+        self.assertIn('warbler_requests_total{route="say \\"hi\\"\\\\"} 1',
+                      render(collect()).splitlines())
+
+
+class MultiprocessMetricsTestCase(TestCase):
+    """Test adding up the metrics of several worker processes."""
+
+    def setUp(self):
+        metrics.clear()
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        res = super().tearDown()
+        self.dir.cleanup()
+        return res
+
+    def test_processes_added_up(self):
+        metrics.inc('warbler_requests_total', (('route', 'homepage'), ('status', '200')), 2)
+        metrics.observe('warbler_db_seconds', (('route', 'homepage'),), 0.02)
+        metrics.set('warbler_db_pool_checked_out', (('pid', str(os.getpid())),), 1)
+        write_snapshot(self.dir.name)
+
+        # A worker that has since exited.
+        with open(snapshot_path(self.dir.name, GONE_PID), 'w') as snapshot:
+            json.dump([
+                ['warbler_requests_total', [['route', 'homepage'], ['status', '200']], 3],
+                ['warbler_db_seconds', [['route', 'homepage']],
+                 [0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0.015]],
+                ['warbler_db_pool_checked_out', [['pid', str(GONE_PID)]], 4],
+            ], snapshot)
+
+        lines = render(collect(self.dir.name)).splitlines()
+
+        self.assertIn('warbler_requests_total{route="homepage",status="200"} 5', lines)
+        self.assertIn('warbler_db_seconds_count{route="homepage"} 2', lines)
+        self.assertIn('warbler_db_seconds_bucket{route="homepage",le="0.025"} 2', lines)
+        self.assertIn('warbler_db_seconds_bucket{route="homepage",le="0.01"} 0', lines)
+        self.assertIn(f'warbler_db_pool_checked_out{{pid="{os.getpid()}"}} 1', lines)
+        self.assertFalse([line for line in lines if str(GONE_PID) in line])
@@ -0,0 +1,140 @@
+"""Schema migration tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_migrations.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Likes
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+from migrations import (migrate, check_indexes, build_index_pack, current_version,
+                        INDEX_PACK, LATEST_VERSION)
+
+# The schema as it was before migrations existed.
+ORIGINAL_SCHEMA = [
+    """CREATE TABLE users (
+       id SERIAL PRIMARY KEY,
+       email TEXT NOT NULL UNIQUE,
+       username TEXT NOT NULL UNIQUE,
+       image_url TEXT,
+       header_image_url TEXT,
+       bio TEXT,
+       location TEXT,
+       password TEXT NOT NULL)""",
+    """CREATE TABLE messages (
+       id SERIAL PRIMARY KEY,
+       text VARCHAR(140) NOT NULL,
+       timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+       user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE)""",
+    """CREATE TABLE follows (
+       user_being_followed_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+       user_following_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+       PRIMARY KEY (user_being_followed_id, user_following_id))""",
+    """CREATE TABLE likes (
+       id SERIAL PRIMARY KEY,
+       user_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+       message_id INTEGER UNIQUE REFERENCES messages (id) ON DELETE CASCADE)""",
+]
+
+
+def drop_everything():
+    db.session.remove()
+    db.engine.execute("DROP TABLE IF EXISTS schema_migrations, timeline_entries, "
+                      "likes, follows, messages, users CASCADE")
+
+
+class MigrationTestCase(TestCase):
+    """Test upgrading old and empty databases to the current schema."""
+
+    def setUp(self):
+        drop_everything()
+
+    def tearDown(self):
+        """Leave the usual test schema behind."""
+
+        res = super().tearDown()
+        drop_everything()
+        db.create_all()
+        return res
+
+    def test_empty_database(self):
+        """An empty database gets the current schema in one step."""
+
+        self.assertEqual(current_version(db.engine), 0)
+        self.assertEqual(migrate(), [])
+        self.assertEqual(current_version(db.engine), LATEST_VERSION)
+
+        self.assertEqual(check_indexes().missing, [])
+        self.assertEqual(migrate(), [])
+
+    def test_upgrade_original_schema(self):
+        """A database from before migrations is upgraded with its data."""
+
+        for statement in ORIGINAL_SCHEMA:
+            db.engine.execute(statement)
+        db.engine.execute("INSERT INTO users (id, email, username, password) "
+                          "VALUES (1, 'a@test.com', 'a', 'x'), (2, 'b@test.com', 'b', 'x')")
+        db.engine.execute("INSERT INTO messages (id, text, timestamp, user_id) "
+                          "VALUES (1, 'an old warble', now(), 1)")
+        db.engine.execute("INSERT INTO likes (user_id, message_id) VALUES (2, 1)")
+
+        self.assertEqual(current_version(db.engine), 1)
+        applied = migrate()
+
+        self.assertEqual([m.version for m in applied], list(range(2, LATEST_VERSION + 1)))
+        self.assertEqual(current_version(db.engine), LATEST_VERSION)
+        self.assertEqual(check_indexes().missing, [])
+
+        self.assertEqual(User.query.get(1).message_count, 1)
+        self.assertEqual(User.query.get(2).like_count, 1)
+        self.assertEqual(Message.query.get(1).like_count, 1)
+
+        # Likes are now keyed on (user_id, message_id), so user 1 can like
+        # a message user 2 already liked.
+        db.session.add(Likes(user_id=1, message_id=1))
+        db.session.commit()
+        self.assertEqual(Likes.query.count(), 2)
+
+        # New messages get snowflake ids, which sort after the old ids.
+        db.session.add(Message(text="a new warble", user_id=1))
+        db.session.commit()
+        self.assertEqual([m.text for m in Message.query.order_by(Message.id.desc())],
+                         ["a new warble", "an old warble"])
+
+    def test_check_indexes(self):
+        """Dropped and invalid pack indexes are reported."""
+
+        migrate()
+        db.engine.execute("DROP INDEX ix_messages_user_id_id")
+        db.engine.execute("UPDATE pg_index SET indisvalid = false "
+                          "WHERE indexrelid = 'ix_timeline_entries_message_id'::regclass")
+
+        report = check_indexes()
+        self.assertEqual(report.missing, ['ix_messages_user_id_id'])
+        self.assertEqual(report.invalid, ['ix_timeline_entries_message_id'])
+
+        build_index_pack()
+
+        report = check_indexes()
+        self.assertEqual((report.missing, report.invalid), ([], []))
+
+    def test_models_match_index_pack(self):
+        """Every secondary index the models declare is in the index pack."""
+
+        declared = {index.name for table in db.metadata.tables.values()
+                    for index in table.indexes}
+        self.assertLessEqual(declared, {name for name, _, _ in INDEX_PACK})
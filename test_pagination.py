@@ -0,0 +1,128 @@
+"""Cursor pagination tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_pagination.py
+
+
+import os
+import re
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class PaginationTestCase(TestCase):
+    """Test older-page links on message and user listings."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        db.drop_all()
+        db.create_all()
+
+        app.config['PAGE_SIZE'] = 2
+
+        self.client = app.test_client()
+
+        for id in range(1, 6):
+            user = User.signup(f"user{id}", f"user{id}@test.com", "password", None)
+            user.id = id
+        db.session.commit()
+
+        # Five messages by user 1, all written at the same time, so only
+        # the id tells them apart.
+        now = datetime.utcnow()
+        db.session.add_all([Message(id=id, text=f"warble number {id}", user_id=1, timestamp=now)
+                            for id in range(1, 6)])
+        db.session.commit()
+
+        db.session.add_all([Follows(user_being_followed_id=1, user_following_id=id)
+                            for id in range(2, 6)])
+        db.session.add_all([Likes(user_id=2, message_id=id) for id in range(1, 6)])
+        db.session.commit()
+
+    def tearDown(self):
+        """Clean up any fouled transactions."""
+
+        res = super().tearDown()
+        db.session.rollback()
+        app.config['PAGE_SIZE'] = 100
+        return res
+
+    def walk(self, c, url):
+        """Follow "Older" links from `url`, returning the text of every page."""
+
+        pages = []
+        while url:
+            resp = c.get(url)
+            self.assertEqual(resp.status_code, 200)
+            html = resp.data.decode('UTF-8')
+            pages.append(html)
+
+            found = re.search(r'href="([^"]*before=[^"]*)"', html)
+            url = found.group(1).replace('&amp;', '&') if found else None
+
+        return pages
+
+    def test_profile_pages(self):
+        """Profile messages come two at a time, newest first, without repeats."""
+
+        with self.client as c:
+            pages = self.walk(c, "/users/1")
+
+        self.assertEqual(len(pages), 3)
+        self.assertIn("warble number 5", pages[0])
+        self.assertIn("warble number 4", pages[0])
+        self.assertNotIn("warble number 3", pages[0])
+        self.assertIn("warble number 1", pages[2])
+        self.assertNotIn("Older", pages[2])
+
+    def test_home_pages(self):
+        """The home feed is paged the same way."""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 2
+            pages = self.walk(c, "/")
+
+        self.assertEqual(len(pages), 3)
+        self.assertIn("warble number 3", pages[1])
+
+    def test_likes_and_followers_pages(self):
+        """Likes and followers listings get older links too."""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 2
+
+            self.assertEqual(len(self.walk(c, "/users/2/likes")), 3)
+
+            followers = self.walk(c, "/users/1/followers")
+            self.assertEqual(len(followers), 2)
+            self.assertIn("@user5", followers[0])
+            self.assertIn("@user2", followers[1])
+
+    def test_bad_cursor(self):
+        """A cursor we didn't hand out is a bad request."""
+
+        with self.client as c:
+            resp = c.get("/users/1?before=not-a-cursor")
+
+        self.assertEqual(resp.status_code, 400)
@@ -0,0 +1,145 @@
+"""Password pool tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_passwords.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User
+from passwords import (PasswordPool, PasswordPoolFull, password_pool,
+                       log_rounds_of, calibrate_log_rounds)
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+from usercache import user_cache
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class PasswordPoolTestCase(TestCase):
+    """Test hashing in a process pool and its queue limit."""
+
+    def test_hash_and_check_in_pool(self):
+        """A pooled hash checks out, in the pool and inline."""
+
+        pool = PasswordPool(size=1, log_rounds=4)
+        try:
+            pw_hash = pool.hash("swordfish")
+
+            self.assertTrue(pw_hash.startswith("$2b$04$"))
+            self.assertTrue(pool.check(pw_hash, "swordfish"))
+            self.assertFalse(pool.check(pw_hash, "catfish"))
+            self.assertTrue(PasswordPool().check(pw_hash, "swordfish"))
+        finally:
+            pool.shutdown()
+
+    def test_broken_pool_is_replaced(self):
+        """A worker dying doesn't break the pool for good."""
+
+        pool = PasswordPool(size=1, log_rounds=4)
+        try:
+            pw_hash = pool.hash("swordfish")
+
+            for process in list(pool.executor._processes.values()):
+                process.kill()
+                process.join()
+
+            self.assertTrue(pool.check(pw_hash, "swordfish"))
+            self.assertTrue(pool.hash("catfish").startswith("$2b$04$"))
+        finally:
+            pool.shutdown()
+
+    def test_full_pool_fails_fast(self):
+        """Once every slot is taken, new jobs are refused rather than queued."""
+
+        pool = PasswordPool(size=1, queue_limit=1, log_rounds=4)
+        pool.slots.acquire()
+        pool.slots.acquire()
+
+        with self.assertRaises(PasswordPoolFull):
+            pool.hash("swordfish")
+
+    def test_empty_password(self):
+        with self.assertRaises(ValueError):
+            PasswordPool().hash("")
+
+    def test_needs_rehash(self):
+        pool = PasswordPool(log_rounds=5)
+
+        self.assertEqual(log_rounds_of(pool.hash("swordfish")), 5)
+        self.assertFalse(pool.needs_rehash(pool.hash("swordfish")))
+        self.assertTrue(pool.needs_rehash(PasswordPool(log_rounds=4).hash("swordfish")))
+
+    def test_calibrate(self):
+        """An impossible budget still gets the minimum cost."""
+
+        log_rounds, timings = calibrate_log_rounds(0, min_rounds=4, max_rounds=6)
+
+        self.assertEqual(log_rounds, 4)
+        self.assertEqual(list(timings), [4])
+
+
+class PasswordPoolViewTestCase(TestCase):
+    """Test that logins get a 503 when the pool is full."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        User.signup("busy", "busy@test.com", "password", None)
+        db.session.commit()
+
+    def tearDown(self):
+        """Clean up any fouled transactions and the pool."""
+
+        res = super().tearDown()
+        db.session.rollback()
+        password_pool.configure(0, 0, password_pool.log_rounds)
+        user_cache.clear()
+        return res
+
+    def test_login_rehashes_at_new_cost(self):
+        """Logging in upgrades a password hashed at an old cost."""
+
+        old_rounds = password_pool.log_rounds
+        password_pool.configure(0, 0, 4)
+        try:
+            user = User.query.filter_by(username="busy").one()
+            user_cache.put(user, 60)
+
+            with self.client as c:
+                c.post("/login", data={"username": "busy", "password": "password"})
+
+            user = User.query.filter_by(username="busy").one()
+            self.assertEqual(log_rounds_of(user.password), 4)
+            self.assertIsNone(user_cache.get(user.id))
+            self.assertIsNotNone(User.authenticate("busy", "password"))
+        finally:
+            password_pool.configure(0, 0, old_rounds)
+
+    def test_login_when_pool_full(self):
+        password_pool.configure(1, 0, password_pool.log_rounds)
+        password_pool.slots.acquire()
+
+        with self.client as c:
+            resp = c.post("/login", data={"username": "busy", "password": "password"})
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers["Retry-After"], "1")
@@ -0,0 +1,123 @@
+"""Sampling profiler tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_profiler.py
+
+
+import os
+from threading import Thread
+from time import monotonic, sleep
+from unittest import TestCase
+
+from models import db, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from profiler import profiler, Profile
+
+db.create_all()
+
+AUTH = {"Authorization": "Bearer sesame"}
+
+
+def spin_in_homepage(seconds):
+    """Stands in for a thread busy serving the homepage."""
+
+    profiler.request_started('homepage')
+    deadline = monotonic() + seconds
+    while monotonic() < deadline:
+        pass
+    profiler.request_finished()
+
+
+class ProfilerTestCase(TestCase):
+    """Test sampling request threads through /_profile."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        db.session.add(User(id=1, username="user1", email="user1@test.com",
+                            password="HASHED_PASSWORD"))
+        db.session.commit()
+
+        self.client = app.test_client()
+        app.config['PROFILER_TOKEN'] = "sesame"
+
+    def tearDown(self):
+        res = super().tearDown()
+        db.session.rollback()
+        app.config['PROFILER_TOKEN'] = None
+        return res
+
+    def test_off_without_token(self):
+        app.config['PROFILER_TOKEN'] = None
+        self.assertEqual(self.client.get("/_profile?seconds=0", headers=AUTH).status_code, 404)
+
+    def test_wrong_token(self):
+        resp = self.client.get("/_profile?seconds=0",
+                               headers={"Authorization": "Bearer guess"})
+        self.assertEqual(resp.status_code, 403)
+        self.assertEqual(self.client.get("/_profile?seconds=0").status_code, 403)
+
+    def test_profile_for_seconds(self):
+        busy = Thread(target=spin_in_homepage, args=(1,))
+        busy.start()
+        resp = self.client.get("/_profile?seconds=0.3&rate=200", headers=AUTH)
+        busy.join()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertGreater(int(resp.headers['X-Profile-Samples']), 10)
+
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            stack, count = line.rsplit(" ", 1)
+            self.assertTrue(stack.startswith("homepage;"))
+            self.assertIn("test_profiler.py:spin_in_homepage", stack)
+            self.assertGreater(int(count), 0)
+
+    def test_profile_next_requests(self):
+        def browse():
+            sleep(0.2)
+            with app.test_client() as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = 1
+                c.get("/users")
+                c.get("/users/1")
+                c.get("/users")
+
+        browser = Thread(target=browse)
+        browser.start()
+
+        start = monotonic()
+        resp = self.client.get("/_profile?seconds=10&rate=1000&route=list_users&requests=2",
+                               headers=AUTH)
+        browser.join()
+
+        self.assertLess(monotonic() - start, 5)
+
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            self.assertTrue(line.startswith("list_users;"))
+            self.assertIn("app.py:list_users", line)
+
+    def test_one_profile_at_a_time(self):
+        profiler.profile = Profile(100)
+        try:
+            resp = self.client.get("/_profile?seconds=0", headers=AUTH)
+        finally:
+            profiler.profile = None
+
+        self.assertEqual(resp.status_code, 409)
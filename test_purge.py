@@ -0,0 +1,166 @@
+"""Account deletion and background purge tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_purge.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, TimelineEntry
+from counters import reconcile_counters
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from purge import purge_deleted_users, purge_user
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class Crash(Exception):
+    """Stands in for the purge job dying part way through."""
+
+
+class PurgeTestCase(TestCase):
+    """Test that deleted accounts vanish at once and are purged in batches."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        db.drop_all()
+        db.create_all()
+
+        app.config['TIMELINE_BACKEND'] = 'sql'
+        app.extensions.pop('timelines', None)
+
+        self.client = app.test_client()
+
+        for id, username in [(1, "leaving"), (2, "friend"), (3, "fan")]:
+            user = User.signup(username, f"{username}@test.com", "password", None)
+            user.id = id
+        db.session.commit()
+
+        db.session.add_all([Message(id=id, text=f"goodbye {id}", user_id=1)
+                            for id in range(1, 6)] +
+                           [Message(id=10, text="still here", user_id=2)])
+        db.session.commit()
+
+        db.session.add_all([
+            Follows(user_being_followed_id=2, user_following_id=1),
+            Follows(user_being_followed_id=1, user_following_id=2),
+            Follows(user_being_followed_id=1, user_following_id=3),
+            Likes(user_id=1, message_id=10),
+            Likes(user_id=3, message_id=10),
+        ] + [Likes(user_id=liker, message_id=id)
+             for id in range(1, 6) for liker in (2, 3)] +
+            [TimelineEntry(user_id=reader, message_id=id, author_id=1)
+             for id in range(1, 6) for reader in (1, 2, 3)])
+        db.session.commit()
+
+        reconcile_counters()
+        db.session.commit()
+
+    def tearDown(self):
+        """Clean up any fouled transactions and turn timelines back off."""
+
+        res = super().tearDown()
+        db.session.rollback()
+        app.config['TIMELINE_BACKEND'] = None
+        app.extensions.pop('timelines', None)
+        return res
+
+    def delete_account(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+            c.post("/users/delete")
+
+    def assert_purged(self):
+        """User 1's rows are gone and everyone else's counters add up."""
+
+        self.assertIsNone(User.query.get(1))
+        self.assertEqual(Message.query.filter_by(user_id=1).count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(Likes.query.count(), 1)
+        self.assertEqual(TimelineEntry.query.count(), 0)
+
+        counters = [(u.id, u.message_count, u.follower_count, u.following_count,
+                     u.like_count) for u in User.query.order_by(User.id)]
+        likes = Message.query.get(10).like_count
+
+        reconcile_counters()
+        db.session.commit()
+
+        self.assertEqual(counters,
+                         [(u.id, u.message_count, u.follower_count, u.following_count,
+                           u.like_count) for u in User.query.order_by(User.id)])
+        self.assertEqual(likes, Message.query.get(10).like_count)
+        self.assertEqual(likes, 1)
+
+    def test_deleted_account_is_hidden(self):
+        """The account disappears at once, though its rows are still there."""
+
+        self.delete_account()
+
+        self.assertIsNotNone(User.query.get(1).deleted_at)
+        self.assertEqual(Message.query.filter_by(user_id=1).count(), 5)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 2
+
+            resp = c.get("/users")
+            self.assertNotIn("@leaving", str(resp.data))
+            self.assertIn("@friend", str(resp.data))
+
+            self.assertEqual(c.get("/users/1").status_code, 404)
+            self.assertEqual(c.get("/messages/1").status_code, 404)
+            self.assertNotIn("goodbye", str(c.get("/").data))
+            self.assertNotIn("@leaving", str(c.get("/users/2/followers").data))
+
+            resp = c.post("/login", data={"username": "leaving", "password": "password"})
+            self.assertIn("Invalid credentials", str(resp.data))
+
+    def test_purge_in_batches(self):
+        self.delete_account()
+
+        progress = []
+        with app.app_context():
+            purged = purge_deleted_users(batch_size=2,
+                                         progress=lambda *args: progress.append(args))
+
+        self.assertEqual(purged, [1])
+        self.assertIn((1, 'messages', 4), progress)
+        self.assertIn((1, 'messages', 5), progress)
+        self.assert_purged()
+
+    def test_purge_resumes_after_crash(self):
+        self.delete_account()
+
+        def crash(user_id, step, total):
+            if step == 'likes received':
+                raise Crash()
+
+        with app.app_context():
+            with self.assertRaises(Crash):
+                purge_user(1, batch_size=3, progress=crash)
+
+        # The batches committed before the crash stay done.
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertIsNotNone(User.query.get(1))
+
+        with app.app_context():
+            purge_deleted_users(batch_size=3)
+
+        self.assert_purged()
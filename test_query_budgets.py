@@ -0,0 +1,301 @@
+"""Query budget tests: each view runs a fixed number of SQL statements,
+however many rows it shows."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_query_budgets.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+from counters import reconcile_counters
+from passwords import password_pool
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from search import reindex_messages
+from sqlstats import assert_max_queries, count_queries, fingerprint, sql_stats
+from usercache import user_cache
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+NUM_USERS = 20
+MESSAGES_PER_USER = 3
+
+# Most statements each view may run, however many rows it shows.
+QUERY_BUDGETS = {
+    'homepage': 5,
+    'list_users': 3,
+    'search_users': 3,
+    'users_show': 5,
+    'show_following': 5,
+    'users_followers': 5,
+    'show_likes': 5,
+    'messages_show': 5,
+    'messages_search': 5,
+    'like_message': 7,
+    'messages_add': 7,
+    'add_follow': 7,
+    'stop_following': 7,
+    'static': 0,
+}
+
+
+class QueryBudgetTestCase(TestCase):
+    """Test that no view's query count grows with the rows it shows."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        # Nobody logs in with a password, so skip bcrypt.
+        db.session.add_all([User(id=id, username=f"user{id}", email=f"user{id}@test.com",
+                                 password="HASHED_PASSWORD")
+                            for id in range(1, NUM_USERS + 1)])
+        db.session.commit()
+
+        db.session.add_all([Message(id=user_id * 100 + n, text=f"bird song {n}", user_id=user_id)
+                            for user_id in range(1, NUM_USERS + 1)
+                            for n in range(MESSAGES_PER_USER)])
+        db.session.commit()
+
+        db.session.add_all(
+            [Follows(user_being_followed_id=id, user_following_id=1)
+             for id in range(2, NUM_USERS + 1)] +
+            [Follows(user_being_followed_id=1, user_following_id=id)
+             for id in range(2, NUM_USERS + 1)] +
+            [Likes(user_id=1, message_id=user_id * 100)
+             for user_id in range(2, NUM_USERS + 1)])
+        db.session.commit()
+
+        reconcile_counters()
+        with app.app_context():
+            reindex_messages()
+            db.session.commit()
+
+    def tearDown(self):
+        res = super().tearDown()
+        db.session.rollback()
+        return res
+
+    def assertBudget(self, route, method, url, shows=None, **kwargs):
+        """Request `url` as user 1 within `route`'s budget; `shows` is
+        text the page must contain, to be sure it listed its rows.
+        """
+
+        # Start from an empty identity map, the way a real request would.
+        db.session.remove()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            with assert_max_queries(QUERY_BUDGETS[route]) as log:
+                resp = c.open(url, method=method, **kwargs)
+
+            self.assertLess(resp.status_code, 400)
+            if shows:
+                self.assertIn(shows, str(resp.data))
+            return log
+
+    def test_homepage(self):
+        self.assertBudget('homepage', 'GET', "/", shows=f"@user{NUM_USERS}")
+
+    def test_homepage_timeline(self):
+        app.config['TIMELINE_BACKEND'] = 'memory'
+        try:
+            app.extensions.pop('timelines', None)
+
+            # The first read builds the cold timeline; budget the warm one.
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = 1
+                c.get("/")
+
+            self.assertBudget('homepage', 'GET', "/", shows=f"@user{NUM_USERS}")
+        finally:
+            app.config['TIMELINE_BACKEND'] = None
+            app.extensions.pop('timelines', None)
+
+    def test_list_users(self):
+        self.assertBudget('list_users', 'GET', "/users", shows=f"@user{NUM_USERS}")
+
+    def test_search_users(self):
+        self.assertBudget('search_users', 'GET', "/users?q=user", shows=f"@user{NUM_USERS}")
+
+    def test_users_show(self):
+        self.assertBudget('users_show', 'GET', "/users/1")
+
+    def test_show_following(self):
+        self.assertBudget('show_following', 'GET', "/users/1/following",
+                          shows=f"@user{NUM_USERS}")
+
+    def test_users_followers(self):
+        self.assertBudget('users_followers', 'GET', "/users/1/followers",
+                          shows=f"@user{NUM_USERS}")
+
+    def test_show_likes(self):
+        self.assertBudget('show_likes', 'GET', "/users/1/likes", shows=f"@user{NUM_USERS}")
+
+    def test_messages_show(self):
+        self.assertBudget('messages_show', 'GET', "/messages/200")
+
+    def test_messages_search(self):
+        self.assertBudget('messages_search', 'GET', "/messages/search?q=bird",
+                          shows=f"@user{NUM_USERS}")
+
+    def test_like_message(self):
+        self.assertBudget('like_message', 'POST', "/messages/300/like")
+
+    def test_messages_add(self):
+        self.assertBudget('messages_add', 'POST', "/messages/new", data={"text": "Hello"})
+
+    def test_add_follow(self):
+        db.session.delete(Follows.query.get((2, 1)))
+        db.session.commit()
+
+        self.assertBudget('add_follow', 'POST', "/users/follow/2")
+
+    def test_stop_following(self):
+        self.assertBudget('stop_following', 'POST', "/users/stop-following/2")
+
+    def test_static(self):
+        """Static files never look up the logged in user."""
+
+        self.assertBudget('static', 'GET', "/static/stylesheets/style.css")
+
+    def test_cached_current_user(self):
+        """With a TTL, the logged in user's row comes from the process cache
+           until their profile changes.
+        """
+
+        User.query.get(1).password = password_pool.hash("password")
+        db.session.commit()
+
+        app.config['CURRENT_USER_CACHE_TTL'] = 60
+        user_cache.clear()
+        try:
+            cold = self.assertBudget('messages_add', 'GET', "/messages/new")
+            warm = self.assertBudget('messages_add', 'GET', "/messages/new")
+
+            self.assertEqual(cold.queries, 1)
+            self.assertEqual(warm.queries, 0)
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = 1
+                c.post("/users/profile", data={"username": "user1",
+                                               "email": "user1@test.com",
+                                               "image_url": "/renamed.png",
+                                               "password": "password"})
+
+            self.assertBudget('messages_add', 'GET', "/messages/new", shows="/renamed.png")
+        finally:
+            app.config['CURRENT_USER_CACHE_TTL'] = 0
+            user_cache.clear()
+
+    def test_over_budget(self):
+        with self.assertRaises(AssertionError) as cm:
+            with assert_max_queries(1):
+                User.query.get(1)
+                User.query.get(2)
+
+        self.assertIn("2 queries run, over the budget of 1", str(cm.exception))
+        self.assertIn("2 x", str(cm.exception))
+
+
+class SQLStatsTestCase(TestCase):
+    """Test the per-request and per-route counts."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        db.session.add(User(id=1, username="user1", email="user1@test.com",
+                            password="HASHED_PASSWORD"))
+        db.session.commit()
+
+        self.client = app.test_client()
+        sql_stats.clear()
+
+    def tearDown(self):
+        res = super().tearDown()
+        db.session.rollback()
+        app.config['SLOW_REQUEST_MS'] = 500
+        return res
+
+    def test_fingerprint(self):
+        self.assertEqual(
+            fingerprint("SELECT * FROM users\n  WHERE id IN (%(id_1)s, %(id_2)s) "
+                        "AND username = 'o''brien' LIMIT 10"),
+            "SELECT * FROM users WHERE id IN (?, ...) AND username = ? LIMIT ?")
+
+    def test_count_queries(self):
+        with count_queries() as log:
+            User.query.get(1)
+            db.session.query(User.id).all()
+
+        self.assertEqual(log.queries, 2)
+        self.assertEqual(log.rows, 2)
+        self.assertGreater(log.seconds, 0)
+
+    def test_per_route_totals(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            resp = c.get("/users/1")
+            self.assertNotIn('Server-Timing', resp.headers)
+            c.get("/users/1")
+            c.get("/nowhere")
+
+        routes = sql_stats.routes()
+        self.assertEqual(routes['users_show'].requests, 2)
+        self.assertGreater(routes['users_show'].queries, 2)
+        self.assertGreater(routes['users_show'].rows, 0)
+        self.assertEqual(routes['unmatched'].requests, 1)
+
+    def test_server_timing(self):
+        """The header is only sent when configured."""
+
+        app.config['SERVER_TIMING'] = True
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = 1
+
+                resp = c.get("/users/1")
+        finally:
+            app.config['SERVER_TIMING'] = False
+
+        self.assertIn("queries", resp.headers['Server-Timing'])
+
+    def test_slow_request_logged(self):
+        app.config['SLOW_REQUEST_MS'] = 0
+
+        with self.assertLogs(app.logger, 'WARNING') as logs:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = 1
+
+                c.get("/users/1")
+
+        self.assertIn("slow request: GET /users/1 (users_show)", logs.output[0])
+        self.assertIn("FROM messages WHERE messages.user_id = ? "
+                      "ORDER BY messages.id DESC LIMIT ?", logs.output[0])
@@ -0,0 +1,267 @@
+"""User and message search tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_search.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from purge import mark_deleted
+from search import (memory_user_search, search_users, memory_message_search,
+                    search_messages, reindex_messages, USER_SEARCH_BACKENDS)
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class SQLUserSearchTestCase(TestCase):
+    """Test ranked, paginated username search against the sql backend."""
+
+    backend = 'sql'
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        db.drop_all()
+        db.create_all()
+
+        app.config['SEARCH_BACKEND'] = self.backend
+        app.config['PAGE_SIZE'] = 2
+        memory_user_search.clear()
+
+        self.client = app.test_client()
+
+        for id, username in [(1, "xbird"), (2, "bird"), (3, "birdwatcher"),
+                             (4, "Bird_Lover"), (5, "cat"), (6, "songbird")]:
+            user = User(id=id, username=username, email=f"{id}@test.com",
+                        password="HASHED_PASSWORD")
+            db.session.add(user)
+        db.session.commit()
+
+    def tearDown(self):
+        """Clean up any fouled transactions."""
+
+        res = super().tearDown()
+        db.session.rollback()
+        app.config['SEARCH_BACKEND'] = 'sql'
+        app.config['PAGE_SIZE'] = 100
+        return res
+
+    def search(self, term):
+        """Every username matching `term`, in order, following Older links."""
+
+        usernames = []
+        with app.test_request_context(f"/users?q={term}"):
+            users, cursor = search_users(term)
+            usernames += [user.username for user in users]
+
+            while cursor:
+                with app.test_request_context(f"/users?q={term}&before={cursor}"):
+                    users, cursor = search_users(term)
+                    usernames += [user.username for user in users]
+
+        return usernames
+
+    def matching(self, term, usernames):
+        """`usernames` the backend can find for `term`: all of them, or only
+        the prefix matches if Postgres can't index substring matches.
+        """
+
+        if self.backend == 'sql' and not USER_SEARCH_BACKENDS['sql'].matches_substrings():
+            return [username for username in usernames if username.lower().startswith(term)]
+        return usernames
+
+    def test_ranking(self):
+        """Exact match, then prefix matches, then the rest, newest first."""
+
+        self.assertEqual(self.search("bird"),
+                         self.matching("bird", ["bird", "Bird_Lover", "birdwatcher",
+                                                "songbird", "xbird"]))
+
+    def test_wildcards_are_literal(self):
+        self.assertEqual(self.search("d_l"), self.matching("d_l", ["Bird_Lover"]))
+        self.assertEqual(self.search("bird_"), ["Bird_Lover"])
+        self.assertEqual(self.search("%"), [])
+
+    def test_new_and_renamed_users(self):
+        """Users added or renamed after the first search are found."""
+
+        self.search("bird")
+
+        db.session.add(User(id=7, username="birdie", email="7@test.com",
+                            password="HASHED_PASSWORD"))
+        User.query.get(5).username = "catbird"
+        db.session.commit()
+
+        self.assertEqual(self.search("bird"),
+                         self.matching("bird", ["bird", "birdie", "Bird_Lover", "birdwatcher",
+                                                "songbird", "catbird", "xbird"]))
+
+    def test_search_page(self):
+        with self.client as c:
+            resp = c.get("/users?q=bird")
+
+        self.assertIn("@bird", str(resp.data))
+        self.assertIn("q=bird", str(resp.data))
+        self.assertNotIn("@cat", str(resp.data))
+
+
+class MemoryUserSearchTestCase(SQLUserSearchTestCase):
+    """Run the same tests against the in-process trigram index."""
+
+    backend = 'memory'
+
+
+class SQLUserSearchPlanTestCase(TestCase):
+    """Test that Postgres answers username search from an index."""
+
+    def test_uses_index(self):
+        search = USER_SEARCH_BACKENDS['sql']
+        conn = db.session.connection()
+        statement = search.query("bird").statement.compile(conn)
+        try:
+            conn.execute("SET LOCAL enable_seqscan = off")
+            plan = "\n".join(row[0] for row in conn.execute(f"EXPLAIN {statement}",
+                                                            statement.params))
+        finally:
+            db.session.rollback()
+
+        self.assertNotIn("Seq Scan", plan)
+        index = ('ix_users_username_trgm' if search.matches_substrings()
+                 else 'ix_users_username_prefix')
+        self.assertIn(index, plan)
+
+
+class SQLMessageSearchTestCase(TestCase):
+    """Test ranked, paginated full-text message search against the sql backend."""
+
+    backend = 'sql'
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        db.drop_all()
+        db.create_all()
+
+        app.config['SEARCH_BACKEND'] = self.backend
+        app.config['PAGE_SIZE'] = 2
+        memory_message_search.clear()
+
+        self.client = app.test_client()
+
+        db.session.add(User(id=1, username="birder", email="1@test.com",
+                            password="HASHED_PASSWORD"))
+        db.session.commit()
+
+        for id, text in [(1, "a bird sang"), (2, "bird bird bird"),
+                         (3, "cats nap"), (4, "bird song at dawn"),
+                         (5, "loud bird song")]:
+            db.session.add(Message(id=id, text=text, user_id=1))
+        db.session.commit()
+
+        with app.app_context():
+            reindex_messages()
+            db.session.commit()
+
+    def tearDown(self):
+        """Clean up any fouled transactions."""
+
+        res = super().tearDown()
+        db.session.rollback()
+        app.config['SEARCH_BACKEND'] = 'sql'
+        app.config['PAGE_SIZE'] = 100
+        return res
+
+    def search(self, term):
+        """Ids of every message matching `term`, in order, following Older links."""
+
+        ids = []
+        with app.test_request_context(f"/messages/search?q={term}"):
+            messages, cursor = search_messages(term)
+            ids += [msg.id for msg in messages]
+
+            while cursor:
+                with app.test_request_context(f"/messages/search?q={term}&before={cursor}"):
+                    messages, cursor = search_messages(term)
+                    ids += [msg.id for msg in messages]
+
+        return ids
+
+    def test_ranking(self):
+        """Messages using the word most come first, then newest first."""
+
+        self.assertEqual(self.search("bird"), [2, 5, 4, 1])
+
+    def test_every_word_must_match(self):
+        self.assertEqual(self.search("bird song"), [5, 4])
+        self.assertEqual(self.search("bird nap"), [])
+
+    def test_added_and_deleted_messages(self):
+        """Messages written and deleted through the views update the index."""
+
+        self.search("bird")
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            c.post("/messages/new", data={"text": "sleepy bird"})
+            c.post("/messages/4/delete")
+
+        added = Message.query.filter_by(text="sleepy bird").one()
+        self.assertEqual(self.search("bird"), [2, added.id, 5, 1])
+
+    def test_deleted_accounts_are_skipped(self):
+        """Messages by deleted accounts don't come up, and pages stay full."""
+
+        spammer = User(id=2, username="spammer", email="2@test.com",
+                       password="HASHED_PASSWORD")
+        db.session.add(spammer)
+        db.session.add_all([Message(id=id, text="bird bird bird bird", user_id=2)
+                            for id in (6, 7, 8)])
+        db.session.commit()
+
+        with app.app_context():
+            reindex_messages()
+            db.session.commit()
+
+        self.search("bird")
+
+        with app.app_context():
+            mark_deleted(User.query.get(2))
+            db.session.commit()
+
+        self.assertEqual(self.search("bird"), [2, 5, 4, 1])
+
+        with app.test_request_context("/messages/search?q=bird"):
+            messages, cursor = search_messages("bird")
+        self.assertEqual([msg.id for msg in messages], [2, 5])
+        self.assertIsNotNone(cursor)
+
+    def test_search_page(self):
+        with self.client as c:
+            resp = c.get("/messages/search?q=bird")
+
+        self.assertIn("bird bird bird", str(resp.data))
+        self.assertIn("q=bird", str(resp.data))
+        self.assertNotIn("cats nap", str(resp.data))
+
+
+class MemoryMessageSearchTestCase(SQLMessageSearchTestCase):
+    """Run the same tests against the in-process inverted index."""
+
+    backend = 'memory'
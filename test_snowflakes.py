@@ -0,0 +1,124 @@
+"""Snowflake message id tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_snowflakes.py
+
+
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy import create_engine
+
+import snowflakes
+from snowflakes import SnowflakeGenerator, lease_worker_id, timestamp_of, MAX_SEQUENCE
+
+
+class SnowflakeTestCase(TestCase):
+    """Test minting time-ordered ids."""
+
+    def test_ids_increase(self):
+        generator = SnowflakeGenerator(worker_id=7)
+        ids = [generator.next_id() for _ in range(10000)]
+
+        self.assertEqual(ids, sorted(set(ids)))
+
+    def test_timestamp_round_trip(self):
+        generator = SnowflakeGenerator(worker_id=7)
+        before = datetime.utcnow() - timedelta(milliseconds=1)
+        minted = timestamp_of(generator.next_id())
+
+        self.assertLessEqual(before, minted)
+        self.assertLessEqual(minted, datetime.utcnow())
+
+        when = datetime(2017, 1, 21, 11, 4, 53, 522000)
+        self.assertEqual(timestamp_of(generator.id_at(when)), when)
+
+    def test_workers_dont_collide(self):
+        now = datetime.utcnow()
+        with patch.object(snowflakes, 'datetime') as clock:
+            clock.utcnow.return_value = now
+            ids = {SnowflakeGenerator(worker_id=1).next_id(),
+                   SnowflakeGenerator(worker_id=2).next_id()}
+
+        self.assertEqual(len(ids), 2)
+
+    def test_clock_going_backwards(self):
+        """Ids keep increasing if the clock steps back or a millisecond fills up."""
+
+        generator = SnowflakeGenerator()
+        now = datetime.utcnow()
+
+        with patch.object(snowflakes, 'datetime') as clock:
+            clock.utcnow.return_value = now
+            ids = [generator.next_id() for _ in range(MAX_SEQUENCE + 2)]
+
+            clock.utcnow.return_value = now - timedelta(seconds=1)
+            ids.append(generator.next_id())
+
+        self.assertEqual(ids, sorted(set(ids)))
+
+    def test_backfill_ids_per_millisecond(self):
+        """Ids for the same old timestamp are unique until its sequence runs out."""
+
+        generator = SnowflakeGenerator(worker_id=7)
+        when = datetime(2017, 1, 21, 11, 4, 53, 522000)
+        later = when + timedelta(milliseconds=1)
+
+        ids = [generator.id_at(when) for _ in range(MAX_SEQUENCE)]
+        ids.append(generator.id_at(later))
+        ids.append(generator.id_at(when))
+
+        self.assertEqual(len(set(ids)), MAX_SEQUENCE + 2)
+        self.assertEqual(generator.id_at(later) & MAX_SEQUENCE, 1)
+
+        with self.assertRaises(ValueError):
+            generator.id_at(when)
+
+    def test_bad_input(self):
+        with self.assertRaises(ValueError):
+            SnowflakeGenerator(worker_id=1024)
+
+        with self.assertRaises(ValueError):
+            SnowflakeGenerator().id_at(datetime(2000, 1, 1))
+
+
+class WorkerLeaseTestCase(TestCase):
+    """Test leasing worker ids from Postgres."""
+
+    def setUp(self):
+        self.engine = create_engine("postgresql:///warbler-test")
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_leases_are_unique(self):
+        first_id, first = lease_worker_id(self.engine)
+        second_id, second = lease_worker_id(self.engine)
+        self.assertNotEqual(first_id, second_id)
+
+        # Closing the connection gives the id back.
+        first.close()
+        third_id, third = lease_worker_id(self.engine)
+        self.assertEqual(third_id, first_id)
+
+        second.close()
+        third.close()
+
+    def test_leased_on_first_id(self):
+        """A generator without a worker id leases one once per process."""
+
+        generator = SnowflakeGenerator()
+        calls = []
+
+        def allocate():
+            calls.append(1)
+            return 5, None
+
+        generator.allocate = allocate
+        ids = [generator.next_id(), generator.next_id(), generator.id_at(datetime(2017, 1, 1))]
+
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all((id >> snowflakes.SEQUENCE_BITS) & snowflakes.MAX_WORKER_ID == 5
+                            for id in ids))
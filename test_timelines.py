@@ -0,0 +1,408 @@
+"""Materialized timeline tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_timelines.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Follows, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from counters import reconcile_counters
+from purge import mark_deleted
+from timelines import (get_timeline_store, merge_timelines, pulled_author_ids,
+                       TimelineItem)
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class SQLTimelineTestCase(TestCase):
+    """Test fan-out-on-write timelines against the sql backend."""
+
+    backend = 'sql'
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        db.drop_all()
+        db.create_all()
+
+        app.config['TIMELINE_BACKEND'] = self.backend
+        app.config['TIMELINE_MAX_LENGTH'] = 3
+        app.config['TIMELINE_FANOUT_THRESHOLD'] = None
+        app.extensions.pop('timelines', None)
+
+        self.client = app.test_client()
+
+        self.reader = User.signup("reader", "reader@test.com", "password", None)
+        self.reader.id = 100
+        self.author = User.signup("author", "author@test.com", "password", None)
+        self.author.id = 200
+        self.stranger = User.signup("stranger", "stranger@test.com", "password", None)
+        self.stranger.id = 300
+
+        db.session.commit()
+
+    def tearDown(self):
+        """Clean up any fouled transactions and turn timelines back off."""
+
+        res = super().tearDown()
+        db.session.rollback()
+        app.config['TIMELINE_BACKEND'] = None
+        app.config['PAGE_SIZE'] = 100
+        app.extensions.pop('timelines', None)
+        return res
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def timeline(self, user_id):
+        with app.app_context():
+            return [item.message_id for item in get_timeline_store().read(user_id, 10)]
+
+    def test_post_fans_out_to_followers(self):
+        """A new message lands in the author's and followers' timelines only."""
+
+        db.session.add(Follows(user_being_followed_id=200, user_following_id=100))
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c, 200)
+            c.post("/messages/new", data={"text": "fan me out"})
+
+        msg = Message.query.one()
+        self.assertEqual(self.timeline(100), [msg.id])
+        self.assertEqual(self.timeline(200), [msg.id])
+        self.assertEqual(self.timeline(300), [])
+
+    def test_homepage_reads_timeline(self):
+        """The homepage shows what is in the timeline, newest first."""
+
+        db.session.add(Follows(user_being_followed_id=200, user_following_id=100))
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c, 200)
+            c.post("/messages/new", data={"text": "first warble"})
+
+            self.login(c, 100)
+            resp = c.get("/")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("first warble", str(resp.data))
+
+    def test_follow_backfills_and_unfollow_prunes(self):
+        """Following copies recent messages in; unfollowing removes them."""
+
+        now = datetime.utcnow()
+        db.session.add_all([
+            Message(id=1, text="old", user_id=200, timestamp=now - timedelta(days=2)),
+            Message(id=2, text="new", user_id=200, timestamp=now - timedelta(days=1)),
+        ])
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c, 100)
+            c.post("/users/follow/200")
+            self.assertEqual(self.timeline(100), [2, 1])
+
+            c.post("/users/stop-following/200")
+            self.assertEqual(self.timeline(100), [])
+
+    def test_timeline_is_bounded(self):
+        """Only the newest TIMELINE_MAX_LENGTH messages are kept."""
+
+        now = datetime.utcnow()
+        db.session.add_all([
+            Message(id=i, text=f"warble {i}", user_id=200, timestamp=now + timedelta(minutes=i))
+            for i in range(1, 6)
+        ])
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c, 100)
+            c.post("/users/follow/200")
+
+        self.assertEqual(self.timeline(100), [5, 4, 3])
+
+    def test_read_trims_timeline(self):
+        """Each recipient's timeline is back to TIMELINE_MAX_LENGTH once read."""
+
+        db.session.add_all([
+            Follows(user_being_followed_id=200, user_following_id=100),
+            Follows(user_being_followed_id=200, user_following_id=300),
+        ])
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c, 200)
+            for i in range(5):
+                c.post("/messages/new", data={"text": f"warble {i}"})
+
+            for user_id in (100, 200, 300):
+                self.login(c, user_id)
+                c.get("/")
+
+        newest = [msg.id for msg in Message.query.order_by(Message.id.desc()).limit(3)]
+        for user_id in (100, 200, 300):
+            self.assertEqual(self.timeline(user_id), newest)
+
+    def test_timeline_read_before_cursor(self):
+        """Reads can start just after a message id cursor."""
+
+        db.session.add_all([Message(id=i, text=f"warble {i}", user_id=200)
+                            for i in range(1, 4)])
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c, 100)
+            c.post("/users/follow/200")
+
+        with app.app_context():
+            store = get_timeline_store()
+            older = store.read(100, 10, before=(3,))
+
+        self.assertEqual([item.message_id for item in older], [2, 1])
+
+    def test_delete_removes_from_timelines(self):
+        """Deleting a message takes it out of every timeline."""
+
+        db.session.add(Follows(user_being_followed_id=200, user_following_id=100))
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c, 200)
+            c.post("/messages/new", data={"text": "regrettable"})
+            msg_id = Message.query.one().id
+
+            c.post(f"/messages/{msg_id}/delete")
+
+        self.assertEqual(self.timeline(100), [])
+        self.assertEqual(self.timeline(200), [])
+        self.assertEqual(TimelineEntry.query.count(), 0)
+
+    def test_cold_timeline_is_rebuilt(self):
+        """A user with no timeline yet gets one built on first read."""
+
+        db.session.add_all([
+            Follows(user_being_followed_id=200, user_following_id=100),
+            Message(id=7, text="written before timelines", user_id=200),
+        ])
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c, 100)
+            resp = c.get("/")
+
+        self.assertIn("written before timelines", str(resp.data))
+        self.assertEqual(self.timeline(100), [7])
+
+    def test_empty_timeline_is_built_once(self):
+        """A timeline that is built but empty isn't rebuilt on every read."""
+
+        with self.client as c:
+            self.login(c, 100)
+            c.get("/")
+
+            # Written behind the timelines' back, so only a rebuild finds it.
+            db.session.add_all([
+                Follows(user_being_followed_id=200, user_following_id=100),
+                Message(id=7, text="written behind its back", user_id=200),
+            ])
+            db.session.commit()
+
+            resp = c.get("/")
+
+        self.assertNotIn("written behind its back", str(resp.data))
+        self.assertEqual(self.timeline(100), [])
+
+    def test_deleted_author_is_skipped(self):
+        """A followed account that is deleted doesn't cut the homepage short."""
+
+        app.config['PAGE_SIZE'] = 1
+        db.session.add_all([
+            Follows(user_being_followed_id=200, user_following_id=100),
+            Follows(user_being_followed_id=300, user_following_id=100),
+        ])
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c, 300)
+            c.post("/messages/new", data={"text": "kept 0"})
+            c.post("/messages/new", data={"text": "kept 1"})
+            self.login(c, 200)
+            c.post("/messages/new", data={"text": "gone 0"})
+
+            mark_deleted(User.query.get(200))
+            db.session.commit()
+
+            self.login(c, 100)
+            resp = c.get("/")
+            self.assertIn("kept 1", str(resp.data))
+            self.assertNotIn("gone 0", str(resp.data))
+            self.assertIn("before=", str(resp.data))
+
+            older = c.get("/?before=" + str(resp.data).split("before=")[1].split('"')[0])
+            self.assertIn("kept 0", str(older.data))
+
+
+class MemoryTimelineTestCase(SQLTimelineTestCase):
+    """Run the same tests against the in-process backend."""
+
+    backend = 'memory'
+
+
+class HybridTimelineTestCase(TestCase):
+    """Test that high-follower authors are pulled at read time."""
+
+    backend = 'memory'
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        db.drop_all()
+        db.create_all()
+
+        app.config['TIMELINE_BACKEND'] = self.backend
+        app.config['TIMELINE_MAX_LENGTH'] = 10
+        app.config['TIMELINE_FANOUT_THRESHOLD'] = 1
+        app.extensions.pop('timelines', None)
+
+        self.client = app.test_client()
+
+        for id, name in [(100, "reader"), (200, "celebrity"), (300, "fan"), (400, "friend")]:
+            user = User.signup(name, f"{name}@test.com", "password", None)
+            user.id = id
+        db.session.commit()
+
+        # 200 has two followers, which is over the threshold of 1;
+        # 400 has just the one.
+        db.session.add_all([
+            Follows(user_being_followed_id=200, user_following_id=100),
+            Follows(user_being_followed_id=200, user_following_id=300),
+            Follows(user_being_followed_id=400, user_following_id=100),
+        ])
+        reconcile_counters()
+        db.session.commit()
+
+    def tearDown(self):
+        """Clean up any fouled transactions and turn timelines back off."""
+
+        res = super().tearDown()
+        db.session.rollback()
+        app.config['TIMELINE_BACKEND'] = None
+        app.config['TIMELINE_FANOUT_THRESHOLD'] = None
+        app.extensions.pop('timelines', None)
+        return res
+
+    def post_as(self, c, user_id, text):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        c.post("/messages/new", data={"text": text})
+
+    def test_celebrity_is_not_fanned_out(self):
+        """Only the celebrity's own timeline is written to."""
+
+        with self.client as c:
+            self.post_as(c, 200, "hello fans")
+
+        with app.app_context():
+            store = get_timeline_store()
+            self.assertEqual(len(store.read(200, 10)), 1)
+            self.assertEqual(store.read(100, 10), [])
+            self.assertEqual(store.read(300, 10), [])
+
+    def test_celebrity_is_merged_at_read(self):
+        """Pulled and pushed messages both show up on the homepage."""
+
+        with self.client as c:
+            self.post_as(c, 400, "from a friend")
+            self.post_as(c, 200, "from a celebrity")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 100
+            resp = c.get("/")
+
+        self.assertIn("from a friend", str(resp.data))
+        self.assertIn("from a celebrity", str(resp.data))
+
+    def test_pulled_authors_come_from_follower_counts(self):
+        """Only followed authors whose follower_count is over the threshold are pulled."""
+
+        with app.app_context():
+            store = get_timeline_store()
+            self.assertEqual(pulled_author_ids(store, 100), {200})
+            self.assertEqual(pulled_author_ids(store, 300), {200})
+            self.assertEqual(pulled_author_ids(store, 400), set())
+
+    def test_crossing_the_threshold(self):
+        """Nothing goes missing as an author moves over the threshold and back."""
+
+        def home_of_reader(c):
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 100
+            return str(c.get("/").data)
+
+        with self.client as c:
+            # Down to one follower: pushed.
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 300
+            c.post("/users/stop-following/200")
+            self.post_as(c, 200, "while pushed")
+
+            # Back up to two: pulled.
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 300
+            c.post("/users/follow/200")
+            self.post_as(c, 200, "while pulled")
+
+            home = home_of_reader(c)
+            self.assertIn("while pushed", home)
+            self.assertIn("while pulled", home)
+
+            # Down to one again: what was pulled is pushed now.
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 300
+            c.post("/users/stop-following/200")
+
+            home = home_of_reader(c)
+            self.assertIn("while pushed", home)
+            self.assertIn("while pulled", home)
+
+        with app.app_context():
+            store = get_timeline_store()
+            self.assertEqual(pulled_author_ids(store, 100), set())
+            self.assertEqual(len([item for item in store.read(100, 10)
+                                  if item.author_id == 200]), 2)
+
+
+class SQLHybridTimelineTestCase(HybridTimelineTestCase):
+    """Run the same tests against the sql backend."""
+
+    backend = 'sql'
+
+
+class MergeTimelinesTestCase(TestCase):
+    """Test the k-way merge used for hybrid timelines."""
+
+    def test_merge_orders_dedupes_and_limits(self):
+        a = [TimelineItem(3, 1), TimelineItem(1, 1)]
+        b = [TimelineItem(3, 1), TimelineItem(2, 2)]
+
+        merged = merge_timelines([a, b], 2)
+        self.assertEqual([item.message_id for item in merged], [3, 2])
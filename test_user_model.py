@@ -119,6 +119,35 @@ class UserModelTestCase(TestCase):
         self.assertTrue(self.user1.is_following(self.user2))
         self.assertFalse(self.user2.is_following(self.user1))
 
+    def test_user_followed_by(self):
+        """This test method checks that the is_followed_by method works"""
+
+        self.user1.following.append(self.user2)
+        db.session.commit()
+
+        self.assertTrue(self.user2.is_followed_by(self.user1))
+        self.assertFalse(self.user1.is_followed_by(self.user2))
+
+    def test_following_among(self):
+        """This test method checks the batched following_among method,
+           including that its cache notices new follows.
+        """
+
+        user3 = User.signup("user3", "user3@test.com", "passWord4u3", None)
+        user3.id = 3333
+        db.session.commit()
+
+        self.user1.following.append(self.user2)
+        db.session.commit()
+
+        users = [self.user2, user3]
+        self.assertEqual(self.user1.following_among(users), {self.u2d2})
+
+        self.user1.following.append(user3)
+        db.session.commit()
+
+        self.assertEqual(self.user1.following_among(users), {self.u2d2, 3333})
+
     #######################
     #
     # Signup Tests
@@ -10,6 +10,7 @@ from unittest import TestCase
 
 from models import db, connect_db, User, Message, Likes, Follows
 from bs4 import BeautifulSoup
+from counters import reconcile_counters
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -155,6 +156,11 @@ class UserViewsTestCase(TestCase):
         db.session.add(l1)
         db.session.commit()
 
+        # These rows were added directly rather than through the views,
+        # so the denormalized user counters need rebuilding.
+        reconcile_counters()
+        db.session.commit()
+
     def test_user_shows_with_likes(self):
         """This test method tests to see user likes"""
         self.setup_likes()
@@ -230,7 +236,63 @@ class UserViewsTestCase(TestCase):
             # Nothing that this message has been unliked, we expect to get 
             # a length of 0 for likes
             self.assertEqual(len(likes), 0)
-    
+
+    def test_like_message_json(self):
+        """This test method confirms that the like toggle answers
+           with the new like state and count when asked for JSON.
+        """
+        m = Message(id=2000, text="testing testing a wabler", user_id=self.u1id )
+
+        db.session.add(m)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            headers = {"Accept": "application/json"}
+
+            resp = c.post("/messages/2000/like", headers=headers)
+            self.assertEqual(resp.json, {"liked": True, "likes": 1})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2id
+
+            resp = c.post("/messages/2000/like", headers=headers)
+            self.assertEqual(resp.json, {"liked": True, "likes": 2})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.post("/messages/2000/like", headers=headers)
+            self.assertEqual(resp.json, {"liked": False, "likes": 1})
+
+        self.assertEqual(User.query.get(self.testuser_id).like_count, 0)
+        self.assertEqual(User.query.get(self.u2id).like_count, 1)
+        self.assertEqual(Message.query.get(2000).like_count, 1)
+
+
+    def test_liked_messages_are_highlighted(self):
+        """This test method confirms that messages the logged in user
+           liked are rendered with the liked button style.
+        """
+        self.setup_likes()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get(f"/users/{self.u1id}")
+            soup = BeautifulSoup(str(resp.data), 'html.parser')
+            form = soup.find("form", {"action": "/messages/1984/like"})
+
+            self.assertIn("btn-primary", form.button["class"])
+
+            resp = c.get("/messages/1984")
+            soup = BeautifulSoup(str(resp.data), 'html.parser')
+            form = soup.find("form", {"action": "/messages/1984/like"})
+
+            self.assertIn("btn-primary", form.button["class"])
 
     def test_unauthorithed_like(self):
         """This test method test that an unauthorized user cannot like a meesage"""
@@ -267,6 +329,41 @@ class UserViewsTestCase(TestCase):
         db.session.add_all([f1, f2, f3])
         db.session.commit()
 
+        reconcile_counters()
+        db.session.commit()
+
+    def test_counters_follow_the_views(self):
+        """This test method confirms that following, liking and posting
+           through the views keeps the user counters up to date.
+        """
+        m = Message(id=2000, text="a message worth liking", user_id=self.u1id)
+        db.session.add(m)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post(f"/users/follow/{self.u1id}")
+            c.post("/messages/2000/like")
+            c.post("/messages/new", data={"text": "counting on it"})
+
+        testuser = User.query.get(self.testuser_id)
+        u1 = User.query.get(self.u1id)
+        self.assertEqual(testuser.following_count, 1)
+        self.assertEqual(testuser.like_count, 1)
+        self.assertEqual(testuser.message_count, 1)
+        self.assertEqual(u1.follower_count, 1)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1id
+
+            c.post("/messages/2000/delete")
+
+        testuser = User.query.get(self.testuser_id)
+        self.assertEqual(testuser.like_count, 0)
+
     def test_user_show_with_follows(self):
         """This test method, test to confirm that the right number of 
             users following logged in user and the right number of users the logged in
@@ -0,0 +1,542 @@
+"""Materialized home timelines for Warbler.
+
+When timelines are turned on (``TIMELINE_BACKEND`` in the app config), every
+new message is pushed into the timeline of its author and each of the
+author's followers when it is written.  The homepage then reads one
+precomputed, bounded list instead of querying every followed user's messages.
+
+Two backends are available:
+
+- ``"sql"``: entries live in the ``timeline_entries`` table
+- ``"memory"``: entries live in a dict in this process (handy for tests)
+
+Authors with more than ``TIMELINE_FANOUT_THRESHOLD`` followers are not fanned
+out, since one of their messages would mean that many timeline writes.
+Instead their recent messages are pulled when a follower reads the homepage
+and merged into the stored timeline.  An author who drops back down to the
+threshold has their recent messages copied into their followers' timelines,
+since what they posted while over it was never pushed.
+
+Message ids are time-ordered (see snowflakes.py), so timelines are kept,
+merged and paged in message id order.
+
+In the sql backend a message is fanned out with one ``INSERT ... SELECT``
+over the author's followers, and timelines are trimmed back to
+``TIMELINE_MAX_LENGTH`` when their owner reads them rather than on every
+write, so a timeline that isn't read can run a little long until it is.
+"""
+
+from bisect import bisect_left, insort
+from collections import namedtuple
+from heapq import merge
+
+from flask import current_app
+from sqlalchemy import text
+
+from models import db, Follows, Message, TimelineBuild, TimelineEntry, User
+from loading import with_authors
+from pagination import seek
+
+TimelineItem = namedtuple('TimelineItem', ['message_id', 'author_id'])
+
+
+def item_for(msg):
+    """Build a timeline item for message `msg`."""
+
+    return TimelineItem(msg.id, msg.user_id)
+
+
+class TimelineStore:
+    """Interface shared by every timeline backend.
+
+    A timeline is kept newest-first and is cut back to `max_length` entries
+    (older entries fall off the end) by the time its owner reads it.
+
+    Authors with more than `fanout_threshold` followers are pulled at read
+    time instead of pushed at write time (None pushes everyone).
+    """
+
+    def __init__(self, max_length, fanout_threshold=None):
+        self.max_length = max_length
+        self.fanout_threshold = fanout_threshold
+
+    def fans_out(self, num_followers):
+        """Should an author with `num_followers` followers be pushed on write?"""
+
+        return (self.fanout_threshold is None
+                or num_followers <= self.fanout_threshold)
+
+    def push(self, item, user_ids):
+        """Add one message to the timelines of every user in `user_ids`."""
+
+        raise NotImplementedError
+
+    def fan_out(self, item):
+        """Add one message to the timelines of its author and their followers."""
+
+        self.push(item, [item.author_id] + follower_ids(item.author_id))
+
+    def extend(self, user_id, items):
+        """Add many messages to the timeline of a single user."""
+
+        raise NotImplementedError
+
+    def backfill_followers(self, author_id, items):
+        """Add many messages by `author_id` to the timelines of their followers."""
+
+        for follower_id in follower_ids(author_id):
+            self.extend(follower_id, items)
+
+    def prune_author(self, user_id, author_id):
+        """Remove every message by `author_id` from `user_id`'s timeline."""
+
+        raise NotImplementedError
+
+    def remove_message(self, message_id):
+        """Remove a message from every timeline it was pushed to."""
+
+        raise NotImplementedError
+
+    def drop(self, user_id):
+        """Throw away the whole timeline of `user_id`, and its built marker."""
+
+        raise NotImplementedError
+
+    def trim(self, user_id):
+        """Cut `user_id`'s timeline back to `max_length`. True if it was over."""
+
+        return False
+
+    def is_built(self, user_id):
+        """Has `user_id`'s timeline been built since it was last dropped?"""
+
+        raise NotImplementedError
+
+    def mark_built(self, user_id):
+        """Record that `user_id`'s timeline has been built."""
+
+        raise NotImplementedError
+
+    def read(self, user_id, limit, before=None):
+        """Return up to `limit` TimelineItems from `user_id`'s timeline, newest first.
+
+        If `before` is a ``(message_id,)`` cursor, start just after it.
+        """
+
+        raise NotImplementedError
+
+
+class SQLTimelineStore(TimelineStore):
+    """Timelines stored in the ``timeline_entries`` table.
+
+    Writes go through the current db session; the caller commits.
+    """
+
+    def push(self, item, user_ids):
+        if not user_ids:
+            return
+
+        db.session.execute(
+            TimelineEntry.__table__.insert(),
+            [dict(user_id=user_id,
+                  message_id=item.message_id,
+                  author_id=item.author_id)
+             for user_id in user_ids])
+
+    def fan_out(self, item):
+        """One statement, however many followers the author has."""
+
+        db.session.execute(
+            text("""
+                INSERT INTO timeline_entries (user_id, message_id, author_id)
+                SELECT :author_id, :message_id, :author_id
+                 UNION
+                SELECT user_following_id, :message_id, :author_id
+                  FROM follows
+                 WHERE user_being_followed_id = :author_id
+            """),
+            item._asdict())
+
+    def extend(self, user_id, items):
+        if not items:
+            return
+
+        existing = {message_id for (message_id,) in (db.session
+                    .query(TimelineEntry.message_id)
+                    .filter(TimelineEntry.user_id == user_id)
+                    .filter(TimelineEntry.message_id.in_([i.message_id for i in items])))}
+        rows = [dict(user_id=user_id,
+                     message_id=item.message_id,
+                     author_id=item.author_id)
+                for item in items if item.message_id not in existing]
+
+        if rows:
+            db.session.execute(TimelineEntry.__table__.insert(), rows)
+            self._trim([user_id])
+
+    def backfill_followers(self, author_id, items):
+        """One statement; entries the followers already have are skipped."""
+
+        if not items:
+            return
+
+        db.session.execute(
+            text("""
+                INSERT INTO timeline_entries (user_id, message_id, author_id)
+                SELECT follows.user_following_id, ids.message_id, :author_id
+                  FROM follows
+                 CROSS JOIN unnest(CAST(:message_ids AS bigint[])) AS ids (message_id)
+                 WHERE follows.user_being_followed_id = :author_id
+                    ON CONFLICT DO NOTHING
+            """),
+            dict(author_id=author_id,
+                 message_ids=[item.message_id for item in items]))
+
+    def prune_author(self, user_id, author_id):
+        (TimelineEntry
+         .query
+         .filter(TimelineEntry.user_id == user_id,
+                 TimelineEntry.author_id == author_id)
+         .delete(synchronize_session=False))
+
+    def remove_message(self, message_id):
+        (TimelineEntry
+         .query
+         .filter(TimelineEntry.message_id == message_id)
+         .delete(synchronize_session=False))
+
+    def drop(self, user_id):
+        (TimelineEntry
+         .query
+         .filter(TimelineEntry.user_id == user_id)
+         .delete(synchronize_session=False))
+        (TimelineBuild
+         .query
+         .filter(TimelineBuild.user_id == user_id)
+         .delete(synchronize_session=False))
+
+    def trim(self, user_id):
+        return self._trim([user_id]) > 0
+
+    def is_built(self, user_id):
+        return (db.session
+                .query(TimelineBuild.user_id)
+                .filter(TimelineBuild.user_id == user_id)
+                .first()) is not None
+
+    def mark_built(self, user_id):
+        db.session.add(TimelineBuild(user_id=user_id))
+
+    def read(self, user_id, limit, before=None):
+        query = (db.session
+                 .query(TimelineEntry.message_id, TimelineEntry.author_id)
+                 .filter(TimelineEntry.user_id == user_id))
+        rows = (seek(query, [TimelineEntry.message_id], before)
+                .limit(limit)
+                .all())
+        return [TimelineItem(*row) for row in rows]
+
+    def _trim(self, user_ids):
+        """Cut the timelines of `user_ids` back down to `max_length` entries.
+
+        Each user's cutoff is found by walking the primary key index
+        newest-first for `max_length` entries, and only entries at or below
+        it are deleted, so the cost doesn't grow with the rest of the table.
+        Returns how many entries were deleted.
+        """
+
+        return db.session.execute(
+            text("""
+                DELETE FROM timeline_entries AS entry
+                USING (
+                    SELECT ids.user_id,
+                           (SELECT newer.message_id
+                              FROM timeline_entries AS newer
+                             WHERE newer.user_id = ids.user_id
+                             ORDER BY newer.message_id DESC
+                            OFFSET :max_length LIMIT 1) AS cutoff
+                      FROM unnest(CAST(:user_ids AS integer[])) AS ids (user_id)
+                ) AS bound
+                WHERE entry.user_id = bound.user_id
+                  AND entry.message_id <= bound.cutoff
+            """),
+            dict(user_ids=list(user_ids), max_length=self.max_length)).rowcount
+
+
+class MemoryTimelineStore(TimelineStore):
+    """Timelines kept in a dict in this process.
+
+    Each timeline is a list of ``(-message_id, item)`` keys, so plain
+    sorted order is newest first.
+    """
+
+    def __init__(self, max_length, fanout_threshold=None):
+        super().__init__(max_length, fanout_threshold)
+        self.timelines = {}
+        self.built = set()
+
+    def push(self, item, user_ids):
+        for user_id in user_ids:
+            self._insert(user_id, item)
+
+    def extend(self, user_id, items):
+        for item in items:
+            self._insert(user_id, item)
+
+    def prune_author(self, user_id, author_id):
+        timeline = self.timelines.get(user_id)
+        if timeline:
+            timeline[:] = [key for key in timeline if key[1].author_id != author_id]
+
+    def remove_message(self, message_id):
+        for timeline in self.timelines.values():
+            timeline[:] = [key for key in timeline if key[0] != -message_id]
+
+    def drop(self, user_id):
+        self.timelines.pop(user_id, None)
+        self.built.discard(user_id)
+
+    def is_built(self, user_id):
+        return user_id in self.built
+
+    def mark_built(self, user_id):
+        self.built.add(user_id)
+
+    def read(self, user_id, limit, before=None):
+        timeline = self.timelines.get(user_id, [])
+        start = 0
+
+        if before is not None:
+            # Keys sort by -message_id, so everything older than `before`
+            # starts at the first key >= (-id + 1,).
+            (message_id,) = before
+            start = bisect_left(timeline, (-message_id + 1,))
+
+        return [key[1] for key in timeline[start:start + limit]]
+
+    def clear(self):
+        """Forget every timeline."""
+
+        self.timelines.clear()
+        self.built.clear()
+
+    def _insert(self, user_id, item):
+        timeline = self.timelines.setdefault(user_id, [])
+        key = (-item.message_id, item)
+
+        if key in timeline:
+            return
+
+        insort(timeline, key)
+        del timeline[self.max_length:]
+
+
+BACKENDS = {
+    'sql': SQLTimelineStore,
+    'memory': MemoryTimelineStore,
+}
+
+
+def get_timeline_store():
+    """Return the timeline store for the current app, or None if timelines are off."""
+
+    backend = current_app.config.get('TIMELINE_BACKEND')
+    if not backend:
+        return None
+
+    stores = current_app.extensions.setdefault('timelines', {})
+    if backend not in stores:
+        stores[backend] = BACKENDS[backend](
+            current_app.config['TIMELINE_MAX_LENGTH'],
+            current_app.config.get('TIMELINE_FANOUT_THRESHOLD'))
+
+    return stores[backend]
+
+
+##############################################################################
+# Helpers used by the views in app.py
+
+
+def follower_ids(user_id):
+    """Ids of every user following `user_id`."""
+
+    rows = (db.session
+            .query(Follows.user_following_id)
+            .filter(Follows.user_being_followed_id == user_id)
+            .all())
+    return [follower_id for (follower_id,) in rows]
+
+
+def recent_items(author_ids, limit, before=None):
+    """Timeline items for the `limit` newest messages by any of `author_ids`.
+
+    If `before` is a ``(message_id,)`` cursor, start just after it.
+    """
+
+    query = (db.session
+             .query(Message.id, Message.user_id)
+             .filter(Message.user_id.in_(author_ids)))
+    messages = (seek(query, [Message.id], before)
+                .limit(limit)
+                .all())
+    return [TimelineItem(*row) for row in messages]
+
+
+def is_pulled(store, author_id):
+    """Does `author_id` have too many followers to be fanned out?"""
+
+    if store.fanout_threshold is None:
+        return False
+
+    num_followers = (db.session
+                     .query(User.follower_count)
+                     .filter(User.id == author_id)
+                     .scalar())
+    return not store.fans_out(num_followers or 0)
+
+
+def followed_authors(user_id):
+    """[(id, follower count)] of every user `user_id` follows."""
+
+    return (db.session
+            .query(User.id, User.follower_count)
+            .join(Follows, Follows.user_being_followed_id == User.id)
+            .filter(Follows.user_following_id == user_id)
+            .all())
+
+
+def pulled_author_ids(store, user_id):
+    """Ids of the users `user_id` follows who have too many followers to
+    be fanned out, going by their follower counts (see counters.py), and
+    haven't deleted their accounts.
+    """
+
+    if store.fanout_threshold is None:
+        return set()
+
+    rows = (db.session
+            .query(Follows.user_being_followed_id)
+            .join(User, User.id == Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == user_id,
+                    User.follower_count > store.fanout_threshold,
+                    User.deleted_at.is_(None))
+            .all())
+    return {author_id for (author_id,) in rows}
+
+
+def merge_timelines(streams, limit):
+    """K-way merge newest-first streams of TimelineItems into one.
+
+    Messages that show up in more than one stream are kept once.
+    """
+
+    merged = merge(*streams,
+                   key=lambda item: item.message_id,
+                   reverse=True)
+    items = []
+    seen = set()
+    for item in merged:
+        if len(items) == limit:
+            break
+        if item.message_id not in seen:
+            seen.add(item.message_id)
+            items.append(item)
+
+    return items
+
+
+def fan_out_message(store, msg):
+    """Push a freshly written message to its author and their followers.
+
+    Authors over the fan-out threshold only get it in their own timeline;
+    their followers pull it at read time.
+    """
+
+    if is_pulled(store, msg.user_id):
+        store.push(item_for(msg), [msg.user_id])
+    else:
+        store.fan_out(item_for(msg))
+
+
+def backfill_follow(store, user_id, followed_id):
+    """`user_id` just followed `followed_id`: copy their recent messages in."""
+
+    if is_pulled(store, followed_id):
+        return
+
+    store.extend(user_id, recent_items([followed_id], store.max_length))
+
+
+def followers_lost(store, author_ids):
+    """Each of `author_ids` has just lost a follower (already flushed).
+
+    Any that are now back down to the fan-out threshold were pulled at read
+    time until now, so their followers' timelines are missing what they
+    posted meanwhile; their recent messages are copied in.
+    """
+
+    if store.fanout_threshold is None or not author_ids:
+        return
+
+    rows = (db.session
+            .query(User.id)
+            .filter(User.id.in_(author_ids),
+                    User.follower_count == store.fanout_threshold)
+            .all())
+    for (author_id,) in rows:
+        store.backfill_followers(author_id, recent_items([author_id], store.max_length))
+
+
+def rebuild_timeline(store, user):
+    """Rebuild `user`'s timeline from scratch from the messages table."""
+
+    author_ids = [author_id for author_id, num_followers in followed_authors(user.id)
+                  if store.fans_out(num_followers)] + [user.id]
+
+    store.drop(user.id)
+    store.extend(user.id, recent_items(author_ids, store.max_length))
+    store.mark_built(user.id)
+
+
+def read_timeline(store, user, limit, before=None):
+    """Load the newest `limit` messages in `user`'s timeline, newest first.
+
+    If `before` is a ``(message_id,)`` cursor, start just after it.
+
+    A timeline that has never been built (e.g. one created before timelines
+    were turned on, or after an in-memory store restarted) is rebuilt first,
+    and one that has grown past `max_length` is trimmed.  Recent messages from followed authors over the fan-out threshold are
+    merged in.
+
+    Entries by authors who have since deleted their accounts stay in the
+    store until they are purged, so those are skipped and the timeline is
+    read further until `limit` messages are found or it runs out.
+    """
+
+    if before is None:
+        if not store.is_built(user.id):
+            rebuild_timeline(store, user)
+            db.session.commit()
+        elif store.trim(user.id):
+            db.session.commit()
+
+    pulled = pulled_author_ids(store, user.id)
+    messages = []
+
+    while len(messages) < limit:
+        streams = [store.read(user.id, limit, before)] + [
+            recent_items([author_id], limit, before) for author_id in pulled]
+        items = merge_timelines(streams, limit)
+        if not items:
+            break
+
+        ids = [item.message_id for item in items]
+        by_id = {msg.id: msg
+                 for msg in with_authors(Message.visible().filter(Message.id.in_(ids)))}
+        messages += [by_id[message_id] for message_id in ids if message_id in by_id]
+
+        if len(items) < limit:
+            break
+        before = (items[-1].message_id,)
+
+    return messages[:limit]
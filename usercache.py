@@ -0,0 +1,88 @@
+"""Short-lived, process-wide cache of logged-in users' rows.
+
+Every request from a logged-in user needs that user's row for ``g.user``.
+With ``CURRENT_USER_CACHE_TTL`` set to a number of seconds, the row's
+profile columns are kept in this process for that long, and ``g.user`` is
+rebuilt from them without a round trip to the database.
+
+Only the columns below are cached.  Anything else (e.g. the denormalized
+counters) is left expired on the rebuilt user and loaded from the database
+if a page actually uses it, so it is never stale.
+
+Each worker process has its own cache, so a change made through another
+process can take up to the TTL to show up here.  Views that change the
+cached columns must call `forget`.
+"""
+
+from threading import Lock
+from time import monotonic
+
+from sqlalchemy.orm import make_transient_to_detached
+
+from models import db, User
+
+CACHED_COLUMNS = ('id', 'email', 'username', 'image_url', 'header_image_url',
+                  'bio', 'location', 'password', 'deleted_at')
+
+
+class UserCache:
+    """Map of user id -> (expiry time, cached column values)."""
+
+    def __init__(self):
+        self.rows = {}
+        self.lock = Lock()
+
+    def get(self, user_id):
+        """Cached column values for `user_id`, or None if missing or expired."""
+
+        with self.lock:
+            entry = self.rows.get(user_id)
+
+        if entry and entry[0] > monotonic():
+            return entry[1]
+
+        return None
+
+    def put(self, user, ttl):
+        """Remember `user`'s columns for `ttl` seconds."""
+
+        row = {column: getattr(user, column) for column in CACHED_COLUMNS}
+
+        with self.lock:
+            self.rows[user.id] = (monotonic() + ttl, row)
+
+    def forget(self, user_id):
+        """Drop `user_id` from the cache, e.g. after their profile changed."""
+
+        with self.lock:
+            self.rows.pop(user_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.rows.clear()
+
+
+user_cache = UserCache()
+
+
+def load_user(user_id, ttl):
+    """Get user `user_id`, from the process cache when `ttl` allows.
+
+    A cached user is attached to the current db session as if it had just
+    been queried, so it can be used (and changed) like any other.  Deleted
+    users come back as None.
+    """
+
+    row = user_cache.get(user_id) if ttl else None
+    if row is None:
+        user = User.query.get(user_id)
+        if user and ttl:
+            user_cache.put(user, ttl)
+        return user if user and not user.deleted_at else None
+
+    if row['deleted_at']:
+        return None
+
+    user = User(**row)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)